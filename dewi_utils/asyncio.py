@@ -0,0 +1,151 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import asyncio
+import time
+from abc import ABC
+
+from dewi_core.logger import log_error
+from dewi_utils.threading import Job, JobParam, MapReduceConfig
+
+
+class AsyncJob(Job, ABC):
+    """
+    Counterpart of threading.Job for I/O bound jobs, the _run() method is a coroutine.
+
+    The next_job_class(), next_job_param_list(), post_processor_job_class() and
+    post_processor_job_params() methods are the same as in threading.Job,
+    and the job classes returned by them must be AsyncJob classes.
+    The retry policy and the timeout of the job class are also used, but here
+    the timed out _run() is cancelled.
+    """
+
+    def __init__(self, pool):
+        super().__init__(pool)
+        self.pool: AsyncPool = pool
+
+    async def run(self, _=None):
+        if not self.is_cancelled:
+            await self._run_with_retries()
+        self.pool.job_completed(self)
+
+    async def _run_with_retries(self):
+        self.started_at = time.monotonic()
+        delay = self.retry_delay
+
+        while True:
+            try:
+                self.result = await asyncio.wait_for(self._run(), self.timeout)
+                break
+            except asyncio.TimeoutError:
+                self.timed_out = self.failed = True
+                log_error("Job timed out", job_class=self.__class__.__name__, timeout=self.timeout)
+                break
+            except Exception as e:
+                if not self._may_retry(e, delay):
+                    break
+                await self._sleep_async(delay)
+                delay *= self.retry_backoff
+
+        self.finished_at = time.monotonic()
+
+    async def _sleep_async(self, delay: float):
+        # interrupted by AsyncPool.cancel()
+        try:
+            await asyncio.wait_for(self.pool.cancel_event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        raise NotImplementedError()
+
+
+class AsyncPool:
+    """
+    Runs AsyncJobs and their chained (next) and post processor (reducer) jobs
+    in a single thread using asyncio, see threading.Pool.
+
+    At most `concurrency` jobs are running (their _run() is awaited) at the same time.
+
+    After cancel() the not yet started jobs are skipped and no more next or reducer jobs are created.
+
+    If the completion of a job raises an exception (e.g. its next_job_param_list()), the run is cancelled,
+    and the first exception is raised by run() after the running jobs are finished, as by threading.Pool.
+    """
+    tasks: set[asyncio.Task]
+
+    def __init__(self, *, state=None, concurrency: int = 100):
+        self.state = state
+        self.concurrency = max(1, concurrency)
+        self.tasks = set()
+        self.map_reduce = MapReduceConfig()
+        self.is_cancelled = False
+        self.cancel_event: asyncio.Event | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._all_jobs_finished: asyncio.Event | None = None
+        self._error: BaseException | None = None
+
+    def cancel(self):
+        self.is_cancelled = True
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+
+    def job_completed(self, job: AsyncJob):
+        try:
+            if not self.is_cancelled:
+                if not job.timed_out:
+                    self._register_next_jobs(job)
+                self._may_reduce(job)
+        finally:
+            self.tasks.discard(job.internal_future)
+            if not self.tasks:
+                self._all_jobs_finished.set()
+
+    def _register_next_jobs(self, job: AsyncJob):
+        for params in job.next_job_param_list():
+            self._register_job(job.next_job_class()(self, *params.args, **params.kwargs), job)
+
+    def _register_job(self, job: AsyncJob, parent: AsyncJob | None = None):
+        self.map_reduce.add_job(job, parent)
+        self._submit_job(job)
+
+    def _submit_job(self, job: AsyncJob):
+        job.internal_future = asyncio.ensure_future(self._run_job(job))
+        self.tasks.add(job.internal_future)
+
+    async def _run_job(self, job: AsyncJob):
+        async with self._semaphore:
+            try:
+                await job.run()
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+                self.cancel()
+
+    def _may_reduce(self, job: AsyncJob):
+        reducer_job = self.map_reduce.may_reduce_job(self, job)
+        if reducer_job:
+            self._submit_job(reducer_job)
+
+    async def run(self, job_class: type, params_list: list[JobParam]):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._all_jobs_finished = asyncio.Event()
+        self.cancel_event = asyncio.Event()
+        if self.is_cancelled:
+            self.cancel_event.set()
+        self._error = None
+
+        for params in params_list:
+            self._register_job(job_class(self, *params.args, **params.kwargs))
+
+        if self.tasks:
+            await self._all_jobs_finished.wait()
+
+        if self._error is not None:
+            raise self._error
+
+    def run_until_complete(self, job_class: type, params_list: list[JobParam]):
+        """
+        Runs the jobs in a new event loop, for callers that are not coroutines.
+        """
+        asyncio.run(self.run(job_class, params_list))
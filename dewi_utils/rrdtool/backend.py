@@ -0,0 +1,359 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import collections.abc
+import contextlib
+import enum
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from dewi_core.logger import log_debug, log_info
+
+
+class RrdToolError(Exception):
+    pass
+
+
+class GraphBackendType(enum.Enum):
+    # Run 'rrdtool graph' for each graph
+    SUBPROCESS = 1
+    # Keep a long-running 'rrdtool -' process per thread and send the graph commands to it
+    PIPE = 2
+    # Use the rrdtool Python bindings (python-rrdtool), no process is started,
+    # but only in the time zone of the process, see BindingsGraphBackend
+    BINDINGS = 3
+    # BINDINGS if the bindings are installed and the time zone is the same as of the process, otherwise PIPE
+    AUTO = 4
+
+
+class GraphBackend:
+    """
+    Renders a graph using rrdtool. The args are the arguments of 'rrdtool graph'
+    without the command name and the output file name, the result is the image.
+    """
+
+    def __init__(self, env: dict[str, str] | None = None):
+        self._env = env
+
+    def graph(self, args: list[str]) -> bytes:
+        raise NotImplementedError()
+
+    def graph_many(self, args_list: list[list[str]]) -> list[bytes]:
+        """
+        Renders multiple graphs, e.g. the graphs of a plugin for each interval.
+        The backends may render them at once, in the same rrdtool process.
+        """
+        return [self.graph(args) for args in args_list]
+
+    def close(self):
+        pass
+
+
+class SubprocessGraphBackend(GraphBackend):
+    def graph(self, args: list[str]) -> bytes:
+        return subprocess.check_output(['rrdtool', 'graph', '-'] + args, env=self._env)
+
+    def graph_many(self, args_list: list[list[str]]) -> list[bytes]:
+        if len(args_list) < 2:
+            return super().graph_many(args_list)
+
+        # One 'rrdtool -' process for all graphs instead of one process per graph
+        backend = PipeGraphBackend(self._env)
+        try:
+            return backend.graph_many(args_list)
+        finally:
+            backend.close()
+
+
+def quote_pipe_arg(arg: str) -> str | None:
+    """
+    Quotes an argument for the 'rrdtool -' (pipe mode) command line, which splits the line
+    at spaces and supports single and double quotes, but no escaping.
+    Returns None if the argument cannot be represented.
+    """
+    if '\n' in arg or '\r' in arg:
+        return None
+    if arg and not any(c in arg for c in ' \t\'"'):
+        return arg
+    if "'" not in arg:
+        return f"'{arg}'"
+    if '"' not in arg:
+        return f'"{arg}"'
+    return None
+
+
+class PipeGraphBackend(GraphBackend):
+    """
+    Sends the graph commands to a long-running 'rrdtool -' process, so only one rrdtool
+    process is started instead of one per graph. The graph is written to a temporary file,
+    as the output of the commands and the image cannot be separated on stdout.
+
+    It's not thread-safe, use one instance per thread, see ThreadLocalGraphBackend.
+    """
+
+    # Max. number of commands sent at once by graph_many(), to avoid filling the pipes
+    BATCH_SIZE = 16
+
+    def __init__(self, env: dict[str, str] | None = None):
+        super().__init__(env)
+        self._process: subprocess.Popen | None = None
+        self._directory: str | None = None
+        self._fallback = SubprocessGraphBackend(env)
+
+    def _start(self):
+        self._directory = tempfile.mkdtemp(prefix='dewi-rrdtool-')
+        self._process = subprocess.Popen(['rrdtool', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         env=self._env, text=True, encoding='UTF-8', bufsize=1)
+        log_debug('Started rrdtool in pipe mode', pid=self._process.pid)
+
+    def _ensure_started(self):
+        if self._process is None or self._process.poll() is not None:
+            self.close()
+            self._start()
+
+    def graph(self, args: list[str]) -> bytes:
+        quoted_args = [quote_pipe_arg(arg) for arg in args]
+        if None in quoted_args:
+            return self._fallback.graph(args)
+
+        self._ensure_started()
+
+        filename = os.path.join(self._directory, 'graph.png')
+        self._process.stdin.write(' '.join(['graph', filename] + quoted_args) + '\n')
+        self._process.stdin.flush()
+        self._read_response()
+
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def graph_many(self, args_list: list[list[str]]) -> list[bytes]:
+        """
+        Sends the commands at once (at most BATCH_SIZE of them), each graph is written to
+        a separate file, and then reads the responses, so rrdtool doesn't wait for the next command.
+        """
+        images: list[bytes | None] = [None] * len(args_list)
+        commands = []
+
+        for i, args in enumerate(args_list):
+            quoted_args = [quote_pipe_arg(arg) for arg in args]
+            if None in quoted_args:
+                images[i] = self._fallback.graph(args)
+            else:
+                commands.append((i, quoted_args))
+
+        for start in range(0, len(commands), self.BATCH_SIZE):
+            self._graph_batch(commands[start:start + self.BATCH_SIZE], images)
+
+        return images
+
+    def _graph_batch(self, commands: list[tuple[int, list[str]]], images: list[bytes | None]):
+        self._ensure_started()
+
+        filenames = [os.path.join(self._directory, f'graph-{n}.png') for n in range(len(commands))]
+        self._process.stdin.write(''.join(
+            ' '.join(['graph', filename] + quoted_args) + '\n'
+            for filename, (_, quoted_args) in zip(filenames, commands)))
+        self._process.stdin.flush()
+
+        # All responses are read even if a command failed, to keep the process usable
+        error = None
+        for _ in commands:
+            try:
+                self._read_response()
+            except RrdToolError as e:
+                if self._process.poll() is not None:
+                    raise
+                error = error or e
+
+        if error is not None:
+            raise error
+
+        for filename, (i, _) in zip(filenames, commands):
+            with open(filename, 'rb') as f:
+                images[i] = f.read()
+
+    def _read_response(self):
+        while True:
+            line = self._process.stdout.readline()
+            if not line:
+                self._process.wait()
+                raise RrdToolError(f'rrdtool exited unexpectedly, exit code: {self._process.returncode}')
+            if line.startswith('OK'):
+                return
+            if line.startswith('ERROR'):
+                raise RrdToolError(line.strip())
+
+    def close(self):
+        if self._process is not None:
+            if self._process.poll() is None:
+                try:
+                    self._process.stdin.write('quit\n')
+                    self._process.stdin.close()
+                except (BrokenPipeError, OSError):
+                    pass
+            self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+
+class BindingsGraphBackend(GraphBackend):
+    """
+    Uses the rrdtool Python bindings. The bindings use the time zone of the process, which is not changed
+    by a backend, as it would affect the other backends and the rest of the process, so the TZ of env
+    must be the same as of the process.
+    """
+
+    def __init__(self, env: dict[str, str] | None = None):
+        super().__init__(env)
+        if not _has_process_tz(env):
+            raise RrdToolError(f'The rrdtool bindings cannot use a time zone other than of the process: '
+                               f'{env["TZ"]}')
+
+        import rrdtool
+        self._rrdtool = rrdtool
+
+    def graph(self, args: list[str]) -> bytes:
+        try:
+            return self._rrdtool.graphv('-', *args)['image']
+        except self._rrdtool.OperationalError as e:
+            raise RrdToolError(str(e)) from e
+
+
+def has_rrdtool_bindings() -> bool:
+    try:
+        import rrdtool
+        return hasattr(rrdtool, 'graphv')
+    except ImportError:
+        return False
+
+
+def _has_process_tz(env: dict[str, str] | None) -> bool:
+    tz = (env or {}).get('TZ')
+    return not tz or tz == os.environ.get('TZ')
+
+
+def create_graph_backend(backend_type: GraphBackendType, env: dict[str, str] | None = None) -> GraphBackend:
+    if backend_type == GraphBackendType.AUTO:
+        use_bindings = _has_process_tz(env) and has_rrdtool_bindings()
+        backend_type = GraphBackendType.BINDINGS if use_bindings else GraphBackendType.PIPE
+
+    if backend_type == GraphBackendType.PIPE:
+        return PipeGraphBackend(env)
+    elif backend_type == GraphBackendType.BINDINGS:
+        return BindingsGraphBackend(env)
+    else:
+        return SubprocessGraphBackend(env)
+
+
+class ThreadLocalGraphBackend(GraphBackend):
+    """
+    Creates a backend per thread, e.g. one 'rrdtool -' process per worker of a Pool.
+    """
+
+    def __init__(self, backend_type: GraphBackendType, env: dict[str, str] | None = None):
+        super().__init__(env)
+        self._backend_type = backend_type
+        self._local = threading.local()
+        self._backends: list[GraphBackend] = list()
+        self._lock = threading.Lock()
+
+    def _get_backend(self) -> GraphBackend:
+        backend = getattr(self._local, 'backend', None)
+        if backend is None:
+            backend = self._local.backend = create_graph_backend(self._backend_type, self._env)
+            with self._lock:
+                self._backends.append(backend)
+        return backend
+
+    def graph(self, args: list[str]) -> bytes:
+        return self._get_backend().graph(args)
+
+    def graph_many(self, args_list: list[list[str]]) -> list[bytes]:
+        return self._get_backend().graph_many(args_list)
+
+    def close(self):
+        with self._lock:
+            backends, self._backends = self._backends, list()
+        for backend in backends:
+            backend.close()
+        self._local = threading.local()
+        if backends:
+            log_info('Closed rrdtool graph backends', count=len(backends), type=self._backend_type.name)
+
+
+class PooledGraphBackend(GraphBackend):
+    """
+    Shares at most `size` backends between the threads, e.g. between the request threads of a server.
+    Those threads are not reused, so ThreadLocalGraphBackend would create a backend
+    (e.g. an 'rrdtool -' process) for each request. A thread waits if all backends are in use.
+    """
+
+    def __init__(self, backend_type: GraphBackendType, env: dict[str, str] | None = None, size: int = 4):
+        super().__init__(env)
+        self._backend_type = backend_type
+        self._size = max(1, size)
+        self._idle_backends: list[GraphBackend] = list()
+        self._count = 0
+        self._condition = threading.Condition()
+
+    @property
+    def count(self) -> int:
+        """
+        The number of the created backends, which are not closed yet
+        """
+        return self._count
+
+    @contextlib.contextmanager
+    def _acquire(self) -> collections.abc.Iterator[GraphBackend]:
+        with self._condition:
+            while not self._idle_backends and self._count >= self._size:
+                self._condition.wait()
+
+            backend = self._idle_backends.pop() if self._idle_backends else None
+            if backend is None:
+                self._count += 1
+
+        if backend is None:
+            try:
+                backend = create_graph_backend(self._backend_type, self._env)
+            except BaseException:
+                with self._condition:
+                    self._count -= 1
+                    self._condition.notify()
+                raise
+
+        try:
+            yield backend
+        finally:
+            with self._condition:
+                self._idle_backends.append(backend)
+                self._condition.notify()
+
+    def graph(self, args: list[str]) -> bytes:
+        with self._acquire() as backend:
+            return backend.graph(args)
+
+    def graph_many(self, args_list: list[list[str]]) -> list[bytes]:
+        with self._acquire() as backend:
+            return backend.graph_many(args_list)
+
+    def close(self):
+        """
+        Closes the idle backends, it should be called when no graph is being rendered.
+        """
+        with self._condition:
+            backends, self._idle_backends = self._idle_backends, list()
+            self._count -= len(backends)
+
+        for backend in backends:
+            backend.close()
+        if backends:
+            log_info('Closed rrdtool graph backends', count=len(backends), type=self._backend_type.name)
@@ -0,0 +1,291 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+"""
+Benchmark of the rrdtool subsystem using a synthetic Munin master.
+
+It generates a datafile and the rrd files of the given number of domains, hosts, plugins and fields,
+then measures the stages of the graph generation: loading the datafile, modifying the config
+and generating the graphs. The graphs are rendered by a stub rrdtool, so neither rrdtool nor
+real data is needed, and the results show the overhead of the Python code.
+
+Usage:
+    python -m dewi_utils.rrdtool.benchmark --hosts 100 --plugins 20 --fields 5 --output result.json
+    python -m dewi_utils.rrdtool.benchmark --hosts 100 --plugins 20 --fields 5 --compare result.json
+
+The result of a run can be saved as JSON and compared to a later run (e.g. of the next release),
+the exit code is 1 if a stage is slower (or uses more memory) than the threshold.
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import os.path
+import platform
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dewi_utils.rrdtool.backend import GraphBackendType, RrdToolError
+from dewi_utils.rrdtool.config import GraphConfig
+from dewi_utils.rrdtool.interval import GraphInterval
+from dewi_utils.rrdtool.loader import GraphLoader
+from dewi_utils.rrdtool.modifiers import (
+    ConfigModifierPipeline, IgnoreLoopbackDisks, RewriteDiskstatsLabels, SeparateDiskstatsPluginsPerDevice,
+)
+from dewi_utils.rrdtool.rrdfile import create_rrd_file_content
+from dewi_utils.rrdtool.writer import GraphResult, GraphWriter
+
+# Speaks both 'rrdtool graph -' and the pipe mode ('rrdtool -'), and writes a fake image
+STUB_RRDTOOL = '''#!{python}
+import shlex
+import sys
+
+IMAGE = b'\\x89PNG\\r\\n\\x1a\\n' + bytes(1024)
+
+if sys.argv[1:] == ['-']:
+    for line in sys.stdin:
+        args = shlex.split(line)
+        if not args or args[0] == 'quit':
+            break
+        if args[0] == 'graph':
+            with open(args[1], 'wb') as f:
+                f.write(IMAGE)
+        print('OK u:0.00 s:0.00 r:0.00', flush=True)
+elif sys.argv[1:3] == ['graph', '-']:
+    sys.stdout.buffer.write(IMAGE)
+else:
+    sys.exit('Unsupported stub rrdtool command: ' + ' '.join(sys.argv[1:]))
+'''
+
+CATEGORIES = ['system', 'network', 'disk', 'processes', 'other']
+
+
+def write_stub_rrdtool(directory: str) -> str:
+    """
+    Writes the stub rrdtool into the directory, which should be prepended to PATH.
+    """
+    filename = os.path.join(directory, 'rrdtool')
+    with open(filename, 'w') as f:
+        f.write(STUB_RRDTOOL.format(python=sys.executable))
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return filename
+
+
+def _create_rrd_file_content(last_update: int, row_count: int = 10) -> bytes:
+    """
+    Creates an rrd file with a single data source ('42', as Munin's)
+    and a single AVERAGE archive of unknown values.
+    """
+    return create_rrd_file_content(last_update, ['42'], [('AVERAGE', 1, [(math.nan,)] * row_count)])
+
+
+def generate_munin_directory(directory: str, *, domains: int = 1, hosts: int = 10, plugins: int = 10,
+                             fields: int = 5, last_update: int | None = None):
+    """
+    Generates a munin directory with a datafile and the rrd files. The first two plugins of each host
+    are diskstats plugins, so the default modifiers also have work to do. Their fields are read/write pairs
+    of devices, so an odd field count is rounded up.
+    """
+    content = _create_rrd_file_content(last_update or int(time.time()))
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, 'datafile'), 'w') as datafile:
+        datafile.write('version 2.0.0\n')
+
+        for d in range(domains):
+            domain = f'domain{d}.example.com'
+            os.makedirs(os.path.join(directory, domain), exist_ok=True)
+
+            for h in range(hosts):
+                host = f'host{h}.{domain}'
+
+                for p in range(plugins):
+                    if p < 2:
+                        plugin, suffix = ('diskstats_iops', 'io') if p == 0 else ('diskstats_throughput', 'bytes')
+                        category = 'disk'
+                        field_names = [f'sd{chr(ord("a") + i)}_{op}{suffix}'
+                                       for i in range((fields + 1) // 2) for op in ('rd', 'wr')]
+                    else:
+                        plugin = f'plugin{p}'
+                        category = CATEGORIES[p % len(CATEGORIES)]
+                        field_names = [f'field{i}' for i in range(fields)]
+
+                    prefix = f'{domain};{host}:{plugin}'
+                    datafile.write(f'{prefix}.graph_title Plugin {p} of {host}\n'
+                                   f'{prefix}.graph_category {category}\n'
+                                   f'{prefix}.graph_args --base 1000 -l 0;\n'
+                                   f'{prefix}.graph_vlabel per ${{graph_period}}\n'
+                                   f'{prefix}.graph_order {" ".join(field_names)}\n')
+
+                    for field in field_names:
+                        datafile.write(f'{prefix}.{field}.label {field}\n'
+                                       f'{prefix}.{field}.draw LINE1\n'
+                                       f'{prefix}.{field}.type DERIVE\n'
+                                       f'{prefix}.{field}.min 0\n')
+
+                        with open(os.path.join(directory, domain, f'{host}-{plugin}-{field}-d.rrd'), 'wb') as f:
+                            f.write(content)
+
+
+class Benchmark:
+    """
+    Runs the stages of the graph generation on a munin directory and collects the timings.
+
+    Each stage reports its wall-clock time, and if trace_memory is True, its peak memory
+    allocated by Python (tracemalloc), which slows down the stages.
+    """
+
+    def __init__(self, munin_directory: str, *, parallel_count: int = 1,
+                 backend: GraphBackendType = GraphBackendType.PIPE, batch_intervals: bool = False,
+                 adaptive_parallel_count: bool = False, trace_memory: bool = False):
+        self._munin_directory = munin_directory
+        self._parallel_count = parallel_count
+        self._backend = backend
+        self._batch_intervals = batch_intervals
+        self._adaptive_parallel_count = adaptive_parallel_count
+        self._trace_memory = trace_memory
+        self.stages: dict[str, dict[str, float]] = dict()
+
+    def _measure(self, name: str, func):
+        if self._trace_memory:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        try:
+            result = func()
+        finally:
+            self.stages[name] = dict(time=time.perf_counter() - start)
+            if self._trace_memory:
+                self.stages[name]['peak_memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+        return result
+
+    def run(self) -> dict:
+        config = self._measure('load', self._load)
+        plugin_count = sum(1 for _ in config.plugins)
+        field_count = sum(1 for _ in config.fields)
+
+        self._measure('modify', lambda: ConfigModifierPipeline(
+            [IgnoreLoopbackDisks(), RewriteDiskstatsLabels(), SeparateDiskstatsPluginsPerDevice()]).modify(config))
+
+        intervals = GraphInterval.default_intervals()
+        graph_count = self._measure('generate', lambda: self._generate(config, intervals))
+        expected_graph_count = len(intervals) * sum(1 for _ in config.plugins)
+        if graph_count != expected_graph_count:
+            raise RrdToolError(f'Only {graph_count} of {expected_graph_count} graphs are generated')
+
+        return dict(
+            stages=self.stages,
+            plugins=plugin_count,
+            fields=field_count,
+            graphs=graph_count,
+            graphs_per_second=graph_count / self.stages['generate']['time'],
+            max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        )
+
+    def _load(self) -> GraphConfig:
+        loader = GraphLoader(os.path.join(self._munin_directory, 'datafile'))
+        loader.load()
+        return loader.config
+
+    def _generate(self, config: GraphConfig, intervals: list[GraphInterval]) -> int:
+        output = GraphResult()
+        writer = GraphWriter(self._munin_directory, config, output, datetime.datetime.now(),
+                             parallel_count=self._parallel_count, backend=self._backend,
+                             batch_intervals=self._batch_intervals,
+                             adaptive_parallel_count=self._adaptive_parallel_count)
+        writer.generate(intervals)
+        return len(output.graphs)
+
+
+def compare_results(baseline: dict, result: dict, threshold: float) -> list[str]:
+    """
+    Returns the regressions: the stages where the time or the peak memory increased
+    by more than threshold (e.g. 0.1 = 10%) compared to the baseline.
+    """
+    regressions = []
+    for stage, values in result['stages'].items():
+        for key, value in values.items():
+            base_value = baseline['stages'].get(stage, {}).get(key)
+            if base_value and value > base_value * (1 + threshold):
+                regressions.append(f'{stage}.{key}: {base_value:.4g} -> {value:.4g} (+{value / base_value - 1:.0%})')
+
+    return regressions
+
+
+def _print_result(result: dict):
+    print(f"Plugins: {result['plugins']}, fields: {result['fields']}, graphs: {result['graphs']}")
+    for stage, values in result['stages'].items():
+        line = f"{stage:>10}: {values['time']:9.3f} s"
+        if 'peak_memory' in values:
+            line += f", peak memory: {values['peak_memory'] / 1024 / 1024:8.1f} MiB"
+        print(line)
+    print(f"Graphs per second: {result['graphs_per_second']:.1f}")
+    print(f"Max RSS: {result['max_rss'] / 1024 / 1024:.1f} MiB")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m dewi_utils.rrdtool.benchmark',
+                                     description='Benchmark of the rrdtool subsystem using a synthetic Munin master')
+    parser.add_argument('--domains', type=int, default=1)
+    parser.add_argument('--hosts', type=int, default=10)
+    parser.add_argument('--plugins', type=int, default=10, help='Plugins per host')
+    parser.add_argument('--fields', type=int, default=5, help='Fields per plugin')
+    parser.add_argument('--parallel', type=int, default=1, help='Parallel run count of the graph generation')
+    parser.add_argument('--backend', choices=[t.name.lower() for t in GraphBackendType], default='pipe')
+    parser.add_argument('--batch-intervals', action='store_true')
+    parser.add_argument('--adaptive-parallel', action='store_true',
+                        help='Adjust the parallel run count while generating, --parallel is the upper limit')
+    parser.add_argument('--trace-memory', action='store_true', help='Measure peak memory per stage (slower)')
+    parser.add_argument('--directory', help='Munin directory to use, generated if it does not exist')
+    parser.add_argument('--output', help='Save the result as JSON')
+    parser.add_argument('--compare', help='Compare the result to a JSON result of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Allowed increase compared to --compare')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='dewi-rrdtool-benchmark-')
+    try:
+        munin_directory = args.directory or os.path.join(tmpdir, 'munin')
+        if not os.path.exists(os.path.join(munin_directory, 'datafile')):
+            generate_munin_directory(munin_directory, domains=args.domains, hosts=args.hosts,
+                                     plugins=args.plugins, fields=args.fields)
+
+        write_stub_rrdtool(tmpdir)
+        os.environ['PATH'] = tmpdir + os.pathsep + os.environ.get('PATH', '')
+
+        benchmark = Benchmark(munin_directory, parallel_count=args.parallel,
+                              backend=GraphBackendType[args.backend.upper()],
+                              batch_intervals=args.batch_intervals, adaptive_parallel_count=args.adaptive_parallel,
+                              trace_memory=args.trace_memory)
+        result = benchmark.run()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    result['parameters'] = {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'threshold')}
+    result['python'] = platform.python_version()
+    _print_result(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), result, args.threshold)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
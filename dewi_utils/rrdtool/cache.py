@@ -0,0 +1,215 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import collections
+import collections.abc
+import hashlib
+import os
+import os.path
+import tempfile
+import threading
+from concurrent.futures import Future
+
+from dewi_core.logger import log_debug, log_info
+
+
+class BaseGraphCache:
+    """
+    Cache of the generated graphs.
+
+    The key of a graph is calculated from the full 'rrdtool graph' argument list, so it contains
+    the plugin, the interval (start and end time) and the size of the graph, and from the
+    modification time and size of the used rrd files. If none of them changed,
+    the cached graph is used instead of running rrdtool again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hit_count = 0
+        self.miss_count = 0
+
+    @staticmethod
+    def calculate_key(args: list[str], rrd_filenames: list[str]) -> str:
+        h = hashlib.sha256()
+
+        for arg in args:
+            h.update(arg.encode('UTF-8'))
+            h.update(b'\0')
+
+        for filename in rrd_filenames:
+            try:
+                st = os.stat(filename)
+                h.update(f'{filename}\0{st.st_mtime_ns}\0{st.st_size}\0'.encode('UTF-8'))
+            except FileNotFoundError:
+                h.update(f'{filename}\0-\0'.encode('UTF-8'))
+
+        return h.hexdigest()
+
+    def get_or_render(self, key: str, render: collections.abc.Callable[[], bytes]) -> bytes:
+        """
+        Returns the cached graph, or the graph rendered by render(), which is also stored.
+        """
+        raise NotImplementedError()
+
+    def get_or_render_many(self, keys: list[str],
+                           render_many: collections.abc.Callable[[list[int]], list[bytes]]) -> list[bytes]:
+        """
+        Returns the graphs of the keys. The missing graphs are rendered by render_many(),
+        which gets the indices of the missing keys and returns their graphs in the same order.
+        """
+        return [self.get_or_render(key, lambda i=i: render_many([i])[0]) for i, key in enumerate(keys)]
+
+    def log_statistics(self):
+        log_info('Graph cache', type=self.__class__.__name__, hits=self.hit_count, misses=self.miss_count)
+
+
+class GraphCache(BaseGraphCache):
+    """
+    Persistent cache of the generated graphs, one PNG file per graph in the cache directory.
+
+    The graphs that are not used since the cache is created are removed by prune(),
+    so the cache directory shouldn't be shared between different munin directories.
+    """
+
+    SUFFIX = '.png'
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self._directory = directory
+        self._used_keys: set[str] = set()
+
+        os.makedirs(self._directory, exist_ok=True)
+
+    def get_or_render(self, key: str, render: collections.abc.Callable[[], bytes]) -> bytes:
+        image = self.get(key)
+        if image is None:
+            image = render()
+            self.put(key, image)
+
+        return image
+
+    def get_or_render_many(self, keys: list[str],
+                           render_many: collections.abc.Callable[[list[int]], list[bytes]]) -> list[bytes]:
+        # The missing graphs are rendered by a single call
+        images = [self.get(key) for key in keys]
+        missing = [i for i, image in enumerate(images) if image is None]
+
+        if missing:
+            for i, image in zip(missing, render_many(missing)):
+                self.put(keys[i], image)
+                images[i] = image
+
+        return images
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self._directory, key + self.SUFFIX)
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            with open(self._filename(key), 'rb') as f:
+                image = f.read()
+        except FileNotFoundError:
+            image = None
+
+        with self._lock:
+            self._used_keys.add(key)
+            if image is None:
+                self.miss_count += 1
+            else:
+                self.hit_count += 1
+
+        return image
+
+    def put(self, key: str, image: bytes):
+        # Written to a temporary file first, so a concurrent or interrupted run never sees a partial graph
+        fd, tmp_filename = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(image)
+            os.replace(tmp_filename, self._filename(key))
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+
+        with self._lock:
+            self._used_keys.add(key)
+
+    def prune(self):
+        """
+        Removes the graphs that were not used (get() or put()) by this instance.
+        """
+        removed = 0
+        for name in os.listdir(self._directory):
+            if name.endswith(self.SUFFIX) and name[:-len(self.SUFFIX)] not in self._used_keys:
+                try:
+                    os.unlink(os.path.join(self._directory, name))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+
+        log_debug('Pruned graph cache', directory=self._directory, removed=removed)
+
+    def log_statistics(self):
+        log_info('Graph cache', directory=self._directory, hits=self.hit_count, misses=self.miss_count)
+
+
+class MemoryGraphCache(BaseGraphCache):
+    """
+    In-memory LRU cache of the last max_count graphs, e.g. for serving the graphs on demand.
+
+    The concurrent requests of the same graph are coalesced: the graph is rendered only by
+    the first caller, the others wait for its result.
+    """
+
+    def __init__(self, max_count: int = 1000):
+        super().__init__()
+        self._max_count = max(1, max_count)
+        self._images: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self._rendered_graphs: dict[str, Future] = dict()
+        self.coalesced_count = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    def get_or_render(self, key: str, render: collections.abc.Callable[[], bytes]) -> bytes:
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.hit_count += 1
+                return image
+
+            future = self._rendered_graphs.get(key)
+            if future is None:
+                self.miss_count += 1
+                self._rendered_graphs[key] = Future()
+            else:
+                self.coalesced_count += 1
+
+        if future is not None:
+            # Rendered by another thread
+            return future.result()
+
+        return self._render(key, render)
+
+    def _render(self, key: str, render: collections.abc.Callable[[], bytes]) -> bytes:
+        try:
+            image = render()
+        except BaseException as e:
+            with self._lock:
+                future = self._rendered_graphs.pop(key)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            future = self._rendered_graphs.pop(key)
+            self._images[key] = image
+            while len(self._images) > self._max_count:
+                self._images.popitem(last=False)
+
+        future.set_result(image)
+        return image
+
+    def log_statistics(self):
+        log_info('Graph cache', type=self.__class__.__name__, hits=self.hit_count, misses=self.miss_count,
+                 coalesced=self.coalesced_count, size=len(self._images))
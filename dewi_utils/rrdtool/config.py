@@ -2,6 +2,7 @@
 # Distributed under the terms of the Apache License, Version 2.0
 
 import collections.abc
+import sys
 from collections import defaultdict
 
 import yaml
@@ -10,7 +11,147 @@ from yaml.dumper import Dumper
 from dewi_dataclass.node import Node
 
 
-class NodeWithName(Node):
+class Options(collections.abc.MutableMapping):
+    """
+    Memory-lean dict of options (of a field or a plugin).
+
+    The keys are stored in a tuple which is shared by all Options objects
+    having the same keys in the same order, e.g. ('label', 'draw', 'type'),
+    so only the tuple of the values is stored per object. The options are rarely
+    modified after loading, so a modification simply creates a new tuple.
+    """
+    __slots__ = ('_keys', '_values')
+
+    # All known key tuples, to share them between the Options objects
+    _key_tables: dict[tuple[str, ...], tuple[str, ...]] = {(): ()}
+
+    def __init__(self, data: collections.abc.Mapping | collections.abc.Iterable | None = None):
+        self._keys: tuple[str, ...] = ()
+        self._values: tuple[str, ...] = ()
+        if data:
+            self.update(data)
+
+    def update(self, data=(), /, **kwargs):
+        if not self._keys and not kwargs and isinstance(data, dict):
+            self._keys = self._shared_keys(tuple(sys.intern(k) for k in data))
+            self._values = tuple(data.values())
+        else:
+            super().update(data, **kwargs)
+
+    @classmethod
+    def _shared_keys(cls, keys: tuple[str, ...]) -> tuple[str, ...]:
+        return cls._key_tables.setdefault(keys, keys)
+
+    def __getitem__(self, key: str) -> str:
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value: str):
+        try:
+            idx = self._keys.index(key)
+        except ValueError:
+            self._keys = self._shared_keys(self._keys + (sys.intern(key),))
+            self._values += (value,)
+        else:
+            self._values = self._values[:idx] + (value,) + self._values[idx + 1:]
+
+    def __delitem__(self, key: str):
+        try:
+            idx = self._keys.index(key)
+        except ValueError:
+            raise KeyError(key) from None
+
+        self._keys = self._shared_keys(self._keys[:idx] + self._keys[idx + 1:])
+        self._values = self._values[:idx] + self._values[idx + 1:]
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys
+
+    def __iter__(self) -> collections.abc.Iterator[str]:
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+    def copy(self) -> 'Options':
+        return Options(self)
+
+    def __getstate__(self) -> tuple[tuple[str, ...], tuple[str, ...]]:
+        return self._keys, self._values
+
+    def __setstate__(self, state: tuple[tuple[str, ...], tuple[str, ...]]):
+        self._keys = self._shared_keys(state[0])
+        self._values = state[1]
+
+
+class SlottedNode(collections.abc.MutableMapping):
+    """
+    Counterpart of Node storing its members in __slots__ instead of a per-instance __dict__,
+    for the config nodes created in large numbers. It isn't a Node subclass, as then
+    each object would also have a __dict__.
+
+    The members can be accessed both as regular object members and as dictionary keys,
+    and all members must be set in __init__().
+    """
+    __slots__ = ()
+
+    _member_names: tuple[str, ...] = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        names = []
+        for klass in reversed(cls.__mro__):
+            for name in klass.__dict__.get('__slots__', ()):
+                if name not in names:
+                    names.append(name)
+        cls._member_names = tuple(names)
+
+    def __getitem__(self, key):
+        if key not in self._member_names:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._member_names:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        raise RuntimeError('Unable to delete key {}'.format(key))
+
+    def __iter__(self):
+        return iter(self._member_names)
+
+    def __len__(self):
+        return len(self._member_names)
+
+    def __contains__(self, item):
+        return item in self._member_names
+
+    def __repr__(self):
+        return str(dict(self.items()))
+
+    def as_dict(self) -> dict:
+        result = {}
+        for key, value in self.items():
+            result[key] = value.as_dict() if isinstance(value, (Node, SlottedNode)) else value
+        return result
+
+    def __getstate__(self) -> dict:
+        return dict(self.items())
+
+    def __setstate__(self, state: dict):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+
+class NodeWithName(SlottedNode):
+    __slots__ = ('name',)
     name: str
 
     def __init__(self):
@@ -31,16 +172,18 @@ class Field(NodeWithName):
     """
     Represents a line or field in a munin Graph
     """
+    __slots__ = ('options', 'filename')
     options: dict[str, str]
     filename: str
 
     def __init__(self):
         super().__init__()
-        self.options = dict()
+        self.options = Options()
         self.filename = None
 
 
 class Plugin(NodeWithName):
+    __slots__ = ('category', 'title', 'period', 'options', 'fields', 'field_order')
     category: str
     title: str
     period: str
@@ -53,12 +196,13 @@ class Plugin(NodeWithName):
         self.category = None
         self.title = None
         self.period = None
-        self.options = dict()
+        self.options = Options()
         self.fields = DefaultDict(Field)
         self.field_order = list()
 
 
 class Host(NodeWithName):
+    __slots__ = ('plugins',)
     plugins: dict[str, Plugin]
 
     def __init__(self):
@@ -67,6 +211,9 @@ class Host(NodeWithName):
 
 
 class Domain(NodeWithName):
+    __slots__ = ('hosts',)
+    hosts: dict[str, Host]
+
     def __init__(self):
         super().__init__()
         self.hosts = DefaultDict(Host)
@@ -78,6 +225,9 @@ class GraphConfig(Node):
     def __init__(self):
         self.domains = DefaultDict(Domain)
 
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+
     @property
     def hosts(self) -> collections.abc.Iterator[tuple[str, str, str]]:
         for domain in self.domains:
@@ -105,3 +255,4 @@ def represent_node(dumper: Dumper, data: DefaultDict):
 
 
 yaml.add_multi_representer(DefaultDict, represent_node)
+yaml.add_multi_representer(Options, represent_node)
@@ -0,0 +1,269 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import datetime
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing.managers import BaseManager
+
+from dewi_core.logger import log_debug, log_error, log_info
+from dewi_utils.rrdtool import config
+from dewi_utils.rrdtool.backend import GraphBackend, GraphBackendType, RrdToolError, create_graph_backend
+from dewi_utils.rrdtool.interval import GraphInterval
+from dewi_utils.rrdtool.writer import DirectorySink, GraphNode, GraphResult, GraphWriter, GraphWriterJob, _prepare_env
+
+# Queues of the broker, they exist only in its server process
+_queues: dict[str, queue.Queue] = dict()
+
+
+def _get_queue(name: str) -> queue.Queue:
+    return _queues.setdefault(name, queue.Queue())
+
+
+class _BrokerManager(BaseManager):
+    pass
+
+
+_BrokerManager.register('get_queue', callable=_get_queue)
+
+
+class GraphBroker:
+    """
+    Settings of the distributed graph generation, see DistributedGraphWriter.
+
+    The broker listens on `address`, the workers connect to it using `authkey`
+    (the key of the current process if it's None, which is inherited only by the local workers).
+    The images are written to `output_directory` by the workers, so it must be
+    the same shared directory on each host, as well as the munin directory.
+
+    `local_worker_count` workers are started on the local host using `backend`,
+    the remote workers are started by run_worker() on the other hosts.
+    If `timeout` is set, the generation fails if no graph is finished within `timeout` seconds.
+    The generation also fails if a local worker dies, but the death of a remote worker can be
+    detected only by the timeout, so it's required if there are no local workers.
+    """
+
+    def __init__(self,
+                 output_directory: str,
+                 *,
+                 address: tuple[str, int] = ('localhost', 0),
+                 authkey: bytes | None = None,
+                 local_worker_count: int = 1,
+                 backend: GraphBackendType = GraphBackendType.AUTO,
+                 timeout: float | None = None,
+                 ):
+        if not local_worker_count and timeout is None:
+            raise ValueError('The timeout must be set if the graphs are generated only by remote workers')
+
+        self.output_directory = output_directory
+        self.address = address
+        self.authkey = authkey
+        self.local_worker_count = local_worker_count
+        self.backend = backend
+        self.timeout = timeout
+
+
+class _GraphJobSettings:
+    """
+    The parameters of GraphWriterJob which are the same for each job
+    """
+
+    def __init__(self,
+                 munin_directory: str,
+                 output_directory: str,
+                 last_update_date_time: datetime.datetime,
+                 last_update_timestamp: int,
+                 width: int,
+                 height: int,
+                 header_args: list[str],
+                 env_tz: str | None):
+        self.munin_directory = munin_directory
+        self.output_directory = output_directory
+        self.last_update_date_time = last_update_date_time
+        self.last_update_timestamp = last_update_timestamp
+        self.width = width
+        self.height = height
+        self.header_args = header_args
+        self.env_tz = env_tz
+
+
+# A job is (index, settings, plugin, intervals), the result is (index, graphs, error),
+# None in the job queue stops the workers
+_GraphJob = tuple[int, _GraphJobSettings, config.Plugin, list[GraphInterval]]
+_GraphJobResult = tuple[int, list[GraphNode] | None, str | None]
+
+
+class DistributedGraphWriter(GraphWriter):
+    """
+    Generates the graphs by worker processes, which may run on multiple hosts sharing the munin
+    directory (e.g. over NFS).
+
+    The writer starts a broker (a multiprocessing manager listening on a socket) with a job queue
+    containing the plugin × interval jobs (a job per plugin if batch_intervals is True), then
+    the workers pull the jobs, render and write the graphs into the output directory, and send back
+    the graph metadata. The graphs are added to the output in the same order as by GraphWriter.
+    """
+    # How often the local workers are checked while waiting for the results, in seconds
+    WORKER_CHECK_INTERVAL = 1.0
+
+    def __init__(self,
+                 munin_directory: str,
+                 config: config.GraphConfig,
+                 output: GraphResult,
+                 last_update_date_time: datetime.datetime | None,
+                 width: int | None = None,
+                 height: int | None = None,
+                 *,
+                 broker: GraphBroker,
+                 batch_intervals: bool = False,
+                 ):
+        super().__init__(munin_directory, config, output, last_update_date_time, width, height,
+                         backend=broker.backend, batch_intervals=batch_intervals)
+        self._broker = broker
+
+    def generate(self, intervals: list[GraphInterval]):
+        log_info('Generating graphs by workers', local_workers=self._broker.local_worker_count)
+        settings = _GraphJobSettings(self._munin_directory, self._broker.output_directory,
+                                     self._last_update_date_time, self._last_update_timestamp,
+                                     self._width, self._height, self._header_args, self._env_tz)
+
+        os.makedirs(self._broker.output_directory, exist_ok=True)
+
+        manager = _BrokerManager(address=self._broker.address, authkey=self._broker.authkey)
+        manager.start()
+        log_info('Started graph broker', address=manager.address)
+
+        workers = []
+        try:
+            jobs = manager.get_queue('jobs')
+            job_count = 0
+            for domain, host, plugin in self._config.plugins:
+                plugin = self._config.domains[domain].hosts[host].plugins[plugin]
+                for job_intervals in [intervals] if self._batch_intervals else [[i] for i in intervals]:
+                    jobs.put((job_count, settings, plugin, job_intervals))
+                    job_count += 1
+            jobs.put(None)
+
+            for _ in range(self._broker.local_worker_count):
+                worker = multiprocessing.Process(target=run_worker,
+                                                 args=(manager.address, self._broker.authkey, self._broker.backend))
+                worker.start()
+                workers.append(worker)
+
+            self._collect_results(manager.get_queue('results'), job_count, workers)
+        except BaseException:
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+            manager.shutdown()
+
+    def _collect_results(self, results, job_count: int, workers: list[multiprocessing.Process]):
+        graphs_of_jobs: list[list[GraphNode] | None] = [None] * job_count
+
+        for _ in range(job_count):
+            index, graphs, error = self._get_result(results, workers)
+            if error is not None:
+                log_error('Unable to generate graph', error=error)
+            graphs_of_jobs[index] = graphs
+
+        for graphs in graphs_of_jobs:
+            if graphs is not None:
+                self._output.graphs.extend(graphs)
+
+    def _get_result(self, results, workers: list[multiprocessing.Process]) -> _GraphJobResult:
+        timeout = self._broker.timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        while True:
+            wait_time = self.WORKER_CHECK_INTERVAL
+            if deadline is not None:
+                wait_time = max(0.0, min(wait_time, deadline - time.monotonic()))
+
+            try:
+                return results.get(timeout=wait_time)
+            except queue.Empty:
+                pass
+
+            # A worker exits successfully only after all jobs are taken, but a crashed worker's job is lost
+            for worker in workers:
+                if worker.exitcode not in (None, 0):
+                    raise RrdToolError(f'A graph worker exited unexpectedly, exit code: {worker.exitcode}')
+
+            if deadline is not None and time.monotonic() >= deadline:
+                raise RrdToolError(f'No graph is generated by the workers in {timeout} seconds')
+
+
+class GraphWorker:
+    """
+    Pulls the jobs of a DistributedGraphWriter from its broker until all jobs are taken.
+    """
+
+    def __init__(self,
+                 address: tuple[str, int],
+                 authkey: bytes | None = None,
+                 backend: GraphBackendType = GraphBackendType.AUTO,
+                 ):
+        self._address = address
+        self._authkey = authkey
+        self._backend_type = backend
+        # Backends per TZ, as in GraphServer
+        self._backends: dict[str | None, GraphBackend] = dict()
+
+    def run(self) -> int:
+        """
+        Returns the number of processed jobs
+        """
+        manager = _BrokerManager(address=self._address, authkey=self._authkey)
+        manager.connect()
+        jobs = manager.get_queue('jobs')
+        results = manager.get_queue('results')
+
+        count = 0
+        try:
+            while True:
+                job: _GraphJob | None = jobs.get()
+                if job is None:
+                    # Put back for the other workers
+                    jobs.put(None)
+                    break
+
+                results.put(self._process(job))
+                count += 1
+        except (EOFError, ConnectionError):
+            # The broker is already stopped
+            pass
+        finally:
+            for backend in self._backends.values():
+                backend.close()
+
+        log_debug('Graph worker finished', jobs=count)
+        return count
+
+    def _process(self, job: _GraphJob) -> _GraphJobResult:
+        index, settings, plugin, intervals = job
+
+        try:
+            backend = self._backends.get(settings.env_tz)
+            if backend is None:
+                backend = self._backends[settings.env_tz] = self._create_backend(settings.env_tz)
+
+            writer_job = GraphWriterJob(None, settings.munin_directory, None, None, settings.last_update_date_time,
+                                        settings.last_update_timestamp, settings.width, settings.height,
+                                        settings.header_args, settings.env_tz, plugin, intervals=intervals,
+                                        backend=backend, sink=DirectorySink(settings.output_directory))
+            return index, writer_job.generate_graphs(), None
+        except Exception as e:
+            return index, None, f'{plugin.name}: {e}'
+
+    def _create_backend(self, env_tz: str | None) -> GraphBackend:
+        return create_graph_backend(self._backend_type, _prepare_env(env_tz))
+
+
+def run_worker(address: tuple[str, int], authkey: bytes | None = None,
+               backend: GraphBackendType = GraphBackendType.AUTO) -> int:
+    return GraphWorker(address, authkey, backend).run()
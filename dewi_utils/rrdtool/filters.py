@@ -0,0 +1,86 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import fnmatch
+import re
+
+# Munin's category of plugins without graph_category
+DEFAULT_CATEGORY = 'other'
+
+Patterns = str | list[str] | None
+
+
+class GraphFilter:
+    """
+    Selects the graphs by domain, host, plugin and category.
+
+    Each parameter is a pattern or a list of patterns, which are glob patterns by default
+    or regular expressions if use_regex is True. The patterns must match the whole name.
+    A plugin is selected if each of its domain, host, plugin name and category matches
+    at least one of the corresponding include patterns (if any),
+    and none of them matches any of the exclude patterns.
+
+    The filter is applied by GraphLoader, so the datafile entries of the other plugins are skipped.
+    """
+
+    def __init__(self, *,
+                 domains: Patterns = None,
+                 hosts: Patterns = None,
+                 plugins: Patterns = None,
+                 categories: Patterns = None,
+                 exclude_domains: Patterns = None,
+                 exclude_hosts: Patterns = None,
+                 exclude_plugins: Patterns = None,
+                 exclude_categories: Patterns = None,
+                 use_regex: bool = False,
+                 ):
+        self._use_regex = use_regex
+        # Identifies the filter, e.g. in the snapshot of the filtered config
+        self.id = (use_regex,) + tuple(self._as_tuple(p) for p in (
+            domains, hosts, plugins, categories, exclude_domains, exclude_hosts, exclude_plugins, exclude_categories))
+
+        self._domains = self._compile(domains)
+        self._hosts = self._compile(hosts)
+        self._plugins = self._compile(plugins)
+        self._categories = self._compile(categories)
+        self._exclude_domains = self._compile(exclude_domains)
+        self._exclude_hosts = self._compile(exclude_hosts)
+        self._exclude_plugins = self._compile(exclude_plugins)
+        self._exclude_categories = self._compile(exclude_categories)
+
+    @staticmethod
+    def _as_tuple(patterns: Patterns) -> tuple[str, ...]:
+        if isinstance(patterns, str):
+            return patterns,
+        return tuple(patterns or ())
+
+    def _compile(self, patterns: Patterns) -> re.Pattern | None:
+        patterns = self._as_tuple(patterns)
+        if not patterns:
+            return None
+
+        if not self._use_regex:
+            patterns = [fnmatch.translate(p) for p in patterns]
+
+        return re.compile('|'.join(f'(?:{p})' for p in patterns))
+
+    @staticmethod
+    def _is_selected(name: str, include: re.Pattern | None, exclude: re.Pattern | None) -> bool:
+        if include is not None and not include.fullmatch(name):
+            return False
+        return exclude is None or not exclude.fullmatch(name)
+
+    @property
+    def has_category_filter(self) -> bool:
+        return self._categories is not None or self._exclude_categories is not None
+
+    def is_plugin_selected(self, domain: str, host: str, plugin: str) -> bool:
+        """
+        Checks the domain, host and plugin name, but not the category
+        """
+        return (self._is_selected(domain, self._domains, self._exclude_domains)
+                and self._is_selected(host, self._hosts, self._exclude_hosts)
+                and self._is_selected(plugin, self._plugins, self._exclude_plugins))
+
+    def is_category_selected(self, category: str | None) -> bool:
+        return self._is_selected(category or DEFAULT_CATEGORY, self._categories, self._exclude_categories)
@@ -1,9 +1,17 @@
 # Copyright 2017-2022 Laszlo Attila Toth
 # Distributed under the terms of the Apache License, Version 2.0
 
+import array
+import collections.abc
+import datetime
 import enum
 import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class GraphIntervalType(enum.Enum):
     HOUR = 1
@@ -12,16 +20,74 @@ class GraphIntervalType(enum.Enum):
     MONTH = 4
     YEAR = 5
     CUSTOM = 6
+    # A sliding window of any length before the end time, see GraphInterval.sliding()
+    SLIDING = 7
+    # The last complete calendar period before the end time, see GraphInterval.calendar()
+    CALENDAR = 8
+
+
+class CalendarPeriod(enum.Enum):
+    DAY = 1
+    # Weeks start on Monday
+    WEEK = 2
+    MONTH = 3
+    YEAR = 4
+
+
+# The length of the predefined sliding windows in seconds.
+# Ranges are slightly differ from day/week/month/day, it's for 400px wide graphs, 1 RRA/px.
+_WINDOW_LENGTHS = {
+    # 4000s, 1h 6m 40s
+    GraphIntervalType.HOUR: 4000,
+    # 2000m, 33h 20m
+    GraphIntervalType.DAY: 2000 * 60,
+    # 12000m, 8d 13h 20m
+    GraphIntervalType.WEEK: 12000 * 60,
+    # 48000m, 33d 8h
+    GraphIntervalType.MONTH: 48000 * 60,
+    # 400d
+    GraphIntervalType.YEAR: 400 * 24 * 3600,
+}
 
 
 class GraphInterval:
+    """
+    The time range of a graph relative to an end time (usually the last update of the rrd files):
+    one of the predefined sliding windows (HOUR - YEAR), a sliding window of any length,
+    the last complete calendar period or a fixed (CUSTOM) range.
+
+    The resolution, if set, is passed to rrdtool as the step of the graph (--step) in seconds.
+    """
+
     def __init__(self,
                  interval_type: GraphIntervalType,
                  start_time: int | None = None,
-                 end_time: int | None = None
+                 end_time: int | None = None,
+                 *,
+                 length: int | None = None,
+                 period: CalendarPeriod | None = None,
+                 tz: datetime.tzinfo | None = None,
+                 name: str | None = None,
+                 resolution: int | None = None,
                  ):
         self.interval_type = interval_type
-        self.interval_name = interval_type.name.lower()
+        self.resolution = resolution
+        self._length = _WINDOW_LENGTHS.get(interval_type, length)
+        self._period = period
+        self._tz = tz
+
+        if self.interval_type == GraphIntervalType.SLIDING:
+            if not length or length <= 0:
+                raise ValueError('The length of a sliding interval must be positive')
+            default_name = f'{length}s'
+        elif self.interval_type == GraphIntervalType.CALENDAR:
+            if period is None:
+                raise ValueError('The period of a calendar interval must be set')
+            default_name = f'calendar_{period.name.lower()}'
+        else:
+            default_name = interval_type.name.lower()
+
+        self.interval_name = name or default_name
         self.interval_title = self.interval_name.capitalize()
 
         if self.interval_type == GraphIntervalType.CUSTOM:
@@ -32,31 +98,74 @@ class GraphInterval:
             self._start_time = self._end_time = None
             self.title_suffix = f'by {self.interval_title}'
 
+    @classmethod
+    def sliding(cls, length: int, *, name: str | None = None, resolution: int | None = None) -> 'GraphInterval':
+        """
+        The last `length` seconds before the end time.
+        """
+        return cls(GraphIntervalType.SLIDING, length=length, name=name, resolution=resolution)
+
+    @classmethod
+    def calendar(cls, period: CalendarPeriod, *, tz: datetime.tzinfo | None = None, name: str | None = None,
+                 resolution: int | None = None) -> 'GraphInterval':
+        """
+        The last complete day, week, month or year before the end time, in the time zone `tz`
+        (the local time zone if it's None). E.g. the calendar day of any time of May 2 is May 1.
+        """
+        return cls(GraphIntervalType.CALENDAR, period=period, tz=tz, name=name, resolution=resolution)
+
     def range(self, end_time_maybe: int) -> tuple[int, int]:
         """
         Return start and end time as UNIX timestamps based on `end_time_maybe` as end time.
 
         In case of custom ranges the end_time_maybe is ignored.
-
-        Ranges are slightly differ from day/week/month/day, it's for 400px wide graphs, 1 RRA/px.
         """
         if self.interval_type == GraphIntervalType.CUSTOM:
             return self._start_time, self._end_time
-        if self.interval_type == GraphIntervalType.HOUR:
-            # 4000s, 1h 6m 40s
-            return end_time_maybe - 4000, end_time_maybe
-        elif self.interval_type == GraphIntervalType.DAY:
-            # 2000m, 33h 20m
-            return end_time_maybe - 2000 * 60, end_time_maybe
-        elif self.interval_type == GraphIntervalType.WEEK:
-            # 12000m, 8d 13h 20m
-            return end_time_maybe - 12000 * 60, end_time_maybe
-        elif self.interval_type == GraphIntervalType.MONTH:
-            # 48000m, 33d 8h
-            return end_time_maybe - 48000 * 60, end_time_maybe
-        elif self.interval_type == GraphIntervalType.YEAR:
-            # 400d
-            return end_time_maybe - 400 * 24 * 3600, end_time_maybe
+        if self.interval_type == GraphIntervalType.CALENDAR:
+            return self._calendar_range(end_time_maybe)
+        return end_time_maybe - self._length, end_time_maybe
+
+    def ranges(self, end_times: collections.abc.Iterable[int]) -> tuple:
+        """
+        Return the start and end times of multiple end times at once, e.g. to generate the daily graphs
+        of the last 90 days. The result is a pair of numpy arrays if numpy is installed,
+        otherwise a pair of array.array('q') objects.
+        """
+        if self.interval_type in (GraphIntervalType.CUSTOM, GraphIntervalType.CALENDAR):
+            pairs = [self.range(int(end_time)) for end_time in end_times]
+            return self._as_array(p[0] for p in pairs), self._as_array(p[1] for p in pairs)
+
+        if numpy is not None:
+            ends = numpy.array(end_times if hasattr(end_times, '__len__') else list(end_times), dtype=numpy.int64)
+            return ends - self._length, ends
+
+        ends = array.array('q', end_times)
+        return array.array('q', (end_time - self._length for end_time in ends)), ends
+
+    @staticmethod
+    def _as_array(values: collections.abc.Iterable[int]):
+        if numpy is not None:
+            return numpy.fromiter(values, dtype=numpy.int64)
+        return array.array('q', values)
+
+    def _calendar_range(self, end_time: int) -> tuple[int, int]:
+        # The naive datetime objects are in local time, as by time.mktime()
+        period_end = self._period_start(datetime.datetime.fromtimestamp(end_time, tz=self._tz))
+        period_start = self._period_start(period_end - datetime.timedelta(seconds=1))
+        return int(period_start.timestamp()), int(period_end.timestamp())
+
+    def _period_start(self, dt: datetime.datetime) -> datetime.datetime:
+        dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        if self._period == CalendarPeriod.WEEK:
+            return dt - datetime.timedelta(days=dt.weekday())
+        elif self._period == CalendarPeriod.MONTH:
+            return dt.replace(day=1)
+        elif self._period == CalendarPeriod.YEAR:
+            return dt.replace(month=1, day=1)
+
+        return dt
 
     @classmethod
     def default_intervals(cls):
@@ -1,74 +1,420 @@
-# Copyright 2017-2021 Laszlo Attila Toth
+# Copyright 2017-2022 Laszlo Attila Toth
 # Distributed under the terms of the Apache License, Version 2.0
 
+import collections.abc
+import contextlib
+import gc
+import hashlib
+import io
+import locale
+import marshal
+import os
 import os.path
-import re
+import stat
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
-from dewi_core.logger import log_info
-from dewi_utils.rrdtool.config import GraphConfig
+from dewi_core.logger import log_info, log_warning
+from dewi_utils.rrdtool.config import GraphConfig, Options, Plugin
+from dewi_utils.rrdtool.filters import GraphFilter
+
+# The entries of a plugin: graph_* options and options of the fields, in the order of their first occurrence
+PluginEntries = tuple[dict[str, str], dict[str, dict[str, str]]]
+DatafileEntries = dict[tuple[str, str, str], PluginEntries]
+
+
+def parse_datafile_lines(lines: collections.abc.Iterable[str],
+                         graph_filter: GraphFilter | None = None) -> DatafileEntries:
+    """
+    Parses the 'domain;host:plugin.key value' lines of a Munin datafile, other lines are skipped.
+    A line is split the same way as by the regex '^(.+?);(.+?):(.+?)\\.(.+?) (.+)$', but using str.find().
+
+    The lines of a plugin are usually consecutive, so the entries of the previous plugin are reused
+    if the line starts with the same 'domain;host:plugin.' prefix.
+
+    The option names and values are interned, as most of them (label, draw, LINE1, etc.) are repeated
+    many times. It reduces both the memory usage and the size of the pickled result of a chunk.
+
+    The lines of the plugins not selected by graph_filter (domain, host and plugin name) are skipped.
+    """
+    intern = sys.intern
+    result: DatafileEntries = dict()
+    prefix = None
+    plugin_key = None
+    entries: PluginEntries | None = None
+    skipped = False
+    selected_plugins: dict[tuple[str, str, str], bool] = dict()
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+
+        if prefix is not None and line.startswith(prefix):
+            dot = len(prefix) - 1
+        else:
+            semicolon = line.find(';', 1)
+            if semicolon < 0:
+                continue
+            colon = line.find(':', semicolon + 2)
+            if colon < 0:
+                continue
+            dot = line.find('.', colon + 2)
+            if dot < 0:
+                continue
+
+            prefix = line[:dot + 1]
+            plugin_key = (intern(line[:semicolon]), intern(line[semicolon + 1:colon]), line[colon + 1:dot])
+            entries = None
+
+            if graph_filter is not None:
+                if plugin_key not in selected_plugins:
+                    selected_plugins[plugin_key] = graph_filter.is_plugin_selected(*plugin_key)
+                skipped = not selected_plugins[plugin_key]
+
+        if skipped:
+            continue
+
+        space = line.find(' ', dot + 2)
+        if space < 0 or space == len(line) - 1:
+            continue
+
+        if entries is None:
+            if plugin_key not in result:
+                result[plugin_key] = (dict(), dict())
+            entries = result[plugin_key]
+
+        key = line[dot + 1:space]
+        value = intern(line[space + 1:])
+        if key.startswith('graph_'):
+            entries[0][intern(key)] = value
+        else:
+            field, key = key.split('.', 1)
+            field_entries = entries[1]
+            if field not in field_entries:
+                field_entries[field] = dict()
+            field_entries[field][intern(key)] = value
+
+    return result
+
+
+def _parse_datafile_chunk(path: str, start: int, end: int, graph_filter: GraphFilter | None) -> DatafileEntries:
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    # The same decoding and newline translation as open(path) in text mode
+    return parse_datafile_lines(io.StringIO(data.decode(locale.getpreferredencoding(False)), newline=None),
+                                graph_filter)
+
+
+# The snapshot of a plugin: category, title, period, options, field order and
+# the options and filename of the fields, where options are (keys, values)
+PluginSnapshot = tuple[str, str, str, tuple, list[str], dict[str, tuple[tuple, str]]]
+ConfigSnapshot = dict[str, dict[str, dict[str, PluginSnapshot]]]
+
+
+def _create_config_snapshot(config: GraphConfig) -> ConfigSnapshot:
+    return {
+        domain_name: {
+            host_name: {
+                plugin_name: (plugin.category, plugin.title, plugin.period, plugin.options.__getstate__(),
+                              plugin.field_order,
+                              {field_name: (field.options.__getstate__(), field.filename)
+                               for field_name, field in plugin.fields.items()})
+                for plugin_name, plugin in host.plugins.items()
+            }
+            for host_name, host in domain.hosts.items()
+        }
+        for domain_name, domain in config.domains.items()
+    }
+
+
+def _check_snapshot(condition: bool):
+    if not condition:
+        raise ValueError('Invalid datafile snapshot')
+
+
+def _is_str_sequence(value) -> bool:
+    # Faster than checking the type of each item
+    try:
+        ''.join(value)
+        return True
+    except TypeError:
+        return False
+
+
+def _is_optional_str(value) -> bool:
+    return value is None or type(value) is str
+
+
+def _items_of(value) -> collections.abc.Iterable:
+    _check_snapshot(type(value) is dict and _is_str_sequence(value))
+    return value.items()
+
+
+def _create_options(state, checked_keys: set[tuple[str, ...]]) -> Options:
+    _check_snapshot(type(state) is tuple and len(state) == 2)
+    keys, values = state
+    # There are only a few different key tuples
+    if keys not in checked_keys:
+        _check_snapshot(type(keys) is tuple and _is_str_sequence(keys))
+        checked_keys.add(keys)
+    _check_snapshot(type(values) is tuple and len(values) == len(keys) and _is_str_sequence(values))
+
+    options = Options()
+    options.__setstate__(state)
+    return options
+
+
+def _load_config_snapshot(snapshot) -> GraphConfig:
+    """
+    Rebuilds the config from the snapshot, checking its structure, so it raises ValueError
+    instead of creating an invalid config if the snapshot is corrupted or crafted.
+    """
+    config = GraphConfig()
+    checked_keys = set()
+    for domain_name, hosts in _items_of(snapshot):
+        domain = config.domains[domain_name]
+        for host_name, plugins in _items_of(hosts):
+            host = domain.hosts[host_name]
+            for plugin_name, plugin_snapshot in _items_of(plugins):
+                _check_snapshot(type(plugin_snapshot) is tuple and len(plugin_snapshot) == 6)
+                category, title, period, options, field_order, fields = plugin_snapshot
+                _check_snapshot(_is_optional_str(category) and _is_optional_str(title) and _is_optional_str(period)
+                                and type(field_order) is list and _is_str_sequence(field_order))
+
+                plugin = host.plugins[plugin_name]
+                plugin.category, plugin.title, plugin.period = category, title, period
+                plugin.options = _create_options(options, checked_keys)
+                plugin.field_order = field_order
+                for field_name, field_snapshot in _items_of(fields):
+                    _check_snapshot(type(field_snapshot) is tuple and len(field_snapshot) == 2
+                                    and _is_optional_str(field_snapshot[1]))
+                    field = plugin.fields[field_name]
+                    field.options = _create_options(field_snapshot[0], checked_keys)
+                    field.filename = field_snapshot[1]
+
+    return config
+
+
+@contextlib.contextmanager
+def _gc_disabled():
+    # The cyclic GC would run many times while millions of nodes and dicts are created,
+    # but none of them can be garbage
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
 
 class GraphLoader:
-    def __init__(self, data_file_path: str):
+    """
+    Loads a Munin datafile into a GraphConfig.
+
+    If parallel_count is greater than 1, a large datafile is split into chunks at line boundaries,
+    and the chunks are parsed in parallel in worker processes. The result is the same as the result of
+    the sequential load as the parsed entries of the chunks are applied in the order of the chunks.
+
+    If snapshot_directory is set, the loaded config is also saved into a binary snapshot in that directory,
+    and the next load reads the snapshot instead of the datafile if the size and the modification time
+    of the datafile are not changed. The directory should be owned by the caller, not the Munin directory,
+    which is usually writable by other users (e.g. munin). A snapshot which is not owned by the current user
+    or which is writable by others is not loaded. The snapshot contains only plain values (marshal format),
+    and their structure is checked while the config is rebuilt from them.
+
+    If graph_filter is set, only the selected plugins are loaded, see GraphFilter.
+    """
+    MIN_CHUNK_SIZE = 8 * 1024 * 1024
+    SNAPSHOT_SUFFIX = '.snapshot'
+    # Increment it if GraphConfig or the loaded values are changed
+    SNAPSHOT_VERSION = 3
+
+    def __init__(self, data_file_path: str, parallel_count: int = 1, snapshot_directory: str | None = None,
+                 graph_filter: GraphFilter | None = None):
         self._data_file_path = data_file_path
+        self._parallel_count = parallel_count
+        self._snapshot_directory = snapshot_directory
+        self._graph_filter = graph_filter
+        self._snapshot_path = None
+        if snapshot_directory is not None:
+            # The snapshots of multiple datafiles may be in the same directory
+            path_hash = hashlib.sha256(os.path.abspath(data_file_path).encode()).hexdigest()[:16]
+            self._snapshot_path = os.path.join(
+                snapshot_directory, f'{os.path.basename(data_file_path)}-{path_hash}{self.SNAPSHOT_SUFFIX}')
 
         self.config = GraphConfig()
 
     def load(self):
+        snapshot_id = self._get_snapshot_id() if self._snapshot_path is not None else None
+        if snapshot_id is not None and self._load_snapshot(snapshot_id):
+            return
+
         log_info('Loading Munin datafile', path=self._data_file_path)
-        self._load_file()
-        self._postprocess()
+        with _gc_disabled():
+            self._load_file()
+            self._postprocess()
+
+        if snapshot_id is not None:
+            self._save_snapshot(snapshot_id)
+
+    def _get_snapshot_id(self) -> tuple:
+        st = os.stat(self._data_file_path)
+        filter_id = self._graph_filter.id if self._graph_filter is not None else None
+        return self.SNAPSHOT_VERSION, st.st_size, st.st_mtime_ns, filter_id
+
+    def _load_snapshot(self, snapshot_id: tuple) -> bool:
+        try:
+            with open(self._snapshot_path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                    log_warning('Datafile snapshot is not owned by the current user or writable by others',
+                                path=self._snapshot_path)
+                    return False
+
+                # The id is stored separately, so an outdated snapshot is not loaded
+                if marshal.load(f) != snapshot_id:
+                    return False
+
+                with _gc_disabled():
+                    self.config = _load_config_snapshot(marshal.loads(f.read()))
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            log_warning('Unable to load datafile snapshot', path=self._snapshot_path, error=str(e))
+            return False
+
+        log_info('Loaded datafile snapshot', path=self._snapshot_path)
+        return True
+
+    def _save_snapshot(self, snapshot_id: tuple):
+        try:
+            os.makedirs(self._snapshot_directory, mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self._snapshot_directory, suffix='.tmp')
+        except OSError as e:
+            log_warning('Unable to save datafile snapshot', path=self._snapshot_path, error=str(e))
+            return
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(snapshot_id, f)
+                marshal.dump(_create_config_snapshot(self.config), f)
+            os.replace(tmp_path, self._snapshot_path)
+        except (OSError, ValueError) as e:
+            os.unlink(tmp_path)
+            log_warning('Unable to save datafile snapshot', path=self._snapshot_path, error=str(e))
 
     def _load_file(self):
-        with open(self._data_file_path) as f:
-            for line in f:
-                line = line.rstrip('\r\n').rstrip('\n')
-                m = re.match(r'^(.+?);(.+?):(.+?)\.(.+?) (.+)$', line)
-                if m:
-                    self._read_entry(m.group(1), m.group(2), m.group(3), m.group(4), m.group(5))
-
-    def _read_entry(self, domain: str, host: str, name: str, key: str, value: str):
+        chunks = self._split_to_chunks()
+
+        if len(chunks) <= 1:
+            with open(self._data_file_path) as f:
+                self._apply_entries(parse_datafile_lines(f, self._graph_filter), check_category=True)
+            return
+
+        log_info('Parsing Munin datafile in parallel', chunks=len(chunks))
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            for entries in executor.map(_parse_datafile_chunk, [self._data_file_path] * len(chunks),
+                                        *zip(*chunks), [self._graph_filter] * len(chunks)):
+                self._apply_entries(entries, check_category=False)
+
+        # The category of a plugin may be in a later chunk, so it can be checked only at the end
+        self._remove_unselected_categories()
+
+    def _split_to_chunks(self) -> list[tuple[int, int]]:
+        size = os.path.getsize(self._data_file_path)
+        count = min(self._parallel_count, size // self.MIN_CHUNK_SIZE)
+        if count <= 1:
+            return [(0, size)]
+
+        chunks = []
+        start = 0
+        with open(self._data_file_path, 'rb') as f:
+            for i in range(1, count):
+                f.seek(max(start, size * i // count))
+                f.readline()
+                end = f.tell()
+                if end > start:
+                    chunks.append((start, end))
+                    start = end
+
+        if start < size:
+            chunks.append((start, size))
+
+        return chunks
+
+    def _apply_entries(self, entries: DatafileEntries, check_category: bool):
+        check_category = check_category and self._graph_filter is not None and self._graph_filter.has_category_filter
+
+        for (domain, host, name), (graph_entries, field_entries) in entries.items():
+            if check_category and not self._graph_filter.is_category_selected(graph_entries.get('graph_category')):
+                continue
+
+            plugin = self.config.domains[domain].hosts[host].plugins[name]
+
+            for key, value in graph_entries.items():
+                self._read_graph_entry(plugin, key, value)
+
+            for field, options in field_entries.items():
+                plugin.fields[field].options.update(options)
+
+    def _remove_unselected_categories(self):
+        if self._graph_filter is None or not self._graph_filter.has_category_filter:
+            return
+
+        for domain_name, domain in list(self.config.domains.items()):
+            for host_name, host in list(domain.hosts.items()):
+                for plugin_name, plugin in list(host.plugins.items()):
+                    if not self._graph_filter.is_category_selected(plugin.category):
+                        del host.plugins[plugin_name]
+
+                if not host.plugins:
+                    del domain.hosts[host_name]
+
+            if not domain.hosts:
+                del self.config.domains[domain_name]
+
+    def _read_graph_entry(self, plugin: Plugin, key: str, value: str):
         if key == 'graph_order':
             # Let's make it unique
-            self.config.domains[domain].hosts[host].plugins[name].field_order = self._uniq(value.split())
+            plugin.field_order = self._uniq(value.split())
         elif key == 'graph_title':
-            self.config.domains[domain].hosts[host].plugins[name].title = value
+            plugin.title = value
         elif key == 'graph_period':
-            self.config.domains[domain].hosts[host].plugins[name].period = value
+            plugin.period = value
         elif key == 'graph_category':
-            self.config.domains[domain].hosts[host].plugins[name].category = value
-        elif key.startswith('graph_'):
+            plugin.category = value
+        else:
             if key == 'graph_args':
                 value = value.rstrip(';')
-            self.config.domains[domain].hosts[host].plugins[name].options[key] = value
-        else:
-            field, key = key.split('.', 1)
-            self.config.domains[domain].hosts[host].plugins[name].fields[field].options[key] = value
+            plugin.options[key] = value
 
     def _uniq(self, l: list) -> list:
         used = set()
         return [x for x in l if x not in used and (used.add(x) or True)]
 
     def _postprocess(self):
-        for domain, host, plugin in self.config.plugins:
-            self.config.domains[domain].hosts[host].plugins[plugin].name = plugin
-            if self.config.domains[domain].hosts[host].plugins[plugin].period is None:
-                self.config.domains[domain].hosts[host].plugins[plugin].period = 'seconds'
-
-        for domain in self.config.domains:
-            self.config.domains[domain].name = domain
-            for host in self.config.domains[domain]:
-                self.config.domains[domain].hosts[host].name = host
-
-        for domain, host, plugin, field_ in self.config.fields:
-            field = self.config.domains[domain].hosts[host].plugins[plugin].fields[field_]
-            field.name = field_
-
-            if 'type' not in field.options:
-                field.options['type'] = 'GAUGE'
-            type_suffix = field.options['type'].lower()[0]
-            field.filename = os.path.join(domain, f'{host}-{plugin.replace(".", "-")}-{field.name}-{type_suffix}.rrd')
-            if 'draw' not in field.options:
-                field.options['draw'] = 'LINE1'
-
-        return
+        for domain_name, domain in self.config.domains.items():
+            domain.name = domain_name
+
+            for host_name, host in domain.hosts.items():
+                host.name = host_name
+
+                for plugin_name, plugin in host.plugins.items():
+                    plugin.name = plugin_name
+                    if plugin.period is None:
+                        plugin.period = 'seconds'
+
+                    filename_prefix = os.path.join(domain_name, f'{host_name}-{plugin_name.replace(".", "-")}-')
+
+                    for field_name, field in plugin.fields.items():
+                        field.name = field_name
+
+                        if 'type' not in field.options:
+                            field.options['type'] = 'GAUGE'
+                        type_suffix = field.options['type'].lower()[0]
+                        field.filename = f'{filename_prefix}{field_name}-{type_suffix}.rrd'
+                        if 'draw' not in field.options:
+                            field.options['draw'] = 'LINE1'
@@ -1,22 +1,50 @@
 # Copyright 2017-2022 Laszlo Attila Toth
 # Distributed under the terms of the Apache License, Version 2.0
 
+import enum
 import re
 
 from dewi_utils.rrdtool.config import GraphConfig, Host, Plugin
 
 
+class ModifierLevel(enum.Enum):
+    # _modify_plugin() is called for each plugin
+    PLUGIN = 1
+    # _modify_host() is called for each host, e.g. to add or remove plugins
+    HOST = 2
+
+
 class ConfigModifier:
+    """
+    Post-modifies the loaded config.
+
+    A modifier changes either a plugin or a host at once, see `level`. It mustn't depend on the other hosts,
+    so multiple modifiers can be applied in a single traversal of the config, see ConfigModifierPipeline.
+    The modifiers overriding modify() are applied on their own.
+    """
+
+    level = ModifierLevel.PLUGIN
+
     def modify(self, config: GraphConfig):
-        self._modify_plugins(config)
+        if self.level == ModifierLevel.HOST:
+            self._modify_hosts(config)
+        else:
+            self._modify_plugins(config)
+
+    @property
+    def is_fusable(self) -> bool:
+        return type(self).modify is ConfigModifier.modify
 
     def _modify_plugins(self, config: GraphConfig):
-        for d, h, plugin_name in config.plugins:
-            self._modify_plugin(config.domains[d].hosts[h].plugins[plugin_name])
+        for domain in config.domains.values():
+            for host in domain.hosts.values():
+                for plugin in list(host.plugins.values()):
+                    self._modify_plugin(plugin)
 
     def _modify_hosts(self, config: GraphConfig):
-        for d, h in config.hosts:
-            self._modify_host(config.domains[d].hosts[h])
+        for domain in config.domains.values():
+            for host in domain.hosts.values():
+                self._modify_host(host)
 
     def _modify_plugin(self, plugin: Plugin):
         pass
@@ -25,6 +53,43 @@ class ConfigModifier:
         pass
 
 
+class ConfigModifierPipeline(ConfigModifier):
+    """
+    Applies the modifiers in the given order, but the config is traversed only once:
+    all modifiers are applied on a host (or on its plugins) before the next host.
+    The result is the same as calling modify() of each modifier one after the other.
+    """
+
+    def __init__(self, modifiers: list[ConfigModifier]):
+        self._modifiers = list(modifiers)
+
+    def modify(self, config: GraphConfig):
+        fused = []
+        for modifier in self._modifiers:
+            if modifier.is_fusable:
+                fused.append(modifier)
+            else:
+                self._apply(config, fused)
+                fused = []
+                modifier.modify(config)
+
+        self._apply(config, fused)
+
+    @staticmethod
+    def _apply(config: GraphConfig, modifiers: list[ConfigModifier]):
+        if not modifiers:
+            return
+
+        for domain in config.domains.values():
+            for host in domain.hosts.values():
+                for modifier in modifiers:
+                    if modifier.level == ModifierLevel.HOST:
+                        modifier._modify_host(host)
+                    else:
+                        for plugin in list(host.plugins.values()):
+                            modifier._modify_plugin(plugin)
+
+
 class IgnoreLoopbackDisks(ConfigModifier):
     def _modify_plugin(self, plugin: Plugin):
         if plugin.category != 'disk':
@@ -59,8 +124,7 @@ class SeparateDiskstatsPluginsPerDevice(ConfigModifier):
     ENDINGS = ['iops', 'throughput']
     PLUGIN_NAMES = [f'diskstats_{x}' for x in ENDINGS]
 
-    def modify(self, config: GraphConfig):
-        self._modify_hosts(config)
+    level = ModifierLevel.HOST
 
     def _modify_host(self, host: Host):
         plugin_names = list(host.plugins.keys())
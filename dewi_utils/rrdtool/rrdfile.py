@@ -0,0 +1,264 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import array
+import math
+import mmap
+import struct
+import typing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class RrdFileError(Exception):
+    pass
+
+
+# The structures of rrd_format.h in the native byte order and alignment, as rrdtool writes them.
+# The unival type is a union of unsigned long and double, the par[10] members are read as raw bytes.
+_UNIVAL_SIZE = 8
+_STAT_HEAD = struct.Struct('@4s5s0dd3L80s')
+_DS_DEF = struct.Struct('@20s20s0d80s')
+_RRA_DEF = struct.Struct('@20s0dLL80s')
+_LIVE_HEAD_V1 = struct.Struct('@l')
+_LIVE_HEAD = struct.Struct('@ll')
+_PDP_PREP_SIZE = struct.calcsize('@30s0d80s')
+_CDP_PREP_SIZE = 10 * _UNIVAL_SIZE
+_RRA_PTR = struct.Struct('@L')
+_VALUE_SIZE = struct.calcsize('@d')
+
+_COOKIE = b'RRD\0'
+_FLOAT_COOKIE = 8.642135E130
+_VERSIONS = (b'0001', b'0002', b'0003', b'0004')
+
+
+def _to_str(value: bytes) -> str:
+    return value.split(b'\0', 1)[0].decode('ascii')
+
+
+def _par_value(par: bytes, idx: int) -> float:
+    return struct.unpack_from('@d', par, idx * _UNIVAL_SIZE)[0]
+
+
+def _par_count(par: bytes, idx: int) -> int:
+    return struct.unpack_from('@L', par, idx * _UNIVAL_SIZE)[0]
+
+
+class DataSource:
+    def __init__(self, name: str, type_: str, heartbeat: int, min_value: float, max_value: float):
+        self.name = name
+        self.type = type_
+        self.heartbeat = heartbeat
+        self.min = min_value
+        self.max = max_value
+
+
+class Archive:
+    """
+    An RRA of the file. The step is the resolution of the archive in seconds.
+    """
+
+    def __init__(self, cf: str, row_count: int, pdp_count: int, xff: float, step: int):
+        self.cf = cf
+        self.row_count = row_count
+        self.pdp_count = pdp_count
+        self.xff = xff
+        self.step = step
+
+
+class ArchiveData:
+    """
+    The rows of an archive from the oldest to the newest one. The timestamp of a row is the end of its period,
+    the unknown values are NaN.
+
+    The columns contain the values of the data sources, as numpy arrays if numpy is installed,
+    otherwise as array.array('d') objects.
+    """
+
+    def __init__(self, start_time: int, step: int, columns: dict):
+        self.start_time = start_time
+        self.step = step
+        self.columns = columns
+
+    @property
+    def row_count(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    @property
+    def end_time(self) -> int:
+        return self.start_time + (self.row_count - 1) * self.step
+
+    @property
+    def timestamps(self):
+        if numpy is not None:
+            return numpy.arange(self.start_time, self.end_time + 1, self.step, dtype=numpy.int64)
+        return array.array('q', range(self.start_time, self.end_time + 1, self.step))
+
+
+class RrdFile:
+    """
+    Reads an .rrd file without rrdtool, e.g. for data export or for the last update time of the graphs.
+
+    The file is memory-mapped, only the header and the requested archives are read. Only files of
+    the native architecture are supported (as by rrdtool itself), RrdFileError is raised for other files.
+
+    Usage:
+        with RrdFile(filename) as rrd:
+            data = rrd.read_archive(rrd.find_archive('AVERAGE', 300))
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise RrdFileError(f'Empty RRD file: {filename}') from None
+
+        try:
+            self._read_header()
+        except (RrdFileError, struct.error, UnicodeDecodeError) as e:
+            self.close()
+            if isinstance(e, RrdFileError):
+                raise
+            raise RrdFileError(f'Invalid RRD file: {filename}') from e
+
+    def _read_header(self):
+        cookie, version, float_cookie, ds_count, rra_count, self.pdp_step, _ = _STAT_HEAD.unpack_from(self._mmap, 0)
+        version = version[:4]
+        if cookie != _COOKIE or version not in _VERSIONS:
+            raise RrdFileError(f'Not an RRD file: {self.filename}')
+        if float_cookie != _FLOAT_COOKIE:
+            raise RrdFileError(f'RRD file of an unsupported architecture: {self.filename}')
+
+        self.version = int(version)
+        offset = _STAT_HEAD.size
+
+        self.data_sources: list[DataSource] = []
+        for _ in range(ds_count):
+            name, type_, par = _DS_DEF.unpack_from(self._mmap, offset)
+            offset += _DS_DEF.size
+            self.data_sources.append(
+                DataSource(_to_str(name), _to_str(type_), _par_count(par, 0), _par_value(par, 1), _par_value(par, 2)))
+
+        self.archives: list[Archive] = []
+        for _ in range(rra_count):
+            cf, row_count, pdp_count, par = _RRA_DEF.unpack_from(self._mmap, offset)
+            offset += _RRA_DEF.size
+            self.archives.append(
+                Archive(_to_str(cf), row_count, pdp_count, _par_value(par, 0), pdp_count * self.pdp_step))
+
+        if self.version < 3:
+            self.last_update, = _LIVE_HEAD_V1.unpack_from(self._mmap, offset)
+            self.last_update_usec = 0
+            offset += _LIVE_HEAD_V1.size
+        else:
+            self.last_update, self.last_update_usec = _LIVE_HEAD.unpack_from(self._mmap, offset)
+            offset += _LIVE_HEAD.size
+
+        offset += ds_count * _PDP_PREP_SIZE + ds_count * rra_count * _CDP_PREP_SIZE
+
+        self._current_rows = [_RRA_PTR.unpack_from(self._mmap, offset + i * _RRA_PTR.size)[0]
+                              for i in range(rra_count)]
+        offset += rra_count * _RRA_PTR.size
+
+        self._data_offsets = []
+        for archive in self.archives:
+            self._data_offsets.append(offset)
+            offset += archive.row_count * ds_count * _VALUE_SIZE
+
+        if offset > len(self._mmap):
+            raise RrdFileError(f'Truncated RRD file: {self.filename}')
+
+    def find_archive(self, cf: str = 'AVERAGE', step: int = 0) -> int:
+        """
+        Returns the index of the archive of the consolidation function having
+        the finest resolution not finer than step.
+        """
+        candidates = [(archive.step, idx) for idx, archive in enumerate(self.archives) if archive.cf == cf]
+        if not candidates:
+            raise RrdFileError(f'No {cf} archive in RRD file: {self.filename}')
+
+        coarser = [c for c in candidates if c[0] >= step]
+        return min(coarser)[1] if coarser else max(candidates)[1]
+
+    def read_archive(self, index: int) -> ArchiveData:
+        archive = self.archives[index]
+        ds_count = len(self.data_sources)
+        row_size = ds_count * _VALUE_SIZE
+        offset = self._data_offsets[index]
+
+        # The archive is a ring buffer, the newest row is the current one
+        first_row = (self._current_rows[index] + 1) % archive.row_count
+        raw = (self._mmap[offset + first_row * row_size:offset + archive.row_count * row_size]
+               + self._mmap[offset:offset + first_row * row_size])
+
+        if numpy is not None:
+            values = numpy.frombuffer(raw, dtype=numpy.float64).reshape(archive.row_count, ds_count)
+            columns = {ds.name: values[:, i].copy() for i, ds in enumerate(self.data_sources)}
+        else:
+            values = array.array('d', raw)
+            columns = {ds.name: values[i::ds_count] for i, ds in enumerate(self.data_sources)}
+
+        end_time = self.last_update - self.last_update % archive.step
+        return ArchiveData(end_time - (archive.row_count - 1) * archive.step, archive.step, columns)
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self) -> 'RrdFile':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_last_update(filename: str) -> int:
+    with RrdFile(filename) as rrd:
+        return rrd.last_update
+
+
+def create_rrd_file_content(last_update: int, data_sources: typing.Sequence[str],
+                            archives: typing.Sequence[tuple[str, int, typing.Sequence[typing.Sequence[float]]]], *,
+                            pdp_step: int = 300, last_update_usec: int = 0,
+                            current_rows: typing.Sequence[int] | None = None) -> bytes:
+    """
+    Creates the content of a minimal rrdtool 1.4+ (version 0003) file of the native architecture,
+    e.g. for tests and benchmarks. The data sources are GAUGEs with a heartbeat of two steps and without limits.
+
+    The archives are given as (cf, pdp_count, rows) tuples, the rows from the oldest one, each row contains
+    a value for each data source. The rows are stored as a ring buffer, the newest one at the index
+    given by current_rows (the last index by default).
+    """
+    if current_rows is None:
+        current_rows = [len(rows) - 1 for _, _, rows in archives]
+
+    parts = [_STAT_HEAD.pack(_COOKIE, b'0003\0', _FLOAT_COOKIE, len(data_sources), len(archives), pdp_step, bytes(80))]
+    ds_par = struct.pack('@Ldd', 2 * pdp_step, math.nan, math.nan).ljust(80, b'\0')
+    parts.extend(_DS_DEF.pack(name.encode('ascii'), b'GAUGE', ds_par) for name in data_sources)
+    rra_par = struct.pack('@d', 0.5).ljust(80, b'\0')
+    parts.extend(_RRA_DEF.pack(cf.encode('ascii'), len(rows), pdp_count, rra_par) for cf, pdp_count, rows in archives)
+    parts.append(_LIVE_HEAD.pack(last_update, last_update_usec))
+    parts.append(bytes(len(data_sources) * _PDP_PREP_SIZE + len(data_sources) * len(archives) * _CDP_PREP_SIZE))
+    parts.extend(_RRA_PTR.pack(current_row) for current_row in current_rows)
+
+    row_format = struct.Struct(f'@{len(data_sources)}d')
+    for (_, _, rows), current_row in zip(archives, current_rows):
+        # The oldest row follows the current one
+        rows = list(rows)
+        split = len(rows) - (current_row + 1) % len(rows)
+        parts.extend(row_format.pack(*row) for row in rows[split:] + rows[:split])
+
+    return b''.join(parts)
+
+
+def write_rrd_file(filename: str, last_update: int, data_sources: typing.Sequence[str],
+                   archives: typing.Sequence[tuple[str, int, typing.Sequence[typing.Sequence[float]]]], **kwargs):
+    """
+    Writes a minimal native RRD file, see create_rrd_file_content() for the parameters.
+    """
+    with open(filename, 'wb') as f:
+        f.write(create_rrd_file_content(last_update, data_sources, archives, **kwargs))
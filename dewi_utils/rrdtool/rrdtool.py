@@ -7,11 +7,17 @@ import os.path
 import subprocess
 
 import dewi_core.utils.yaml as _yaml
+from dewi_core.logger import log_debug, log_info
+from dewi_utils.rrdtool.backend import GraphBackendType
+from dewi_utils.rrdtool.cache import GraphCache
 from dewi_utils.rrdtool.config import GraphConfig
+from dewi_utils.rrdtool.distributed import DistributedGraphWriter, GraphBroker
+from dewi_utils.rrdtool.filters import GraphFilter
 from dewi_utils.rrdtool.interval import GraphInterval
 from dewi_utils.rrdtool.loader import GraphLoader
-from dewi_utils.rrdtool.modifiers import ConfigModifier
-from dewi_utils.rrdtool.writer import GraphResult, GraphWriter
+from dewi_utils.rrdtool.modifiers import ConfigModifier, ConfigModifierPipeline
+from dewi_utils.rrdtool.rrdfile import RrdFileError, read_last_update
+from dewi_utils.rrdtool.writer import GraphResult, GraphSink, GraphWriter
 
 
 class RrdTool:
@@ -25,6 +31,34 @@ class RrdTool:
     The width and height of the graphs can also be specified.
 
     The loaded config may be post-modified for more usable and readable graphs by the `modifiers` parameter.
+
+    The `backend` parameter selects how rrdtool is invoked: a new 'rrdtool graph' process per graph (default),
+    a long-running 'rrdtool -' process per thread, or the rrdtool Python bindings, see GraphBackendType.
+
+    If `cache_directory` is set, the generated graphs are stored there and they are regenerated only
+    if the graph parameters or the rrd files are changed, see GraphCache. The graphs not generated
+    by the run are removed from the cache, unless `graph_filter` is also set.
+
+    If `config_snapshot_directory` is set, the loaded datafile is saved into a binary snapshot in that directory
+    (which should be owned by the caller), and it's used until the datafile is changed, see GraphLoader.
+
+    The graphs can be limited to some domains, hosts, plugins or categories by `graph_filter`,
+    the other plugins are skipped while loading the datafile, see GraphFilter.
+
+    If `sink` is set, each image is passed to it as soon as it's rendered (e.g. DirectorySink writes it to a file),
+    and only the metadata of the graphs are kept in graph_result.
+
+    If `batch_intervals` is True, the graphs of a plugin are generated together: the plugin-specific
+    arguments are created once, and all intervals are rendered by the same rrdtool process.
+
+    If `adaptive_parallel_run` is True, the count of the parallel runs is adjusted while the graphs are
+    generated to maximize the graphs per second, starting from the CPU count, and `parallel_run_count`
+    is the upper limit, see GraphWriter.
+
+    If `broker` is set, the graphs are generated by worker processes, possibly on multiple hosts,
+    and written into the output directory of the broker, see DistributedGraphWriter. Then the backend
+    and the number of the local workers are set in the broker, and `sink`, `cache_directory`,
+    `parallel_run_count` and `adaptive_parallel_run` are not supported.
     """
 
     def __init__(self,
@@ -37,6 +71,14 @@ class RrdTool:
                  width: int | None = None,
                  height: int | None = None,
                  parallel_run_count: int = 1,
+                 backend: GraphBackendType = GraphBackendType.SUBPROCESS,
+                 cache_directory: str | None = None,
+                 config_snapshot_directory: str | None = None,
+                 graph_filter: GraphFilter | None = None,
+                 sink: GraphSink | None = None,
+                 batch_intervals: bool = False,
+                 broker: GraphBroker | None = None,
+                 adaptive_parallel_run: bool = False,
                  ):
         self._munin_directory = munin_directory
         self._end_time: datetime.datetime = end_time
@@ -47,32 +89,75 @@ class RrdTool:
         self._height = height or 300
         self._graphs = GraphResult()
         self._parallel_count = parallel_run_count
+        self._backend = backend
+        self._cache_directory = cache_directory
+        self._config_snapshot_directory = config_snapshot_directory
+        self._graph_filter = graph_filter
+        self._sink = sink
+        self._batch_intervals = batch_intervals
+        self._broker = broker
+        self._adaptive_parallel_run = adaptive_parallel_run
+
+        if broker is not None:
+            unsupported = [name for name, is_set in [('sink', sink is not None),
+                                                     ('cache_directory', cache_directory is not None),
+                                                     ('parallel_run_count', parallel_run_count != 1),
+                                                     ('adaptive_parallel_run', adaptive_parallel_run),
+                                                     ('backend', backend != GraphBackendType.SUBPROCESS)] if is_set]
+            if unsupported:
+                raise ValueError(f'Unsupported parameters with a broker: {", ".join(unsupported)}; '
+                                 f'the backend and the local worker count can be set in GraphBroker')
 
     def run(self):
-        loader = GraphLoader(os.path.join(self._munin_directory, 'datafile'))
+        loader = GraphLoader(os.path.join(self._munin_directory, 'datafile'), self._parallel_count,
+                             self._config_snapshot_directory, self._graph_filter)
         loader.load()
         config = loader.config
 
         self._modify_config(config)
 
+        if next(config.plugins, None) is None:
+            log_info('No plugins to generate graphs for', munin_directory=self._munin_directory)
+            return
+
         if not self._end_time:
             self._calculate_end_time(config)
 
-        g = GraphWriter(self._munin_directory, config, self._graphs, self._end_time, self._width, self._height,
-                        self._parallel_count)
+        cache = GraphCache(self._cache_directory) if self._cache_directory else None
+
+        if self._broker is not None:
+            g = DistributedGraphWriter(self._munin_directory, config, self._graphs, self._end_time,
+                                       self._width, self._height, broker=self._broker,
+                                       batch_intervals=self._batch_intervals)
+        else:
+            g = GraphWriter(self._munin_directory, config, self._graphs, self._end_time, self._width, self._height,
+                            self._parallel_count, self._backend, cache, self._sink,
+                            self._batch_intervals, self._adaptive_parallel_run)
         g.generate(self._intervals)
 
+        if cache is not None:
+            # With a filter only a part of the graphs is generated, the others must be kept
+            if self._graph_filter is None:
+                cache.prune()
+            cache.log_statistics()
+
     def _modify_config(self, config: GraphConfig):
         if self._modifiers is not None:
-            for modifier in self._modifiers:
-                modifier.modify(config)
+            ConfigModifierPipeline(self._modifiers).modify(config)
 
     def _calculate_end_time(self, config: GraphConfig):
         filename = self._get_an_rrd_file_name(config)
+        tz = self._reference_datetime.tzinfo if self._reference_datetime else None
+
+        try:
+            self._end_time = datetime.datetime.fromtimestamp(read_last_update(filename), tz=tz)
+            return
+        except RrdFileError as e:
+            log_debug('Unable to read RRD file, using rrdtool info', filename=filename, error=str(e))
+
         result = subprocess.check_output(['rrdtool', 'info', filename]).decode('UTF-8').splitlines(keepends=False)
         for line in result:
             if line.startswith('last_update = '):
-                tz = self._reference_datetime.tzinfo if self._reference_datetime else None
                 self._end_time = datetime.datetime.fromtimestamp(int(line.replace('last_update = ', '')), tz=tz)
 
     def _get_an_rrd_file_name(self, config: GraphConfig) -> str:
@@ -94,8 +179,11 @@ class RrdTool:
             os.makedirs(directory, exist_ok=True)
 
         for graph in self._graphs.graphs:
-            filename = os.path.join(directory,
-                                    f'{graph.category}-{graph.short_name}-{graph.interval_type.lower()}.png')
+            # Already written by the sink
+            if graph.image is None:
+                continue
+
+            filename = os.path.join(directory, graph.default_filename)
 
             with open(filename, 'wb') as f:
                 f.write(graph.image)
@@ -0,0 +1,178 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import datetime
+import os
+import os.path
+import socketserver
+import threading
+import time
+import urllib.parse
+import wsgiref.simple_server
+
+from dewi_core.logger import log_error, log_info
+from dewi_utils.rrdtool.backend import GraphBackend, GraphBackendType
+from dewi_utils.rrdtool.cache import MemoryGraphCache
+from dewi_utils.rrdtool.config import GraphConfig, Plugin
+from dewi_utils.rrdtool.filters import GraphFilter
+from dewi_utils.rrdtool.interval import GraphInterval, GraphIntervalType
+from dewi_utils.rrdtool.loader import GraphLoader
+from dewi_utils.rrdtool.modifiers import ConfigModifier, ConfigModifierPipeline
+from dewi_utils.rrdtool.writer import GraphResult, GraphWriter
+
+
+class GraphServer:
+    """
+    WSGI application rendering the graphs on demand, instead of generating all of them by RrdTool.
+
+    The URL of a graph is /<domain>/<host>/<plugin>/<interval>.png, where interval is the
+    lowercase name of the interval type, e.g. /example.com/host1.example.com/load/day.png
+
+    The end time of a graph is the last modification time of its rrd files. The last `cache_size`
+    rendered graphs are kept in memory, and the concurrent requests of the same graph are coalesced,
+    see MemoryGraphCache. The datafile is reloaded if it's changed.
+
+    At most `backend_count` backends (e.g. 'rrdtool -' processes) are used per time zone,
+    they are shared by the requests, see PooledGraphBackend.
+
+    The other parameters are the same as RrdTool's parameters.
+    """
+
+    def __init__(self,
+                 munin_directory: str,
+                 *,
+                 reference_datetime: datetime.datetime | None = None,
+                 modifiers: list[ConfigModifier] | None = None,
+                 intervals: list[GraphInterval] | None = None,
+                 width: int | None = None,
+                 height: int | None = None,
+                 backend: GraphBackendType = GraphBackendType.AUTO,
+                 cache_size: int = 1000,
+                 config_snapshot_directory: str | None = None,
+                 graph_filter: GraphFilter | None = None,
+                 backend_count: int = 4,
+                 ):
+        self._munin_directory = munin_directory
+        self._datafile = os.path.join(munin_directory, 'datafile')
+        self._tz = reference_datetime.tzinfo if reference_datetime else None
+        self._modifiers = modifiers
+        self._intervals = {
+            interval.interval_name: interval
+            for interval in intervals or [GraphInterval(GraphIntervalType.HOUR)] + GraphInterval.default_intervals()
+        }
+        self._width = width or 800
+        self._height = height or 300
+        self._backend_type = backend
+        self._config_snapshot_directory = config_snapshot_directory
+        self._graph_filter = graph_filter
+        self._backend_count = backend_count
+
+        self.cache = MemoryGraphCache(cache_size)
+        self._config: GraphConfig | None = None
+        self._datafile_id: tuple[int, int] | None = None
+        self._lock = threading.Lock()
+        # Backends per TZ (it may change by DST), see GraphWriter.env_tz
+        self._backends: dict[str | None, GraphBackend] = dict()
+
+    def __call__(self, environ: dict, start_response):
+        path = urllib.parse.unquote(environ.get('PATH_INFO', ''))
+        parts = path.strip('/').split('/')
+
+        if environ.get('REQUEST_METHOD', 'GET') != 'GET':
+            return self._respond(start_response, '405 Method Not Allowed', b'Method not allowed\n')
+
+        if len(parts) != 4 or not parts[3].endswith('.png'):
+            return self._respond(start_response, '404 Not Found', b'Not found\n')
+
+        domain, host, plugin_name, interval_name = parts[0], parts[1], parts[2], parts[3][:-len('.png')]
+
+        try:
+            plugin = self._find_plugin(domain, host, plugin_name)
+            interval = self._intervals.get(interval_name)
+            if plugin is None or interval is None:
+                return self._respond(start_response, '404 Not Found', b'Not found\n')
+
+            image = self.render(plugin, interval)
+        except Exception as e:
+            log_error('Unable to render graph', path=path, error=str(e))
+            return self._respond(start_response, '500 Internal Server Error', b'Unable to render graph\n')
+
+        return self._respond(start_response, '200 OK', image, 'image/png')
+
+    @staticmethod
+    def _respond(start_response, status: str, body: bytes, content_type: str = 'text/plain'):
+        start_response(status, [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+        return [body]
+
+    def _find_plugin(self, domain: str, host: str, plugin: str) -> Plugin | None:
+        config = self._get_config()
+
+        # The DefaultDicts must not be indexed by unknown names
+        if domain not in config.domains or host not in config.domains[domain].hosts:
+            return None
+        return config.domains[domain].hosts[host].plugins.get(plugin)
+
+    def _get_config(self) -> GraphConfig:
+        st = os.stat(self._datafile)
+        datafile_id = (st.st_size, st.st_mtime_ns)
+
+        with self._lock:
+            if self._config is None or datafile_id != self._datafile_id:
+                loader = GraphLoader(self._datafile, snapshot_directory=self._config_snapshot_directory,
+                                     graph_filter=self._graph_filter)
+                loader.load()
+
+                if self._modifiers is not None:
+                    ConfigModifierPipeline(self._modifiers).modify(loader.config)
+
+                self._config = loader.config
+                self._datafile_id = datafile_id
+
+            return self._config
+
+    def render(self, plugin: Plugin, interval: GraphInterval) -> bytes:
+        end_time = datetime.datetime.fromtimestamp(self._get_last_update(plugin), tz=self._tz)
+        writer = GraphWriter(self._munin_directory, self._config, GraphResult(), end_time,
+                             self._width, self._height, backend=self._backend_type, cache=self.cache)
+
+        with self._lock:
+            backend = self._backends.get(writer.env_tz)
+            if backend is None:
+                backend = self._backends[writer.env_tz] = writer.create_backend(self._backend_count)
+
+        return writer.render(plugin, interval, backend).image
+
+    def _get_last_update(self, plugin: Plugin) -> int:
+        result = 0
+        for field in plugin.fields.values():
+            try:
+                result = max(result, int(os.stat(os.path.join(self._munin_directory, field.filename)).st_mtime))
+            except FileNotFoundError:
+                pass
+
+        return result or int(time.time())
+
+    def close(self):
+        with self._lock:
+            backends, self._backends = self._backends, dict()
+
+        for backend in backends.values():
+            backend.close()
+
+        self.cache.log_statistics()
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+
+
+def serve(server: GraphServer, host: str = 'localhost', port: int = 8080):
+    """
+    Serves the graphs using the built-in WSGI server of Python, one thread per request.
+    """
+    with wsgiref.simple_server.make_server(host, port, server, server_class=_ThreadingWSGIServer) as httpd:
+        log_info('Serving graphs', host=host, port=port)
+        try:
+            httpd.serve_forever()
+        finally:
+            server.close()
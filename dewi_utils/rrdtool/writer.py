@@ -1,16 +1,31 @@
 # Copyright 2017-2022 Laszlo Attila Toth
 # Distributed under the terms of the Apache License, Version 2.0
 
+import collections.abc
 import datetime
+import multiprocessing
 import os.path
 import shlex
-import subprocess
 
 from dewi_dataclass.node import Node, NodeList
 from dewi_core.logger import log_info
 from dewi_utils.rrdtool import config
+from dewi_utils.rrdtool.backend import GraphBackend, GraphBackendType, PooledGraphBackend, SubprocessGraphBackend, \
+    ThreadLocalGraphBackend
+from dewi_utils.rrdtool.cache import BaseGraphCache
 from dewi_utils.rrdtool.interval import GraphInterval, GraphIntervalType
-from ..threading import Job, JobParam, Pool
+from ..threading import HillClimbingConcurrencyController, Job, JobParam, Pool
+
+
+def _prepare_env(env_tz: str | None) -> dict[str, str]:
+    env = dict(os.environ)
+    env['LANG'] = 'en_US.UTF-8'
+    env['LC_LANG'] = 'en_US.UTF-8'
+
+    if env_tz:
+        env['TZ'] = env_tz
+
+    return env
 
 
 class GraphNode(Node):
@@ -23,6 +38,12 @@ class GraphNode(Node):
         self.start_time: int = 0
         self.end_time: int = 0
         self.image: bytearray = None
+        # The path of the image if it's written by a DirectorySink
+        self.filename: str = None
+
+    @property
+    def default_filename(self) -> str:
+        return f'{self.category}-{self.short_name}-{self.interval_type.lower()}.png'
 
 
 class GraphResult(Node):
@@ -30,12 +51,48 @@ class GraphResult(Node):
         self.graphs: list[GraphNode] = NodeList(GraphNode)
 
 
+class GraphSink:
+    """
+    Receives each image as soon as it's rendered, so the images are not kept in memory
+    in GraphResult, only the metadata of the graphs.
+
+    The write() method is called from the worker threads of the graph generation.
+    """
+
+    def write(self, graph: GraphNode, image: bytes):
+        raise NotImplementedError()
+
+
+class DirectorySink(GraphSink):
+    """
+    Writes the images into a directory, using the same names as RrdTool.save_to_directory().
+    """
+
+    def __init__(self, directory: str, create: bool = False):
+        self._directory = directory
+
+        if create:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, graph: GraphNode, image: bytes):
+        graph.filename = os.path.join(self._directory, graph.default_filename)
+
+        with open(graph.filename, 'wb') as f:
+            f.write(image)
+
+
 class GraphWriter:
     """
     Writing a graph based
+
+    If adaptive_parallel_count is True, the count of the concurrently rendered graphs starts from
+    the CPU count and it's adjusted based on the measured throughput, render time and I/O wait,
+    see HillClimbingConcurrencyController. Then parallel_count is the upper limit
+    (ADAPTIVE_MAX_PER_CPU * CPU count if it's 1).
     """
     DEFAULT_WIDTH = 400
     DEFAULT_HEIGHT = 175
+    ADAPTIVE_MAX_PER_CPU = 4
 
     def __init__(self,
                  munin_directory: str,
@@ -44,7 +101,12 @@ class GraphWriter:
                  last_update_date_time: datetime.datetime | None,
                  width: int | None = None,
                  height: int | None = None,
-                 parallel_count: int = 1
+                 parallel_count: int = 1,
+                 backend: GraphBackendType = GraphBackendType.SUBPROCESS,
+                 cache: BaseGraphCache | None = None,
+                 sink: GraphSink | None = None,
+                 batch_intervals: bool = False,
+                 adaptive_parallel_count: bool = False,
                  ):
         self._munin_directory = munin_directory
         self._config = config
@@ -54,13 +116,20 @@ class GraphWriter:
         self._width = width or self.DEFAULT_WIDTH
         self._height = height or self.DEFAULT_HEIGHT
         self._parallel_count = parallel_count
+        self._backend_type = backend
+        self._cache = cache
+        self._sink = sink
+        self._batch_intervals = batch_intervals
+        self._adaptive_parallel_count = adaptive_parallel_count
+
+        if self._adaptive_parallel_count and self._parallel_count == 1:
+            self._parallel_count = self.ADAPTIVE_MAX_PER_CPU * multiprocessing.cpu_count()
 
         if self._width < 200 or self._height < 100:
             self._width = self.DEFAULT_WIDTH
             self._height = self.DEFAULT_HEIGHT
 
         self._header_args = [
-            'graph',
             '--font', 'TITLE:12:Sans',
             '--font', 'DEFAULT:7',
             '--font', 'LEGEND:7',
@@ -77,13 +146,13 @@ class GraphWriter:
             '--watermark', "DEWI - dewi_utils.rrdtool",
             '--slope-mode',
             '--disable-rrdtool-tag',
-            '-',
             '--width', self._width,
             '--height', self._height,
             '--imgformat', 'PNG',
         ]
 
         self._env_tz = self._prepare_env_tz()
+        self._env = _prepare_env(self._env_tz)
 
     def _prepare_env_tz(self) -> str | None:
         if self._last_update_date_time is not None:
@@ -100,29 +169,87 @@ class GraphWriter:
 
         return None
 
+    @property
+    def env_tz(self) -> str | None:
+        return self._env_tz
+
+    def create_backend(self, pool_size: int | None = None) -> GraphBackend:
+        if pool_size is not None:
+            # At most pool_size backends shared by the threads, e.g. by the requests of a server
+            return PooledGraphBackend(self._backend_type, self._env, pool_size)
+
+        # One backend (e.g. 'rrdtool -' process) per thread, they are reused by the jobs of the thread
+        return ThreadLocalGraphBackend(self._backend_type, self._env)
+
     def generate(self, intervals: list[GraphInterval]):
-        log_info(f'Generating graphs in {self._parallel_count} thread(s)')
-        if self._parallel_count == 1:
-            job = GraphWriterJob(self._munin_directory, self._config, self._output, self._last_update_date_time,
+        log_info(f'Generating graphs in {self._parallel_count} thread(s)', backend=self._backend_type.name,
+                 adaptive=self._adaptive_parallel_count)
+        backend = self.create_backend()
+        try:
+            self._generate(intervals, backend)
+        finally:
+            backend.close()
+
+    def render(self, plugin: config.Plugin, interval: GraphInterval, backend: GraphBackend) -> GraphNode:
+        """
+        Generates a single graph using a backend created by create_backend(), e.g. to serve graphs on demand.
+        """
+        job = GraphWriterJob(None, self._munin_directory, self._config, self._output, self._last_update_date_time,
+                             self._last_update_timestamp,
+                             self._width, self._height, self._header_args, self._env_tz,
+                             plugin, interval, backend=backend, cache=self._cache, sink=self._sink)
+        return job.generate_graph()
+
+    def render_snapshots(self, plugin: config.Plugin, interval: GraphInterval,
+                         end_times: collections.abc.Iterable[int], backend: GraphBackend) -> list[GraphNode]:
+        """
+        Generates the graphs of the plugin for the interval at each end time in a single call of the backend,
+        e.g. the daily graphs of the last 90 days. The images are returned in the graphs, not passed to the sink,
+        as the graphs would have the same file name.
+        """
+        job = GraphWriterJob(None, self._munin_directory, self._config, self._output, self._last_update_date_time,
+                             self._last_update_timestamp,
+                             self._width, self._height, self._header_args, self._env_tz,
+                             plugin, interval, backend=backend, cache=self._cache)
+        return job.generate_snapshots(plugin, interval, end_times)
+
+    def _generate(self, intervals: list[GraphInterval], backend: GraphBackend):
+        if self._parallel_count == 1 and not self._adaptive_parallel_count:
+            job = GraphWriterJob(None, self._munin_directory, self._config, self._output, self._last_update_date_time,
                                  self._last_update_timestamp,
-                                 self._width, self._height, self._header_args, self._env_tz)
-            job.generate_all(intervals)
+                                 self._width, self._height, self._header_args, self._env_tz, backend=backend,
+                                 cache=self._cache, sink=self._sink)
+            job.generate_all(intervals, self._batch_intervals)
 
         else:
-            pool = Pool(state=self, thread_count=self._parallel_count)
+            controller = HillClimbingConcurrencyController() if self._adaptive_parallel_count else None
+            pool = Pool(state=self, thread_count=self._parallel_count, concurrency_controller=controller)
             job_params: list[JobParam] = []
 
             for domain, host, plugin in self._config.plugins:
+                if self._batch_intervals:
+                    job_params.append(JobParam(
+                        self._munin_directory, self._config, self._output, self._last_update_date_time,
+                        self._last_update_timestamp,
+                        self._width, self._height, self._header_args, self._env_tz,
+                        self._config.domains[domain].hosts[host].plugins[plugin],
+                        intervals=intervals, backend=backend, cache=self._cache, sink=self._sink))
+                    continue
+
                 for interval in intervals:
                     job_params.append(JobParam(
-                        self,
                         self._munin_directory, self._config, self._output, self._last_update_date_time,
                         self._last_update_timestamp,
                         self._width, self._height, self._header_args, self._env_tz,
                         self._config.domains[domain].hosts[host].plugins[plugin],
-                        interval))
+                        interval, backend=backend, cache=self._cache, sink=self._sink))
 
-            pool.run(GraphWriterJob, job_params)
+            # The graphs are returned by the jobs, in the same order as in the sequential run
+            if self._batch_intervals:
+                for graphs in pool.map(GraphWriterJob, job_params):
+                    self._output.graphs.extend(graphs)
+            else:
+                self._output.graphs.extend(pool.map(GraphWriterJob, job_params))
 
 
 class GraphWriterJob(Job):
@@ -134,6 +261,7 @@ class GraphWriterJob(Job):
         666600 FFBFFF 00FFCC CC6699 999900""".split()
 
     def __init__(self,
+                 pool: Pool | None,
                  munin_directory: str,
                  config: config.GraphConfig,
                  output: GraphResult,
@@ -145,7 +273,13 @@ class GraphWriterJob(Job):
                  env_tz: str | None,
                  plugin: config.Plugin | None = None,
                  interval: GraphInterval | None = None,
+                 *,
+                 intervals: list[GraphInterval] | None = None,
+                 backend: GraphBackend | None = None,
+                 cache: BaseGraphCache | None = None,
+                 sink: GraphSink | None = None,
                  ):
+        super().__init__(pool)
         self._munin_directory = munin_directory
         self._config = config
         self._output = output
@@ -158,46 +292,89 @@ class GraphWriterJob(Job):
 
         self._plugin = plugin
         self._interval = interval
+        # All graphs of the plugin, see GraphWriter's batch_intervals
+        self._intervals = intervals
 
-        self._env = self._prepare_env()
-
-    def _prepare_env(self):
-        env = dict(os.environ)
-        env['LANG'] = 'en_US.UTF-8'
-        env['LC_LANG'] = 'en_US.UTF-8'
-
-        if self._env_tz:
-            env['TZ'] = self._env_tz
+        self._backend = backend or SubprocessGraphBackend(_prepare_env(env_tz))
+        self._cache = cache
+        self._sink = sink
 
-        return env
-
-    def generate_all(self, intervals: list[GraphInterval]):
+    def generate_all(self, intervals: list[GraphInterval], batch_intervals: bool = False):
         for domain, host, plugin in self._config.plugins:
-            for interval in intervals:
-                result = self._generate_graph_of_interval(self._config.domains[domain].hosts[host].plugins[plugin],
-                                                          interval)
-                self._output.graphs.append(result)
+            plugin = self._config.domains[domain].hosts[host].plugins[plugin]
+
+            if batch_intervals:
+                self._output.graphs.extend(self._generate_graphs_of_intervals(plugin, intervals))
+            else:
+                for interval in intervals:
+                    self._output.graphs.append(self._generate_graph_of_interval(plugin, interval))
 
     def _generate_graph_of_interval(self, plugin: config.Plugin,
                                     interval: GraphInterval) -> GraphNode:
-        result = GraphNode()
-        result.interval_type = interval.interval_name
-        result.title = plugin.title
-        result.title_suffix = interval.title_suffix
-        result.short_name = plugin.name
-        result.category = plugin.category
-
-        args = list(self._header_args)
-
-        start_time, end_time = interval.range(self._last_update_timestamp)
-        args += [
-            '--start', start_time,
-            '--end', end_time,
-            '--title', f'{result.title} - {result.title_suffix}'
-        ]
-
-        result.start_time, result.end_time = start_time, end_time
-
+        return self._generate_graphs_of_intervals(plugin, [interval])[0]
+
+    def _generate_graphs_of_intervals(self, plugin: config.Plugin,
+                                      intervals: list[GraphInterval]) -> list[GraphNode]:
+        return self._generate_graphs(plugin, [(interval, *interval.range(self._last_update_timestamp))
+                                              for interval in intervals])
+
+    def generate_snapshots(self, plugin: config.Plugin, interval: GraphInterval,
+                           end_times: collections.abc.Iterable[int]) -> list[GraphNode]:
+        """
+        Generates the graphs of a plugin for the interval at multiple end times,
+        e.g. the daily graphs of the last 90 days.
+        """
+        start_times, end_times = interval.ranges(end_times)
+        return self._generate_graphs(plugin, [(interval, int(start_time), int(end_time))
+                                              for start_time, end_time in zip(start_times, end_times)])
+
+    def _generate_graphs(self, plugin: config.Plugin,
+                         ranges: list[tuple[GraphInterval, int, int]]) -> list[GraphNode]:
+        """
+        Generates the graphs of a plugin for each (interval, start time, end time). The plugin-specific arguments
+        are created only once, and the graphs are rendered by a single call of the backend
+        (e.g. in one rrdtool process).
+        """
+        plugin_args, rrd_filenames = self._create_plugin_args(plugin)
+
+        results = []
+        args_list = []
+        for interval, start_time, end_time in ranges:
+            result = GraphNode()
+            result.interval_type = interval.interval_name
+            result.title = plugin.title
+            result.title_suffix = interval.title_suffix
+            result.short_name = plugin.name
+            result.category = plugin.category
+
+            result.start_time, result.end_time = start_time, end_time
+
+            args = self._header_args + [
+                '--start', start_time,
+                '--end', end_time,
+                '--title', f'{result.title} - {result.title_suffix}'
+            ]
+            if interval.resolution:
+                args += ['--step', interval.resolution]
+            args_list.append([str(x) for x in args] + plugin_args)
+            results.append(result)
+
+        images = self._render(args_list, rrd_filenames)
+
+        for result, image in zip(results, images):
+            if self._sink is None:
+                result.image = image
+            else:
+                self._sink.write(result, image)
+
+        return results
+
+    def _create_plugin_args(self, plugin: config.Plugin) -> tuple[list[str], list[str]]:
+        """
+        Returns the arguments of the graphs of the plugin after the interval-specific ones,
+        and the list of used rrd files.
+        """
+        args = []
         printf_format = None
 
         for opt_name in plugin.options:
@@ -226,14 +403,16 @@ class GraphWriterJob(Job):
 
         field_names = plugin.field_order if len(plugin.field_order) else plugin.fields.keys()
 
+        rrd_filenames = []
         field_number = -1
         for field_name in field_names:
             field_number += 1
             field = plugin.fields[field_name]
+            filename = os.path.join(self._munin_directory, field.filename)
+            rrd_filenames.append(filename)
 
             for i in ['g:AVERAGE', 'i:MIN', 'a:MAX', 'c:LAST']:
                 short_name, long_name = i.split(':')
-                filename = os.path.join(self._munin_directory, field.filename)
                 args.append(
                     f'DEF:{short_name}{field.name}={filename}:42:{long_name}'
                 )
@@ -258,9 +437,15 @@ class GraphWriterJob(Job):
             f"COMMENT:Last update\\: {last_updated}\\r"
         )
 
-        result.image = subprocess.check_output(['rrdtool'] + [str(x) for x in args], env=self._env)
+        return [str(x) for x in args], rrd_filenames
 
-        return result
+    def _render(self, args_list: list[list[str]], rrd_filenames: list[str]) -> list[bytes]:
+        if self._cache is None:
+            return self._backend.graph_many(args_list)
+
+        keys = [self._cache.calculate_key(args, rrd_filenames) for args in args_list]
+        return self._cache.get_or_render_many(
+            keys, lambda indices: self._backend.graph_many([args_list[i] for i in indices]))
 
     def _get_max_label_length(self, plugin: config.Plugin):
         result = 0
@@ -279,5 +464,11 @@ class GraphWriterJob(Job):
             self._generate_graph_of_interval(self._plugin, self._interval)
         )
 
-    def _run(self):
-        self.generate_single()
+    def generate_graph(self) -> GraphNode:
+        return self._generate_graph_of_interval(self._plugin, self._interval)
+
+    def generate_graphs(self) -> list[GraphNode]:
+        return self._generate_graphs_of_intervals(self._plugin, self._intervals)
+
+    def _run(self) -> GraphNode | list[GraphNode]:
+        return self.generate_graph() if self._intervals is None else self.generate_graphs()
@@ -0,0 +1,164 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import asyncio
+import time
+
+import dewi_core.testcase
+from dewi_utils.asyncio import AsyncJob, AsyncPool
+from dewi_utils.threading import JobParam
+
+
+class State:
+    def __init__(self):
+        self.result = list()
+        self.running = 0
+        self.max_running = 0
+
+
+class AsyncTestJob(AsyncJob):
+    def __init__(self, pool: AsyncPool, state: State, value: int,
+                 *,
+                 next_job_class: type[AsyncJob] | None = None,
+                 next_job_count: int = 0,
+                 postprocessor_job_class: type[AsyncJob] | None = None):
+        super().__init__(pool)
+        self._state = state
+        self._value = value
+        self._next_job_class = next_job_class
+        self._next_job_count = next_job_count
+        self._postprocessor_job_class = postprocessor_job_class
+
+    async def _run(self):
+        self._state.running += 1
+        self._state.max_running = max(self._state.running, self._state.max_running)
+        await asyncio.sleep(0.05)
+        self._state.running -= 1
+        self._state.result.append(self._value)
+
+    def next_job_class(self) -> type | None:
+        return self._next_job_class
+
+    def next_job_param_list(self) -> list[JobParam]:
+        return JobParam.from_list(list(range(1, self._next_job_count + 1)), self._state)
+
+    def post_processor_job_class(self) -> type | None:
+        return self._postprocessor_job_class
+
+    def post_processor_job_params(self) -> JobParam | None:
+        return JobParam(self._state)
+
+
+class AsyncJob1(AsyncTestJob):
+    def __init__(self, pool, state: State, _=None):
+        super().__init__(pool, state, 1, next_job_class=AsyncJob2, next_job_count=5, postprocessor_job_class=AsyncJob4)
+
+
+class AsyncJob2(AsyncTestJob):
+    def __init__(self, pool, state: State, _=None):
+        super().__init__(pool, state, 2, next_job_class=AsyncJob3, next_job_count=4, postprocessor_job_class=AsyncJob5)
+
+
+class AsyncJob3(AsyncTestJob):
+    def __init__(self, pool, state: State, _=None):
+        super().__init__(pool, state, 3)
+
+
+class AsyncJob4(AsyncTestJob):
+    def __init__(self, pool, state: State, _=None):
+        super().__init__(pool, state, 4)
+
+
+class AsyncJob5(AsyncTestJob):
+    def __init__(self, pool, state: State, _=None):
+        super().__init__(pool, state, 5)
+
+
+class SlowAsyncJob(AsyncJob):
+    timeout = 0.1
+
+    def __init__(self, pool, state: State, _=None):
+        super().__init__(pool)
+        self._state = state
+
+    async def _run(self):
+        await asyncio.sleep(10)
+        self._state.result.append(0)
+
+    def next_job_class(self) -> type | None:
+        return AsyncJob3
+
+    def next_job_param_list(self) -> list[JobParam]:
+        return [JobParam(self._state)]
+
+
+class FailingNextJobsAsyncJob(AsyncJob3):
+    def next_job_param_list(self) -> list[JobParam]:
+        raise ValueError('invalid next jobs')
+
+
+class FlakyAsyncJob(AsyncJob):
+    max_retries = 3
+    retry_delay = 10
+
+    async def _run(self):
+        raise RuntimeError('transient failure')
+
+
+class AsyncPoolTest(dewi_core.testcase.TestCase):
+    def test_run_single_job2(self):
+        state = State()
+        AsyncPool().run_until_complete(AsyncJob2, [JobParam(state)])
+        self.assert_equal([2] + (4 * [3]) + [5], state.result)
+
+    def test_reducers_run_after_their_subtree(self):
+        state = State()
+        AsyncPool().run_until_complete(AsyncJob1, [JobParam(state)])
+        self.assert_equal(1, state.result[0])
+        self.assert_equal(4, state.result[-1])
+        self.assert_equal(sorted([1] + (5 * [2]) + (5 * 4 * [3]) + (5 * [5]) + [4]), sorted(state.result))
+
+    def test_concurrency_limit(self):
+        state = State()
+        AsyncPool(concurrency=3).run_until_complete(AsyncJob3, [JobParam(state)] * 10)
+        self.assert_equal(10 * [3], state.result)
+        self.assert_equal(3, state.max_running)
+
+    def test_thousands_of_jobs_run_concurrently(self):
+        state = State()
+        start = time.monotonic()
+        AsyncPool(concurrency=2000).run_until_complete(AsyncJob3, [JobParam(state)] * 2000)
+        self.assert_less(time.monotonic() - start, 10)
+        self.assert_equal(2000, state.max_running)
+
+    def test_run_without_jobs(self):
+        pool = AsyncPool()
+        pool.run_until_complete(AsyncJob3, [])
+        self.assert_false(pool.tasks)
+
+    def test_timed_out_job_is_cancelled_without_next_jobs(self):
+        state = State()
+        start = time.monotonic()
+        pool = AsyncPool()
+        pool.run_until_complete(SlowAsyncJob, [JobParam(state)])
+        self.assert_less(time.monotonic() - start, 5)
+        self.assert_equal([], state.result)
+
+    def test_completion_error_is_raised_by_run(self):
+        state = State()
+        with self.assert_raises(ValueError):
+            AsyncPool().run_until_complete(FailingNextJobsAsyncJob, [JobParam(state)] * 3)
+        self.assert_equal(3 * [3], state.result)
+
+    def test_cancel_interrupts_retry_delay(self):
+        async def cancel_later(pool: AsyncPool):
+            await asyncio.sleep(0.1)
+            pool.cancel()
+
+        async def run():
+            pool = AsyncPool()
+            await asyncio.gather(pool.run(FlakyAsyncJob, [JobParam()]), cancel_later(pool))
+
+        start = time.monotonic()
+        asyncio.run(run())
+        self.assert_less(time.monotonic() - start, 5)
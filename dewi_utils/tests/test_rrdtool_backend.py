@@ -0,0 +1,42 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import os
+import unittest.mock
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.backend import (
+    BindingsGraphBackend, GraphBackendType, PipeGraphBackend, RrdToolError, create_graph_backend, quote_pipe_arg,
+)
+
+
+class QuotePipeArgTest(dewi_core.testcase.TestCase):
+    def test_simple_args_are_not_quoted(self):
+        self.assert_equal('--width', quote_pipe_arg('--width'))
+        self.assert_equal('DEF:gload=/a/b.rrd:42:AVERAGE', quote_pipe_arg('DEF:gload=/a/b.rrd:42:AVERAGE'))
+
+    def test_args_with_whitespace_are_quoted(self):
+        self.assert_equal("'COMMENT:Min\\:  \\j'", quote_pipe_arg('COMMENT:Min\\:  \\j'))
+        self.assert_equal("''", quote_pipe_arg(''))
+
+    def test_other_quote_is_used_if_arg_contains_quote(self):
+        self.assert_equal('"it\'s"', quote_pipe_arg("it's"))
+        self.assert_equal("'a \"b\"'", quote_pipe_arg('a "b"'))
+
+    def test_unrepresentable_args(self):
+        self.assert_is_none(quote_pipe_arg('a\nb'))
+        self.assert_is_none(quote_pipe_arg('it\'s "x"'))
+
+
+class BindingsGraphBackendTest(dewi_core.testcase.TestCase):
+    def test_time_zone_of_process_is_not_changed(self):
+        with unittest.mock.patch.dict(os.environ, TZ='UTC'):
+            with self.assert_raises(RrdToolError):
+                BindingsGraphBackend({'TZ': '-02:00'})
+            self.assert_equal('UTC', os.environ['TZ'])
+
+    def test_auto_backend_uses_pipe_mode_in_other_time_zone(self):
+        with unittest.mock.patch.dict(os.environ, TZ='UTC'):
+            with unittest.mock.patch('dewi_utils.rrdtool.backend.has_rrdtool_bindings', return_value=True):
+                backend = create_graph_backend(GraphBackendType.AUTO, {'TZ': '-02:00'})
+        self.assert_is_instance(backend, PipeGraphBackend)
@@ -0,0 +1,48 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import os
+import os.path
+import tempfile
+import unittest.mock
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.benchmark import Benchmark, compare_results, generate_munin_directory, write_stub_rrdtool
+from dewi_utils.rrdtool.loader import GraphLoader
+from dewi_utils.rrdtool.rrdfile import read_last_update
+
+
+class BenchmarkTest(dewi_core.testcase.TestCase):
+    def test_munin_directory_is_generated(self):
+        with tempfile.TemporaryDirectory() as directory:
+            generate_munin_directory(directory, domains=2, hosts=3, plugins=4, fields=2, last_update=1651406400)
+
+            loader = GraphLoader(os.path.join(directory, 'datafile'))
+            loader.load()
+            self.assert_equal(2 * 3 * 4, len(list(loader.config.plugins)))
+            self.assert_equal(2 * 3 * 4 * 2, len(list(loader.config.fields)))
+
+            for d, h, p, f in loader.config.fields:
+                field = loader.config.domains[d].hosts[h].plugins[p].fields[f]
+                self.assert_equal(1651406400, read_last_update(os.path.join(directory, field.filename)))
+
+    def test_graphs_are_generated_by_stub_rrdtool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            munin_directory = os.path.join(directory, 'munin')
+            # The diskstats plugins have complete read/write pairs of 2 devices, which are separated
+            generate_munin_directory(munin_directory, hosts=2, plugins=3, fields=3)
+            write_stub_rrdtool(directory)
+
+            with unittest.mock.patch.dict(os.environ, PATH=directory + os.pathsep + os.environ.get('PATH', '')):
+                result = Benchmark(munin_directory).run()
+
+            self.assert_equal(2 * 3, result['plugins'])
+            self.assert_equal(2 * (2 * 4 + 3), result['fields'])
+            self.assert_equal(2 * (2 * 2 + 1) * 4, result['graphs'])
+
+    def test_regressions_are_reported(self):
+        baseline = dict(stages=dict(load=dict(time=1.0, peak_memory=100), generate=dict(time=2.0)))
+        result = dict(stages=dict(load=dict(time=1.05, peak_memory=150), generate=dict(time=3.0), modify=dict(time=1)))
+
+        self.assert_equal(['load.peak_memory: 100 -> 150 (+50%)', 'generate.time: 2 -> 3 (+50%)'],
+                          compare_results(baseline, result, 0.1))
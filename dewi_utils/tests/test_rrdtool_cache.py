@@ -0,0 +1,114 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.cache import GraphCache, MemoryGraphCache
+
+
+class GraphCacheTest(dewi_core.testcase.TestCase):
+    def set_up(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rrd = os.path.join(self.tmpdir.name, 'load.rrd')
+        self.cache_dir = os.path.join(self.tmpdir.name, 'cache')
+        with open(self.rrd, 'wb') as f:
+            f.write(b'rrd')
+
+    def tear_down(self):
+        self.tmpdir.cleanup()
+
+    def test_stored_graph_is_returned(self):
+        cache = GraphCache(self.cache_dir)
+        key = cache.calculate_key(['--width', '400'], [self.rrd])
+        self.assert_is_none(cache.get(key))
+        cache.put(key, b'PNG')
+
+        cache = GraphCache(self.cache_dir)
+        self.assert_equal(b'PNG', cache.get(key))
+        self.assert_equal(1, cache.hit_count)
+        self.assert_equal(0, cache.miss_count)
+
+    def test_key_depends_on_args_and_rrd_files(self):
+        key = GraphCache.calculate_key(['--width', '400'], [self.rrd])
+        self.assert_equal(key, GraphCache.calculate_key(['--width', '400'], [self.rrd]))
+        self.assert_not_equal(key, GraphCache.calculate_key(['--width', '800'], [self.rrd]))
+        self.assert_not_equal(key, GraphCache.calculate_key(['--width', '400'], []))
+
+        st = os.stat(self.rrd)
+        os.utime(self.rrd, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+        self.assert_not_equal(key, GraphCache.calculate_key(['--width', '400'], [self.rrd]))
+
+    def test_missing_graphs_are_rendered_at_once(self):
+        cache = GraphCache(self.cache_dir)
+        cache.put('b', b'B')
+        rendered = []
+
+        def render_many(indices):
+            rendered.append(indices)
+            return [b'X%d' % i for i in indices]
+
+        self.assert_equal([b'X0', b'B', b'X2'], cache.get_or_render_many(['a', 'b', 'c'], render_many))
+        self.assert_equal([[0, 2]], rendered)
+        self.assert_equal(b'X2', cache.get('c'))
+
+    def test_prune_removes_unused_graphs(self):
+        cache = GraphCache(self.cache_dir)
+        cache.put('a', b'A')
+        cache.put('b', b'B')
+
+        cache = GraphCache(self.cache_dir)
+        cache.get('a')
+        cache.prune()
+        self.assert_equal(['a.png'], os.listdir(self.cache_dir))
+
+
+class MemoryGraphCacheTest(dewi_core.testcase.TestCase):
+    def test_least_recently_used_graphs_are_dropped(self):
+        cache = MemoryGraphCache(2)
+        cache.get_or_render('a', lambda: b'A')
+        cache.get_or_render('b', lambda: b'B')
+        self.assert_equal(b'A', cache.get_or_render('a', lambda: b'X'))
+        cache.get_or_render('c', lambda: b'C')
+
+        self.assert_equal(2, len(cache))
+        self.assert_equal(b'A', cache.get_or_render('a', lambda: b'X'))
+        self.assert_equal(b'X', cache.get_or_render('b', lambda: b'X'))
+        self.assert_equal(2, cache.hit_count)
+        self.assert_equal(4, cache.miss_count)
+
+    def test_concurrent_requests_are_coalesced(self):
+        cache = MemoryGraphCache()
+        render_count = 0
+        results = []
+
+        def render():
+            nonlocal render_count
+            render_count += 1
+            time.sleep(0.2)
+            return b'PNG'
+
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_render('a', render)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assert_equal(5 * [b'PNG'], results)
+        self.assert_equal(1, render_count)
+        self.assert_equal(4, cache.coalesced_count)
+
+    def test_failed_render_is_not_cached(self):
+        cache = MemoryGraphCache()
+
+        def render():
+            raise RuntimeError('rrdtool failed')
+
+        with self.assert_raises(RuntimeError):
+            cache.get_or_render('a', render)
+        self.assert_equal(b'A', cache.get_or_render('a', lambda: b'A'))
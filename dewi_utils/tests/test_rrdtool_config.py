@@ -0,0 +1,54 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import pickle
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.config import Field, GraphConfig, Options
+
+
+class OptionsTest(dewi_core.testcase.TestCase):
+    def test_dict_operations(self):
+        options = Options({'label': 'load', 'draw': 'LINE1'})
+        options['type'] = 'GAUGE'
+        options['draw'] = 'AREA'
+
+        self.assert_equal({'label': 'load', 'draw': 'AREA', 'type': 'GAUGE'}, options)
+        self.assert_equal(['label', 'draw', 'type'], list(options))
+        self.assert_in('type', options)
+        self.assert_equal('AREA', options['draw'])
+        self.assert_is_none(options.get('min'))
+
+        del options['label']
+        self.assert_equal({'draw': 'AREA', 'type': 'GAUGE'}, options)
+        with self.assert_raises(KeyError):
+            options['label']
+
+    def test_keys_are_shared(self):
+        options1 = Options({'label': 'user', 'type': 'DERIVE'})
+        options2 = Options()
+        options2['label'] = 'system'
+        options2['type'] = 'DERIVE'
+
+        self.assert_is(options1._keys, options2._keys)
+        self.assert_is(options1._keys, pickle.loads(pickle.dumps(options1))._keys)
+
+
+class SlottedNodeTest(dewi_core.testcase.TestCase):
+    def test_field_is_a_mapping_without_dict(self):
+        field = Field()
+        field.name = 'load'
+        field['filename'] = 'load.rrd'
+
+        self.assert_false(hasattr(field, '__dict__'))
+        self.assert_equal({'name': 'load', 'options': {}, 'filename': 'load.rrd'}, field.as_dict())
+
+    def test_config_can_be_pickled(self):
+        config = GraphConfig()
+        config.domains['example.com'].hosts['host1'].plugins['load'].fields['load'].options['label'] = 'load'
+
+        config = pickle.loads(pickle.dumps(config))
+        self.assert_equal([('example.com', 'host1', 'load', 'load')], list(config.fields))
+        field = config.domains['example.com'].hosts['host1'].plugins['load'].fields['load']
+        self.assert_equal('load', field.name)
+        self.assert_equal({'label': 'load'}, field.options)
@@ -0,0 +1,141 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import datetime
+import os.path
+import socket
+import tempfile
+import threading
+import time
+import unittest.mock
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.backend import GraphBackend, GraphBackendType, RrdToolError
+from dewi_utils.rrdtool.config import GraphConfig
+from dewi_utils.rrdtool.distributed import DistributedGraphWriter, GraphBroker, GraphWorker
+from dewi_utils.rrdtool.interval import GraphInterval
+from dewi_utils.rrdtool.rrdtool import RrdTool
+from dewi_utils.rrdtool.writer import GraphResult
+
+
+class FakeGraphBackend(GraphBackend):
+    def graph(self, args: list[str]) -> bytes:
+        return b'PNG ' + args[args.index('--title') + 1].encode()
+
+
+class FakeGraphWorker(GraphWorker):
+    def _create_backend(self, env_tz: str | None) -> GraphBackend:
+        return FakeGraphBackend()
+
+
+class FailingGraphWorker(GraphWorker):
+    def _create_backend(self, env_tz: str | None) -> GraphBackend:
+        raise ImportError('No module named rrdtool')
+
+
+def _exit_worker(*args):
+    os._exit(3)
+
+
+def _get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class DistributedGraphWriterTest(dewi_core.testcase.TestCase):
+    def set_up(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config = GraphConfig()
+        for name in ['load', 'cpu']:
+            plugin = self.config.domains['example.com'].hosts['host1'].plugins[name]
+            plugin.name = name
+            plugin.title = name.capitalize()
+            plugin.category = 'system'
+            plugin.period = 'second'
+            plugin.field_order = [name]
+            plugin.fields[name].options.update({'label': name, 'draw': 'LINE1'})
+            plugin.fields[name].filename = f'example.com/host1-{name}-{name}-g.rrd'
+
+    def tear_down(self):
+        self.tmpdir.cleanup()
+
+    def _start_workers(self, address: tuple[str, int], count: int,
+                       worker_class: type[GraphWorker] = FakeGraphWorker) -> tuple[list[threading.Thread], list[int]]:
+        job_counts = []
+
+        def run():
+            # The workers may be started before the broker
+            while True:
+                try:
+                    job_counts.append(worker_class(address, b'secret').run())
+                    return
+                except ConnectionRefusedError:
+                    time.sleep(0.05)
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, job_counts
+
+    def test_graphs_are_generated_by_remote_workers(self):
+        address = ('localhost', _get_free_port())
+        threads, job_counts = self._start_workers(address, 2)
+
+        output = GraphResult()
+        output_directory = os.path.join(self.tmpdir.name, 'graphs')
+        broker = GraphBroker(output_directory, address=address, authkey=b'secret', local_worker_count=0, timeout=30)
+        writer = DistributedGraphWriter(self.tmpdir.name, self.config, output, datetime.datetime(2022, 5, 1, 12, 0),
+                                        broker=broker)
+        intervals = GraphInterval.default_intervals()
+        writer.generate(intervals)
+
+        self.assert_equal([(p, i.interval_name) for p in ['load', 'cpu'] for i in intervals],
+                          [(g.short_name, g.interval_type) for g in output.graphs])
+        graph = output.graphs[0]
+        self.assert_is_none(graph.image)
+        self.assert_equal(os.path.join(output_directory, 'system-load-day.png'), graph.filename)
+        with open(graph.filename, 'rb') as f:
+            self.assert_equal(b'PNG Load - by Day', f.read())
+
+        for thread in threads:
+            thread.join()
+        self.assert_equal(8, sum(job_counts))
+
+    def test_backend_error_fails_the_jobs(self):
+        address = ('localhost', _get_free_port())
+        threads, job_counts = self._start_workers(address, 1, FailingGraphWorker)
+
+        output = GraphResult()
+        broker = GraphBroker(self.tmpdir.name, address=address, authkey=b'secret', local_worker_count=0, timeout=30)
+        writer = DistributedGraphWriter(self.tmpdir.name, self.config, output, datetime.datetime(2022, 5, 1, 12, 0),
+                                        broker=broker, batch_intervals=True)
+        writer.generate(GraphInterval.default_intervals())
+
+        self.assert_equal([], output.graphs)
+        for thread in threads:
+            thread.join()
+        self.assert_equal([2], job_counts)
+
+    def test_died_local_worker_fails_the_generation(self):
+        broker = GraphBroker(self.tmpdir.name, authkey=b'secret', local_worker_count=1)
+        writer = DistributedGraphWriter(self.tmpdir.name, self.config, GraphResult(),
+                                        datetime.datetime(2022, 5, 1, 12, 0), broker=broker)
+        writer.WORKER_CHECK_INTERVAL = 0.1
+
+        with unittest.mock.patch('dewi_utils.rrdtool.distributed.run_worker', _exit_worker):
+            with self.assert_raises(RrdToolError):
+                writer.generate(GraphInterval.default_intervals())
+
+    def test_timeout_is_required_without_local_workers(self):
+        with self.assert_raises(ValueError):
+            GraphBroker(self.tmpdir.name, local_worker_count=0)
+
+    def test_unsupported_parameters_of_rrdtool(self):
+        broker = GraphBroker(self.tmpdir.name)
+        RrdTool(self.tmpdir.name, None, broker=broker, batch_intervals=True)
+
+        for kwargs in [dict(cache_directory=self.tmpdir.name), dict(parallel_run_count=4),
+                       dict(adaptive_parallel_run=True), dict(backend=GraphBackendType.PIPE)]:
+            with self.assert_raises(ValueError):
+                RrdTool(self.tmpdir.name, None, broker=broker, **kwargs)
@@ -0,0 +1,37 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.filters import GraphFilter
+
+
+class GraphFilterTest(dewi_core.testcase.TestCase):
+    def test_empty_filter_selects_everything(self):
+        graph_filter = GraphFilter()
+        self.assert_true(graph_filter.is_plugin_selected('example.com', 'host1', 'load'))
+        self.assert_true(graph_filter.is_category_selected(None))
+        self.assert_false(graph_filter.has_category_filter)
+
+    def test_glob_patterns(self):
+        graph_filter = GraphFilter(hosts=['web*', 'db1'], exclude_plugins='if_*')
+        self.assert_true(graph_filter.is_plugin_selected('example.com', 'web1', 'load'))
+        self.assert_true(graph_filter.is_plugin_selected('example.com', 'db1', 'load'))
+        self.assert_false(graph_filter.is_plugin_selected('example.com', 'db10', 'load'))
+        self.assert_false(graph_filter.is_plugin_selected('example.com', 'web1', 'if_eth0'))
+
+    def test_regex_patterns(self):
+        graph_filter = GraphFilter(domains=r'example\.(com|org)', exclude_hosts=r'.*\.test', use_regex=True)
+        self.assert_true(graph_filter.is_plugin_selected('example.org', 'web1', 'load'))
+        self.assert_false(graph_filter.is_plugin_selected('example.net', 'web1', 'load'))
+        self.assert_false(graph_filter.is_plugin_selected('example.com', 'web1.test', 'load'))
+
+    def test_categories(self):
+        graph_filter = GraphFilter(categories=['system', 'other'], exclude_categories='disk')
+        self.assert_true(graph_filter.has_category_filter)
+        self.assert_true(graph_filter.is_category_selected('system'))
+        self.assert_true(graph_filter.is_category_selected(None))
+        self.assert_false(graph_filter.is_category_selected('network'))
+
+    def test_id(self):
+        self.assert_equal(GraphFilter(hosts='web*').id, GraphFilter(hosts=['web*']).id)
+        self.assert_not_equal(GraphFilter(hosts='web*').id, GraphFilter(plugins='web*').id)
@@ -0,0 +1,59 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import datetime
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.interval import CalendarPeriod, GraphInterval, GraphIntervalType
+
+
+def _timestamp(*args) -> int:
+    return int(datetime.datetime(*args, tzinfo=datetime.timezone.utc).timestamp())
+
+
+class GraphIntervalTest(dewi_core.testcase.TestCase):
+    def set_up(self):
+        # Wednesday
+        self.end_time = _timestamp(2022, 5, 4, 12, 30)
+
+    def test_predefined_intervals_are_sliding_windows(self):
+        self.assert_equal((self.end_time - 2000 * 60, self.end_time),
+                          GraphInterval(GraphIntervalType.DAY).range(self.end_time))
+        self.assert_equal((self.end_time - 400 * 86400, self.end_time),
+                          GraphInterval(GraphIntervalType.YEAR).range(self.end_time))
+        self.assert_equal((10, 20), GraphInterval(GraphIntervalType.CUSTOM, 10, 20).range(self.end_time))
+
+    def test_sliding_window_of_any_length(self):
+        interval = GraphInterval.sliding(6 * 3600, name='6h', resolution=60)
+
+        self.assert_equal((self.end_time - 6 * 3600, self.end_time), interval.range(self.end_time))
+        self.assert_equal('6h', interval.interval_name)
+        self.assert_equal(60, interval.resolution)
+        self.assert_equal('7200s', GraphInterval.sliding(7200).interval_name)
+        with self.assert_raises(ValueError):
+            GraphInterval.sliding(0)
+
+    def test_calendar_periods(self):
+        expected = {
+            CalendarPeriod.DAY: (_timestamp(2022, 5, 3), _timestamp(2022, 5, 4)),
+            CalendarPeriod.WEEK: (_timestamp(2022, 4, 25), _timestamp(2022, 5, 2)),
+            CalendarPeriod.MONTH: (_timestamp(2022, 4, 1), _timestamp(2022, 5, 1)),
+            CalendarPeriod.YEAR: (_timestamp(2021, 1, 1), _timestamp(2022, 1, 1)),
+        }
+        for period, time_range in expected.items():
+            interval = GraphInterval.calendar(period, tz=datetime.timezone.utc)
+            self.assert_equal(time_range, interval.range(self.end_time))
+            self.assert_equal(f'calendar_{period.name.lower()}', interval.interval_name)
+
+    def test_ranges_of_multiple_end_times(self):
+        end_times = [self.end_time - day * 86400 for day in range(90)]
+        intervals = [
+            GraphInterval(GraphIntervalType.DAY),
+            GraphInterval.sliding(3600),
+            GraphInterval.calendar(CalendarPeriod.DAY, tz=datetime.timezone.utc),
+            GraphInterval(GraphIntervalType.CUSTOM, 10, 20),
+        ]
+        for interval in intervals:
+            start_times, ends = interval.ranges(iter(end_times))
+            self.assert_equal([interval.range(t) for t in end_times],
+                              [(int(s), int(e)) for s, e in zip(start_times, ends)])
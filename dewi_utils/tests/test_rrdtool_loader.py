@@ -0,0 +1,214 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import marshal
+import os.path
+import pickle
+import tempfile
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.filters import GraphFilter
+from dewi_utils.rrdtool.loader import GraphLoader, parse_datafile_lines
+
+
+DATAFILE = """version 2.0.0
+example.com;host1.example.com:load.graph_title Load average
+example.com;host1.example.com:load.graph_args --base 1000 -l 0;
+example.com;host1.example.com:load.graph_category system
+example.com;host1.example.com:load.graph_order load load
+example.com;host1.example.com:load.load.label load
+example.com;host1.example.com:cpu.graph_title CPU usage
+example.com;host1.example.com:cpu.graph_vlabel %
+example.com;host1.example.com:cpu.user.label user
+example.com;host1.example.com:cpu.user.type DERIVE
+example.com;host1.example.com:cpu.system.label system
+example.org;host2.example.org:if_eth0.graph_title eth0 traffic
+example.org;host2.example.org:if_eth0.down.label received
+example.com;host1.example.com:load.load.draw AREA
+example.com;host1.example.com:load.graph_title Load
+"""
+
+
+class CountingGraphLoader(GraphLoader):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.load_count = 0
+
+    def _load_file(self):
+        self.load_count += 1
+        super()._load_file()
+
+
+_unpickled_objects = []
+
+
+class PickledPayload:
+    def __reduce__(self):
+        return _unpickled_objects.append, ('executed',)
+
+
+class GraphLoaderTest(dewi_core.testcase.TestCase):
+    def set_up(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.datafile = os.path.join(self.tmpdir.name, 'datafile')
+        self.snapshot_directory = os.path.join(self.tmpdir.name, 'cache')
+        with open(self.datafile, 'w') as f:
+            f.write(DATAFILE)
+
+    def tear_down(self):
+        self.tmpdir.cleanup()
+
+    def test_parse_lines(self):
+        entries = parse_datafile_lines(DATAFILE.splitlines(keepends=True))
+        self.assert_equal([
+            ('example.com', 'host1.example.com', 'load'),
+            ('example.com', 'host1.example.com', 'cpu'),
+            ('example.org', 'host2.example.org', 'if_eth0'),
+        ], list(entries))
+
+        graph_entries, field_entries = entries[('example.com', 'host1.example.com', 'load')]
+        self.assert_equal({'graph_title': 'Load', 'graph_args': '--base 1000 -l 0;', 'graph_category': 'system',
+                           'graph_order': 'load load'}, graph_entries)
+        self.assert_equal({'load': {'label': 'load', 'draw': 'AREA'}}, field_entries)
+
+    def test_invalid_lines_are_skipped(self):
+        self.assert_equal({}, parse_datafile_lines(['version 2.0.0', 'a;b:c.graph_title', ';b:c.graph_title x',
+                                                    'a;b:c graph_title x', 'a;:c.graph_title x', '']))
+
+    def test_load(self):
+        loader = GraphLoader(self.datafile)
+        loader.load()
+        config = loader.config
+
+        self.assert_equal([('example.com', 'host1.example.com'), ('example.org', 'host2.example.org')],
+                          list(config.hosts))
+
+        plugin = config.domains['example.com'].hosts['host1.example.com'].plugins['load']
+        self.assert_equal('load', plugin.name)
+        self.assert_equal('Load', plugin.title)
+        self.assert_equal('system', plugin.category)
+        self.assert_equal('seconds', plugin.period)
+        self.assert_equal(['load'], plugin.field_order)
+        self.assert_equal({'graph_args': '--base 1000 -l 0'}, plugin.options)
+        self.assert_equal({'label': 'load', 'draw': 'AREA', 'type': 'GAUGE'}, plugin.fields['load'].options)
+        self.assert_equal(os.path.join('example.com', 'host1.example.com-load-load-g.rrd'),
+                          plugin.fields['load'].filename)
+
+        field = config.domains['example.com'].hosts['host1.example.com'].plugins['cpu'].fields['user']
+        self.assert_equal('user', field.name)
+        self.assert_equal('LINE1', field.options['draw'])
+        self.assert_equal(os.path.join('example.com', 'host1.example.com-cpu-user-d.rrd'), field.filename)
+
+    def test_parallel_load_gives_the_same_config(self):
+        loader = GraphLoader(self.datafile)
+        loader.load()
+
+        parallel_loader = GraphLoader(self.datafile, parallel_count=4)
+        parallel_loader.MIN_CHUNK_SIZE = 100
+        self.assert_equal(4, len(parallel_loader._split_to_chunks()))
+        parallel_loader.load()
+
+        self.assert_equal(list(loader.config.fields), list(parallel_loader.config.fields))
+        for domain, host, plugin in loader.config.plugins:
+            expected = loader.config.domains[domain].hosts[host].plugins[plugin]
+            actual = parallel_loader.config.domains[domain].hosts[host].plugins[plugin]
+            self.assert_equal(expected.title, actual.title)
+            self.assert_equal(expected.field_order, actual.field_order)
+            self.assert_equal(expected.options, actual.options)
+            for field in expected.fields:
+                self.assert_equal(expected.fields[field].options, actual.fields[field].options)
+                self.assert_equal(expected.fields[field].filename, actual.fields[field].filename)
+
+    def test_snapshot_is_used_until_datafile_is_changed(self):
+        loader = GraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+        loader.load()
+        self.assert_true(os.path.exists(loader._snapshot_path))
+        self.assert_equal(self.snapshot_directory, os.path.dirname(loader._snapshot_path))
+
+        loader = CountingGraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+        loader.load()
+        self.assert_equal(0, loader.load_count)
+        plugin = loader.config.domains['example.com'].hosts['host1.example.com'].plugins['load']
+        self.assert_equal('Load', plugin.title)
+        self.assert_equal({'label': 'load', 'draw': 'AREA', 'type': 'GAUGE'}, plugin.fields['load'].options)
+        self.assert_equal(2, len(list(loader.config.hosts)))
+
+        with open(self.datafile, 'a') as f:
+            f.write('example.com;host1.example.com:load.graph_title New title\n')
+
+        loader = CountingGraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+        loader.load()
+        self.assert_equal(1, loader.load_count)
+        plugin = loader.config.domains['example.com'].hosts['host1.example.com'].plugins['load']
+        self.assert_equal('New title', plugin.title)
+
+    def test_snapshot_contains_the_whole_config(self):
+        loader = GraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+        loader.load()
+        snapshot_loader = CountingGraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+        snapshot_loader.load()
+
+        self.assert_equal(0, snapshot_loader.load_count)
+        self.assert_equal(loader.config.as_dict(), snapshot_loader.config.as_dict())
+        plugin = snapshot_loader.config.domains['example.com'].hosts['host1.example.com'].plugins['load']
+        self.assert_equal('load', plugin.name)
+        self.assert_equal('load', plugin.fields['load'].name)
+
+    def test_pickled_snapshot_is_not_loaded(self):
+        loader = GraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+        os.makedirs(self.snapshot_directory)
+        with open(loader._snapshot_path, 'wb') as f:
+            pickle.dump(loader._get_snapshot_id(), f)
+            pickle.dump(PickledPayload(), f)
+
+        loader = CountingGraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+        loader.load()
+        self.assert_equal(1, loader.load_count)
+        self.assert_equal([], _unpickled_objects)
+
+    def test_invalid_snapshot_is_not_loaded(self):
+        loader = GraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+        snapshot_id = loader._get_snapshot_id()
+        loader.load()
+
+        invalid_snapshots = [
+            None,
+            {'example.com': ['host1.example.com']},
+            {'example.com': {'host1.example.com': {'load': ('system', 'Load', None, ((), ()), [], {}, 1)}}},
+            {'example.com': {'host1.example.com': {'load': ('system', 'Load', None, (('a',), ()), [], {})}}},
+            {'example.com': {'host1.example.com': {'load': ('system', 'Load', None, ((), ()), [1], {})}}},
+            {'example.com': {'host1.example.com': {'load': ('system', 'Load', None, ((), ()), [], {'f': (1, 2)})}}},
+        ]
+        for snapshot in invalid_snapshots:
+            with open(loader._snapshot_path, 'wb') as f:
+                marshal.dump(snapshot_id, f)
+                marshal.dump(snapshot, f)
+
+            loader = CountingGraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+            loader.load()
+            self.assert_equal(1, loader.load_count)
+            plugin = loader.config.domains['example.com'].hosts['host1.example.com'].plugins['load']
+            self.assert_equal('Load', plugin.title)
+
+    def test_snapshot_writable_by_others_is_not_loaded(self):
+        loader = GraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+        loader.load()
+        os.chmod(loader._snapshot_path, 0o660)
+
+        loader = CountingGraphLoader(self.datafile, snapshot_directory=self.snapshot_directory)
+        loader.load()
+        self.assert_equal(1, loader.load_count)
+
+    def test_filtered_plugins_are_not_loaded(self):
+        entries = parse_datafile_lines(DATAFILE.splitlines(keepends=True), GraphFilter(exclude_plugins='load'))
+        self.assert_equal([('example.com', 'host1.example.com', 'cpu'),
+                           ('example.org', 'host2.example.org', 'if_eth0')],
+                          list(entries))
+
+        for parallel_count in (1, 4):
+            loader = GraphLoader(self.datafile, parallel_count,
+                                 graph_filter=GraphFilter(domains='*.com', exclude_categories='system'))
+            loader.MIN_CHUNK_SIZE = 100
+            loader.load()
+            self.assert_equal([('example.com', 'host1.example.com', 'cpu')], list(loader.config.plugins))
+            self.assert_equal([('example.com', 'host1.example.com')], list(loader.config.hosts))
@@ -0,0 +1,73 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.config import GraphConfig, Plugin
+from dewi_utils.rrdtool.modifiers import (
+    ConfigModifier, ConfigModifierPipeline, IgnoreLoopbackDisks, RewriteDiskstatsLabels,
+    SeparateDiskstatsPluginsPerDevice,
+)
+
+
+class CountingModifier(ConfigModifier):
+    def __init__(self):
+        self.plugins = []
+
+    def _modify_plugin(self, plugin: Plugin):
+        self.plugins.append(plugin.name)
+
+
+class UppercaseTitles(ConfigModifier):
+    def modify(self, config: GraphConfig):
+        for d, h, p in config.plugins:
+            plugin = config.domains[d].hosts[h].plugins[p]
+            plugin.title = plugin.title.upper()
+
+
+def _create_config() -> GraphConfig:
+    config = GraphConfig()
+    for host_name in ['host1', 'host2']:
+        host = config.domains['example.com'].hosts[host_name]
+
+        plugin = host.plugins['diskstats_iops']
+        plugin.name = 'diskstats_iops'
+        plugin.title = 'Disk IOs'
+        plugin.category = 'disk'
+        plugin.period = 'second'
+        plugin.options['graph_args'] = '--base 1000'
+        plugin.field_order = ['sda_rdio', 'sda_wrio', 'loop0_rdio', 'loop0_wrio']
+        for name in plugin.field_order:
+            plugin.fields[name].options['label'] = name
+
+        plugin = host.plugins['load']
+        plugin.name = 'load'
+        plugin.title = 'Load average'
+        plugin.category = 'system'
+        plugin.field_order = ['load']
+        plugin.fields['load'].options['label'] = 'load'
+
+    return config
+
+
+class ConfigModifierPipelineTest(dewi_core.testcase.TestCase):
+    def _create_modifiers(self) -> list[ConfigModifier]:
+        return [IgnoreLoopbackDisks(), RewriteDiskstatsLabels(), UppercaseTitles(),
+                SeparateDiskstatsPluginsPerDevice(), CountingModifier()]
+
+    def test_result_is_the_same_as_of_the_separate_modifiers(self):
+        expected = _create_config()
+        for modifier in self._create_modifiers():
+            modifier.modify(expected)
+
+        config = _create_config()
+        ConfigModifierPipeline(self._create_modifiers()).modify(config)
+
+        self.assert_equal(expected.as_dict(), config.as_dict())
+        self.assert_equal(['load', 'diskstats_iops_sda'], list(config.domains['example.com'].hosts['host1'].plugins))
+        self.assert_equal('LOAD AVERAGE', config.domains['example.com'].hosts['host2'].plugins['load'].title)
+
+    def test_plugins_are_modified_after_the_host_level_modifiers(self):
+        counter = CountingModifier()
+        ConfigModifierPipeline([SeparateDiskstatsPluginsPerDevice(), counter]).modify(_create_config())
+
+        self.assert_equal(2 * ['load', 'diskstats_iops_sda', 'diskstats_iops_loop0'], counter.plugins)
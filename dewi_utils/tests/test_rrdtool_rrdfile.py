@@ -0,0 +1,71 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import math
+import os.path
+import tempfile
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.rrdfile import RrdFile, RrdFileError, read_last_update, write_rrd_file
+
+
+class RrdFileTest(dewi_core.testcase.TestCase):
+    def set_up(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'test.rrd')
+        # The archives are rotated differently, so the ring buffer is also wrapped at the end
+        write_rrd_file(self.filename, 1651406500, ['a', 'b'], [
+            ('AVERAGE', 1, [(1.0, 10.0), (2.0, 20.0), (3.0, 30.0), (4.0, math.nan)]),
+            ('AVERAGE', 12, [(5.0, 50.0), (6.0, 60.0), (7.0, 70.0)]),
+            ('MAX', 12, [(8.0, 80.0), (9.0, 90.0), (10.0, 100.0)]),
+        ], last_update_usec=123, current_rows=[0, 1, 2])
+
+    def tear_down(self):
+        self.tmpdir.cleanup()
+
+    def test_header_is_read(self):
+        with RrdFile(self.filename) as rrd:
+            self.assert_equal(3, rrd.version)
+            self.assert_equal(300, rrd.pdp_step)
+            self.assert_equal(1651406500, rrd.last_update)
+            self.assert_equal(123, rrd.last_update_usec)
+            self.assert_equal(['a', 'b'], [ds.name for ds in rrd.data_sources])
+            self.assert_equal(['GAUGE', 'GAUGE'], [ds.type for ds in rrd.data_sources])
+            self.assert_equal(600, rrd.data_sources[0].heartbeat)
+            self.assert_equal([('AVERAGE', 300), ('AVERAGE', 3600), ('MAX', 3600)],
+                              [(a.cf, a.step) for a in rrd.archives])
+
+        self.assert_equal(1651406500, read_last_update(self.filename))
+
+    def test_archive_is_read_from_the_oldest_row(self):
+        with RrdFile(self.filename) as rrd:
+            data = rrd.read_archive(0)
+            self.assert_equal([1.0, 2.0, 3.0, 4.0], list(data.columns['a']))
+            self.assert_equal([10.0, 20.0, 30.0], list(data.columns['b'])[:3])
+            self.assert_true(math.isnan(data.columns['b'][3]))
+            self.assert_equal(1651406400, data.end_time)
+            self.assert_equal([1651405500, 1651405800, 1651406100, 1651406400], list(data.timestamps))
+
+            data = rrd.read_archive(1)
+            self.assert_equal([5.0, 6.0, 7.0], list(data.columns['a']))
+            self.assert_equal([50.0, 60.0, 70.0], list(data.columns['b']))
+            self.assert_equal(1651406400 - 2 * 3600, data.start_time)
+
+    def test_archive_is_selected_by_cf_and_resolution(self):
+        with RrdFile(self.filename) as rrd:
+            self.assert_equal(0, rrd.find_archive('AVERAGE'))
+            self.assert_equal(1, rrd.find_archive('AVERAGE', 600))
+            self.assert_equal(1, rrd.find_archive('AVERAGE', 86400))
+            self.assert_equal(2, rrd.find_archive('MAX'))
+            with self.assert_raises(RrdFileError):
+                rrd.find_archive('MIN')
+
+    def test_invalid_files_are_rejected(self):
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+
+        for content in [b'', b'not an rrd file', data[:200], data[:-8]]:
+            with open(self.filename, 'wb') as f:
+                f.write(content)
+            with self.assert_raises(RrdFileError):
+                RrdFile(self.filename)
@@ -0,0 +1,106 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import os
+import os.path
+import tempfile
+import threading
+import unittest.mock
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.backend import GraphBackendType
+from dewi_utils.rrdtool.benchmark import generate_munin_directory, write_stub_rrdtool
+from dewi_utils.rrdtool.config import Plugin
+from dewi_utils.rrdtool.interval import GraphInterval
+from dewi_utils.rrdtool.server import GraphServer
+
+
+class FakeGraphServer(GraphServer):
+    def render(self, plugin: Plugin, interval: GraphInterval) -> bytes:
+        return f'{plugin.name}-{interval.interval_name}'.encode()
+
+
+class GraphServerTest(dewi_core.testcase.TestCase):
+    def set_up(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmpdir.name, 'datafile'), 'w') as f:
+            f.write('version 2.0.0\n'
+                    'example.com;host1.example.com:load.graph_title Load average\n'
+                    'example.com;host1.example.com:load.load.label load\n')
+        self.server = FakeGraphServer(self.tmpdir.name)
+
+    def tear_down(self):
+        self.tmpdir.cleanup()
+
+    def _get(self, path: str, method: str = 'GET') -> tuple[str, dict, bytes]:
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+
+        body = b''.join(self.server({'REQUEST_METHOD': method, 'PATH_INFO': path}, start_response))
+        return response['status'], response['headers'], body
+
+    def test_graph_is_rendered(self):
+        status, headers, body = self._get('/example.com/host1.example.com/load/hour.png')
+        self.assert_equal('200 OK', status)
+        self.assert_equal('image/png', headers['Content-Type'])
+        self.assert_equal(b'load-hour', body)
+
+    def test_unknown_graphs(self):
+        for path in ['/', '/example.com/host1.example.com/load', '/example.com/host1.example.com/load/day.svg',
+                     '/example.com/host2.example.com/load/day.png', '/example.com/host1.example.com/cpu/day.png',
+                     '/example.com/host1.example.com/load/decade.png']:
+            self.assert_equal('404 Not Found', self._get(path)[0])
+
+        # Unknown names are not added to the config
+        self.assert_equal([('example.com', 'host1.example.com', 'load')], list(self.server._get_config().plugins))
+
+    def test_only_get_is_allowed(self):
+        self.assert_equal('405 Method Not Allowed',
+                          self._get('/example.com/host1.example.com/load/day.png', method='POST')[0])
+
+
+class GraphServerRenderTest(dewi_core.testcase.TestCase):
+    def set_up(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.munin_directory = os.path.join(self.tmpdir.name, 'munin')
+        generate_munin_directory(self.munin_directory, hosts=1, plugins=8, fields=1)
+        write_stub_rrdtool(self.tmpdir.name)
+        self.path_patch = unittest.mock.patch.dict(
+            os.environ, PATH=self.tmpdir.name + os.pathsep + os.environ.get('PATH', ''))
+        self.path_patch.start()
+
+    def tear_down(self):
+        self.path_patch.stop()
+        self.tmpdir.cleanup()
+
+    def test_backends_are_shared_by_the_request_threads(self):
+        server = GraphServer(self.munin_directory, backend=GraphBackendType.PIPE, backend_count=2)
+        responses = []
+        bodies = []
+
+        def request(plugin: str, interval: str):
+            def start_response(status, headers):
+                responses.append(status)
+
+            path = f'/domain0.example.com/host0.domain0.example.com/{plugin}/{interval}.png'
+            bodies.append(b''.join(server({'PATH_INFO': path}, start_response)))
+
+        # A new thread per request, as by serve()
+        for interval in ['day', 'week', 'month']:
+            threads = [threading.Thread(target=request, args=(f'plugin{p}', interval)) for p in range(2, 8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assert_equal(18 * ['200 OK'], responses)
+        self.assert_true(all(body.startswith(b'\x89PNG') for body in bodies))
+        self.assert_equal(1, len(server._backends))
+        backend = next(iter(server._backends.values()))
+        self.assert_less_equal(backend.count, 2)
+
+        server.close()
+        self.assert_equal(0, backend.count)
@@ -0,0 +1,101 @@
+# Copyright 2022 Laszlo Attila Toth
+# Distributed under the terms of the Apache License, Version 2.0
+
+import datetime
+import os.path
+import tempfile
+
+import dewi_core.testcase
+from dewi_utils.rrdtool.backend import GraphBackend
+from dewi_utils.rrdtool.config import GraphConfig
+from dewi_utils.rrdtool.interval import GraphInterval, GraphIntervalType
+from dewi_utils.rrdtool.writer import DirectorySink, GraphResult, GraphWriter, GraphWriterJob
+
+
+class FakeGraphBackend(GraphBackend):
+    def __init__(self):
+        super().__init__()
+        self.args = []
+        self.batch_sizes = []
+
+    def graph(self, args: list[str]) -> bytes:
+        self.args.append(args)
+        return b'PNG'
+
+    def graph_many(self, args_list: list[list[str]]) -> list[bytes]:
+        self.batch_sizes.append(len(args_list))
+        return super().graph_many(args_list)
+
+
+class GraphWriterJobTest(dewi_core.testcase.TestCase):
+    def set_up(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config = GraphConfig()
+        plugin = self.config.domains['example.com'].hosts['host1'].plugins['load']
+        plugin.name = 'load'
+        plugin.title = 'Load average'
+        plugin.category = 'system'
+        plugin.period = 'second'
+        field = plugin.fields['load']
+        field.options.update({'label': 'load', 'draw': 'LINE1'})
+        field.filename = 'example.com/host1-load-load-g.rrd'
+        self.plugin = plugin
+        self.backend = FakeGraphBackend()
+
+    def tear_down(self):
+        self.tmpdir.cleanup()
+
+    def _create_job(self, sink=None, intervals=None) -> GraphWriterJob:
+        end_time = datetime.datetime(2022, 5, 1, 12, 0)
+        writer = GraphWriter(self.tmpdir.name, self.config, GraphResult(), end_time)
+        return GraphWriterJob(None, self.tmpdir.name, self.config, GraphResult(), end_time, int(end_time.timestamp()),
+                              400, 175, writer._header_args, None, self.plugin, GraphInterval(GraphIntervalType.DAY),
+                              intervals=intervals, backend=self.backend, sink=sink)
+
+    def test_graph_is_rendered_by_backend(self):
+        graph = self._create_job().generate_graph()
+
+        self.assert_equal(b'PNG', graph.image)
+        self.assert_equal('load', graph.short_name)
+        self.assert_equal('day', graph.interval_type)
+        args = self.backend.args[0]
+        self.assert_in('--start', args)
+        self.assert_in(f'DEF:gload={os.path.join(self.tmpdir.name, "example.com/host1-load-load-g.rrd")}:42:AVERAGE',
+                       args)
+
+    def test_image_is_written_by_sink(self):
+        graph = self._create_job(DirectorySink(os.path.join(self.tmpdir.name, 'out'), create=True)).generate_graph()
+
+        self.assert_is_none(graph.image)
+        self.assert_equal(os.path.join(self.tmpdir.name, 'out', 'system-load-day.png'), graph.filename)
+        with open(graph.filename, 'rb') as f:
+            self.assert_equal(b'PNG', f.read())
+
+    def test_intervals_are_rendered_at_once(self):
+        intervals = GraphInterval.default_intervals()
+        graphs = self._create_job(intervals=intervals).generate_graphs()
+
+        self.assert_equal([i.interval_name for i in intervals], [g.interval_type for g in graphs])
+        self.assert_equal([len(intervals)], self.backend.batch_sizes)
+
+        # Only the interval-specific arguments differ
+        start = self.backend.args[0].index('--start')
+        for args in self.backend.args[1:]:
+            self.assert_equal(self.backend.args[0][:start], args[:start])
+            self.assert_equal(self.backend.args[0][start + 6:], args[start + 6:])
+            self.assert_not_equal(self.backend.args[0][start:start + 6], args[start:start + 6])
+
+    def test_snapshots_are_rendered_at_once(self):
+        end_time = datetime.datetime(2022, 5, 1, 12, 0)
+        end_times = [int(end_time.timestamp()) - day * 86400 for day in range(90)]
+        writer = GraphWriter(self.tmpdir.name, self.config, GraphResult(), end_time)
+        interval = GraphInterval.sliding(86400, name='daily', resolution=300)
+
+        graphs = writer.render_snapshots(self.plugin, interval, end_times, self.backend)
+
+        self.assert_equal([90], self.backend.batch_sizes)
+        self.assert_equal(end_times, [g.end_time for g in graphs])
+        self.assert_equal([t - 86400 for t in end_times], [g.start_time for g in graphs])
+        self.assert_equal(b'PNG', graphs[0].image)
+        args = self.backend.args[-1]
+        self.assert_equal(['--step', '300'], args[args.index('--step'):args.index('--step') + 2])
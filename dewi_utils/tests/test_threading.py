@@ -2,12 +2,15 @@
 # Distributed under the terms of the Apache License, Version 2.0
 
 import multiprocessing
+import os
+import pickle
 import random
 import threading
 import time
 
 import dewi_core.testcase
-from dewi_utils.threading import Job, JobParam, LockableJob, Pool
+from dewi_utils.threading import HillClimbingConcurrencyController, Job, JobParam, LockableJob, MapReduceConfig, \
+    Pool, PriorityScheduler, SchedulerType, WorkStealingScheduler
 
 random.seed()
 
@@ -121,6 +124,323 @@ class Job5(TestJob):
         super().__init__(pool, state, 5)
 
 
+class ProcessJob(Job):
+    def __init__(self, pool: Pool, value: int, child_count: int = 0):
+        super().__init__(pool)
+        self._value = value
+        self._child_count = child_count
+        self._pid = None
+        self._square = None
+
+    def _run(self):
+        self._pid = os.getpid()
+        self._square = self._value * self._value
+
+    def next_job_class(self) -> type | None:
+        return ProcessJob
+
+    def next_job_param_list(self) -> list[JobParam]:
+        # called in the parent process, with the state set by _run() in the worker process
+        self.pool.state.store((self._pid, self._square))
+        return [JobParam(self._value * 10 + i) for i in range(self._child_count)]
+
+    def post_processor_job_class(self) -> type | None:
+        return ProcessJob if self._child_count else None
+
+    def post_processor_job_params(self) -> JobParam | None:
+        return JobParam(-self._value)
+
+
+class WindowJob(Job):
+    def __init__(self, pool: Pool, state: State, _=None):
+        super().__init__(pool)
+        self._state = state
+
+    def _run(self):
+        time.sleep(0.001)
+        self._state.store(len(self.pool.futures))
+
+
+class ResultJob(Job):
+    def __init__(self, pool: Pool, value: int, child_count: int = 0):
+        super().__init__(pool)
+        self._value = value
+        self._child_count = child_count
+
+    def _run(self):
+        time.sleep(random.randint(1, 20) / 1000)
+        return self._value
+
+    def next_job_class(self) -> type | None:
+        return ResultJob
+
+    def next_job_param_list(self) -> list[JobParam]:
+        return [JobParam(self._value * 10 + i) for i in range(self._child_count)]
+
+
+class FailingJob(Job):
+    def __init__(self, pool: Pool, _=None):
+        super().__init__(pool)
+
+    def _run(self):
+        raise RuntimeError('failure')
+
+
+class TinyJob(Job):
+    def __init__(self, pool: Pool, value: int, child_count: int = 0):
+        super().__init__(pool)
+        self._value = value
+        self._child_count = child_count
+
+    def _run(self):
+        return self._value
+
+    def next_job_class(self) -> type | None:
+        return TinyJob
+
+    def next_job_param_list(self) -> list[JobParam]:
+        return [JobParam(-1) for _ in range(self._child_count)]
+
+    def post_processor_job_class(self) -> type | None:
+        return TinyJob if self._child_count else None
+
+    def post_processor_job_params(self) -> JobParam | None:
+        return JobParam(-2)
+
+
+class FlakyJob(Job):
+    max_retries = 2
+    retry_delay = 0.01
+
+    def __init__(self, pool: Pool, failure_count: int):
+        super().__init__(pool)
+        self._failure_count = failure_count
+
+    def _run(self):
+        if self._failure_count:
+            self._failure_count -= 1
+            raise RuntimeError('transient failure')
+        return 'done'
+
+
+class HangingJob(Job):
+    timeout = 0.2
+
+    def __init__(self, pool: Pool, state: State, sleep_time: float):
+        super().__init__(pool)
+        self._state = state
+        self._sleep_time = sleep_time
+
+    def _run(self):
+        time.sleep(self._sleep_time)
+
+    def next_job_class(self) -> type | None:
+        return Job3
+
+    def next_job_param_list(self) -> list[JobParam]:
+        return [JobParam(self._state)]
+
+
+class LateCompletedJob(HangingJob):
+    timeout = 0.1
+
+    def run(self, _=None):
+        self.pool.job_started(self)
+        self.run_without_completion()
+        # the job is finished in time, but its completion is processed after the timeout
+        time.sleep(0.3)
+        self.pool.job_completed(self)
+
+
+class SlowFlakyJob(Job):
+    timeout = 0.1
+    max_retries = 5
+    retry_delay = 0.01
+
+    def __init__(self, pool: Pool, state: State):
+        super().__init__(pool)
+        self._state = state
+
+    def _run(self):
+        self._state.result.append(1)
+        time.sleep(0.15)
+        raise RuntimeError('slow failure')
+
+
+class FailingNextJobsJob(Job):
+    def __init__(self, pool: Pool, state: State, sleep_time: float):
+        super().__init__(pool)
+        self._state = state
+        self._sleep_time = sleep_time
+
+    def _run(self):
+        time.sleep(self._sleep_time)
+        self._state.result.append(self._sleep_time)
+        return self._sleep_time
+
+    def next_job_class(self) -> type | None:
+        return Job3
+
+    def next_job_param_list(self) -> list[JobParam]:
+        if not self._sleep_time:
+            raise ValueError('invalid next jobs')
+        return []
+
+
+class SleepingJob(Job):
+    timeout = 0.2
+
+    def __init__(self, pool: Pool, sleep_time: float):
+        super().__init__(pool)
+        self._sleep_time = sleep_time
+
+    def _run(self):
+        time.sleep(self._sleep_time)
+
+    def next_job_class(self) -> type | None:
+        return ResultJob
+
+    def next_job_param_list(self) -> list[JobParam]:
+        return [JobParam(1)]
+
+
+class CancellingJob(TestJob):
+    def __init__(self, pool, state: State, _=None):
+        super().__init__(pool, state, 1, next_job_class=Job2, next_job_count=5, postprocessor_job_class=Job4)
+
+    def _run(self):
+        super()._run()
+        self.pool.cancel()
+
+
+class MapReduceJob(Job):
+    def __init__(self, pool, reducer: bool = False):
+        super().__init__(pool)
+        self._reducer = reducer
+
+    def post_processor_job_class(self) -> type | None:
+        return MapReduceJob if self._reducer else None
+
+    def post_processor_job_params(self) -> JobParam | None:
+        return JobParam()
+
+
+class PriorityJob(Job):
+    def __init__(self, pool, priority: int, depth: int = 0, sequence_number: int = 0):
+        super().__init__(pool)
+        self._priority = priority
+        self.depth = depth
+        self.sequence_number = sequence_number
+
+    def priority(self) -> int:
+        return self._priority
+
+
+class SchedulerTest(dewi_core.testcase.TestCase):
+    def test_priority_scheduler_pops_highest_priority_then_deepest_job(self):
+        scheduler = PriorityScheduler()
+        jobs = [PriorityJob(None, 0, 0, 0), PriorityJob(None, 5, 0, 1), PriorityJob(None, 0, 3, 2),
+                PriorityJob(None, 5, 1, 3), PriorityJob(None, 0, 0, 4)]
+        for job in jobs:
+            scheduler.push(job, None)
+        self.assert_equal([3, 1, 2, 0, 4], [scheduler.pop().sequence_number for _ in jobs])
+
+    def test_work_stealing_scheduler_pops_own_latest_job_first(self):
+        scheduler = WorkStealingScheduler()
+        jobs = [PriorityJob(None, 0, sequence_number=i) for i in range(4)]
+        scheduler.push(jobs[0], None)
+        scheduler.push(jobs[1], None)
+        scheduler.push(jobs[2], threading.get_ident())
+        scheduler.push(jobs[3], threading.get_ident())
+        self.assert_equal([3, 2, 0, 1], [scheduler.pop().sequence_number for _ in jobs])
+
+    def test_work_stealing_scheduler_steals_oldest_job_of_other_worker(self):
+        scheduler = WorkStealingScheduler()
+        jobs = [PriorityJob(None, 0, sequence_number=i) for i in range(3)]
+        for job in jobs:
+            scheduler.push(job, threading.get_ident() + 1)
+        self.assert_equal([0, 1, 2], [scheduler.pop().sequence_number for _ in jobs])
+
+
+class MapReduceConfigTest(dewi_core.testcase.TestCase):
+    def test_reducer_is_returned_after_the_last_subjob_of_wide_fan_out(self):
+        config = MapReduceConfig()
+        root = MapReduceJob(None, reducer=True)
+        config.add_job(root, None)
+        children = [MapReduceJob(None) for _ in range(50000)]
+        for child in children:
+            config.add_job(child, root)
+        self.assert_is_none(config.may_reduce_job(None, root))
+
+        for child in children[:-1]:
+            self.assert_is_none(config.may_reduce_job(None, child))
+
+        reducer = config.may_reduce_job(None, children[-1])
+        self.assert_is_instance(reducer, MapReduceJob)
+        self.assert_is_not(root, reducer)
+        self.assert_is_none(config.may_reduce_job(None, reducer))
+        self.assert_equal(0, len(config))
+
+    def test_reducer_of_parent_waits_for_reducer_of_subjob(self):
+        config = MapReduceConfig()
+        root = MapReduceJob(None, reducer=True)
+        child = MapReduceJob(None, reducer=True)
+        grandchild = MapReduceJob(None)
+        config.add_job(root, None)
+        config.add_job(child, root)
+        config.add_job(grandchild, child)
+        self.assert_is_none(config.may_reduce_job(None, root))
+        self.assert_is_none(config.may_reduce_job(None, child))
+
+        child_reducer = config.may_reduce_job(None, grandchild)
+        self.assert_is_not_none(child_reducer)
+        root_reducer = config.may_reduce_job(None, child_reducer)
+        self.assert_is_not_none(root_reducer)
+        self.assert_is_none(config.may_reduce_job(None, root_reducer))
+        self.assert_equal(0, len(config))
+
+
+class FakePool:
+    def __init__(self, thread_count: int):
+        self.thread_count = thread_count
+        self.max_pending_jobs = None
+
+
+class HillClimbingConcurrencyControllerTest(dewi_core.testcase.TestCase):
+    def test_count_with_the_highest_throughput_is_found(self):
+        pool = FakePool(16)
+        controller = HillClimbingConcurrencyController(initial_count=1)
+        controller.start(pool)
+        self.assert_equal(1, pool.max_pending_jobs)
+
+        now = controller._window_start
+        for _ in range(2000):
+            # The throughput is the highest with 6 concurrent jobs, e.g. limited by the storage
+            count = pool.max_pending_jobs
+            job = Job(None)
+            job.started_at = now
+            now += 1 / (min(count, 6) - max(0, count - 6) * 0.5)
+            job.finished_at = now
+            controller.job_completed(pool, job)
+
+        counts = [h[0] for h in controller.history[-10:]]
+        self.assert_less_equal(max(counts), 7)
+        self.assert_greater_equal(min(counts), 4)
+
+    def test_count_is_between_the_limits(self):
+        pool = FakePool(2)
+        controller = HillClimbingConcurrencyController(initial_count=8)
+        controller.start(pool)
+        self.assert_equal(2, pool.max_pending_jobs)
+
+    def test_pool_runs_the_jobs_with_adjusted_concurrency(self):
+        controller = HillClimbingConcurrencyController(min_window=4)
+        pool = Pool(thread_count=4, concurrency_controller=controller)
+        self.assert_equal(list(range(100)), pool.map(ResultJob, JobParam.from_list(list(range(100)))))
+        self.assert_true(controller.history)
+        self.assert_equal(controller.count, pool.max_pending_jobs)
+
+
 class PoolTest(dewi_core.testcase.TestCase):
     def assert_state_result(self, thread_count: int, job_class: type[Job], job_count: int,
                             expected_list: list[int]):
@@ -182,3 +502,197 @@ class PoolTest(dewi_core.testcase.TestCase):
         self.assert_equal(2, pool.thread_count)
         job = LockableJob(pool)
         self.assert_is_not_none(job.lock)
+
+    def test_parallel_run_returns_without_waiting_for_wait_interval(self):
+        state = State()
+        pool = Pool(thread_count=2, wait_interval=30)
+        start = time.monotonic()
+        pool.run(Job3, [JobParam(state)])
+        self.assert_less(time.monotonic() - start, 10)
+        self.assert_equal([3], state.result)
+
+    def test_parallel_run_without_jobs(self):
+        pool = Pool(thread_count=2)
+        pool.run(Job3, [])
+        self.assert_false(pool.futures)
+
+    def test_process_pool_runs_jobs_in_worker_processes(self):
+        state = State()
+        pool = Pool(state=state, thread_count=2, use_processes=True)
+        pool.run(ProcessJob, [JobParam(1, 3)])
+
+        pids = [pid for pid, _ in state.result]
+        squares = [square for _, square in state.result]
+        self.assert_not_in(os.getpid(), pids)
+        self.assert_equal(1, squares[0])
+        self.assert_equal([100, 121, 144], sorted(squares[1:4]))
+        self.assert_equal(1, squares[4])
+        self.assert_equal(5, len(squares))
+
+    def test_lockable_job_is_picklable_without_lock(self):
+        pool = Pool(thread_count=2)
+        job = pickle.loads(pickle.dumps(LockableJob(pool)))
+        self.assert_is_none(job.lock)
+        self.assert_is_none(job.pool)
+
+    def test_max_pending_jobs_consumes_params_lazily(self):
+        state = State()
+        pool = Pool(state=state, thread_count=4, max_pending_jobs=3)
+        pool.run(WindowJob, (JobParam(state, i) for i in range(50)))
+        self.assert_equal(50, len(state.result))
+        self.assert_less_equal(max(state.result), 3)
+
+    def test_max_pending_jobs_with_next_and_reducer_jobs(self):
+        state = State()
+        pool = Pool(thread_count=4, max_pending_jobs=2)
+        pool.run(Job1, [JobParam(state)] * 2)
+        self.assert_equal(sorted((2 * [1]) + (2 * 5 * [2]) + (2 * 5 * 4 * [3]) + (2 * 5 * [5]) + (2 * [4])),
+                          sorted(state.result))
+        self.assert_equal(0, len(pool.map_reduce))
+
+    def test_sequential_map_returns_results_in_order(self):
+        pool = Pool(thread_count=1)
+        self.assert_equal([1, 10, 11, 2, 20, 21], pool.map(ResultJob, [JobParam(1, 2), JobParam(2, 2)]))
+
+    def test_parallel_map_returns_results_in_order_of_submission(self):
+        pool = Pool(thread_count=4)
+        self.assert_equal(list(range(30)), pool.map(ResultJob, JobParam.from_list(list(range(30)))))
+
+    def test_map_skips_none_results(self):
+        state = State()
+        pool = Pool(thread_count=4)
+        self.assert_equal([], pool.map(Job2, [JobParam(state)]))
+        self.assert_equal(6, len(state.result))
+
+    def test_as_completed_yields_results_of_next_jobs(self):
+        pool = Pool(thread_count=4, max_pending_jobs=2)
+        self.assert_equal([1, 2, 10, 11, 20, 21],
+                          sorted(pool.as_completed(ResultJob, [JobParam(1, 2), JobParam(2, 2)])))
+
+    def test_process_pool_map(self):
+        pool = Pool(thread_count=2, use_processes=True)
+        self.assert_equal([3, 30, 31, 32], pool.map(ResultJob, [JobParam(3, 3)]))
+
+    def test_statistics_per_job_class(self):
+        state = State()
+        pool = Pool(thread_count=4, log_interval=0.05)
+        pool.run(Job1, [JobParam(state)])
+
+        stats = pool.statistics
+        self.assert_equal(1 + 5 + 20 + 5 + 1, stats.completed_count)
+        self.assert_equal(0, stats.failure_count)
+        self.assert_equal({'Job1': 1, 'Job2': 5, 'Job3': 20, 'Job4': 1, 'Job5': 5},
+                          {name: s.count for name, s in stats.job_classes.items()})
+        self.assert_equal(1, stats.job_classes['Job4'].reducer_count)
+        self.assert_equal(5, stats.job_classes['Job5'].reducer_count)
+        self.assert_equal(0, stats.job_classes['Job3'].reducer_count)
+        self.assert_greater_equal(stats.job_classes['Job3'].max_run_time, 0.01)
+        self.assert_greater_equal(stats.job_classes['Job3'].average_run_time, 0.01)
+        self.assert_greater(stats.throughput, 0)
+
+    def test_statistics_count_failures(self):
+        pool = Pool(thread_count=1)
+        pool.run(FailingJob, [JobParam()] * 3)
+        self.assert_equal(3, pool.statistics.job_classes['FailingJob'].failure_count)
+        self.assert_equal(3, pool.statistics.failure_count)
+
+    def test_depth_first_scheduler(self):
+        state = State()
+        pool = Pool(thread_count=4, scheduler=SchedulerType.DEPTH_FIRST)
+        pool.run(Job1, [JobParam(state)] * 2)
+        self.assert_equal(sorted((2 * [1]) + (2 * 5 * [2]) + (2 * 5 * 4 * [3]) + (2 * 5 * [5]) + (2 * [4])),
+                          sorted(state.result))
+        self.assert_equal(0, len(pool.map_reduce))
+
+    def test_priority_scheduler_with_process_pool(self):
+        pool = Pool(thread_count=2, use_processes=True, scheduler=SchedulerType.PRIORITY, max_pending_jobs=3)
+        self.assert_equal([1, 2, 10, 11, 20, 21], sorted(pool.map(ResultJob, [JobParam(1, 2), JobParam(2, 2)])))
+
+    def test_failed_job_is_retried(self):
+        pool = Pool(thread_count=2)
+        self.assert_equal(['done', 'done'], pool.map(FlakyJob, [JobParam(0), JobParam(2)]))
+        self.assert_equal(2, pool.statistics.job_classes['FlakyJob'].retry_count)
+        self.assert_equal(0, pool.statistics.failure_count)
+
+    def test_job_fails_after_max_retries(self):
+        pool = Pool(thread_count=1)
+        self.assert_equal([], pool.map(FlakyJob, [JobParam(3)]))
+        self.assert_equal(2, pool.statistics.job_classes['FlakyJob'].retry_count)
+        self.assert_equal(1, pool.statistics.failure_count)
+
+    def test_timed_out_job_does_not_block_the_pool(self):
+        state = State()
+        pool = Pool(thread_count=2)
+        start = time.monotonic()
+        pool.run(HangingJob, [JobParam(state, 3), JobParam(state, 0)])
+        self.assert_less(time.monotonic() - start, 2)
+        self.assert_equal(1, pool.statistics.timed_out_count)
+        # only the next job of the non-hanging job is run
+        self.assert_equal([3], state.result)
+
+    def test_finished_job_does_not_time_out(self):
+        state = State()
+        pool = Pool(thread_count=2)
+        pool.run(LateCompletedJob, [JobParam(state, 0)])
+        self.assert_equal(0, pool.statistics.timed_out_count)
+        self.assert_equal([3], state.result)
+
+    def test_timed_out_jobs_do_not_block_the_waiting_jobs(self):
+        pool = Pool(thread_count=2)
+        start = time.monotonic()
+        self.assert_equal([1, 1], pool.map(SleepingJob, [JobParam(3), JobParam(3), JobParam(0), JobParam(0)]))
+        self.assert_less(time.monotonic() - start, 2)
+        self.assert_equal(2, pool.statistics.timed_out_count)
+
+    def test_timed_out_job_is_not_retried(self):
+        state = State()
+        pool = Pool(thread_count=2)
+        pool.run(SlowFlakyJob, [JobParam(state)])
+        time.sleep(0.3)
+        self.assert_equal([1], state.result)
+
+    def test_timed_out_job_in_process_pool(self):
+        pool = Pool(thread_count=2, use_processes=True)
+        start = time.monotonic()
+        self.assert_equal([1], pool.map(SleepingJob, [JobParam(3), JobParam(0)]))
+        self.assert_less(time.monotonic() - start, 2)
+        self.assert_equal(1, pool.statistics.timed_out_count)
+
+    def test_completion_error_is_raised_after_the_running_jobs(self):
+        for run in (Pool.run, Pool.map):
+            state = State()
+            pool = Pool(thread_count=2)
+            with self.assert_raises(ValueError):
+                run(pool, FailingNextJobsJob, [JobParam(state, 0.3), JobParam(state, 0)])
+            self.assert_true(pool.is_cancelled)
+            self.assert_equal([0, 0.3], state.result)
+            self.assert_false(pool.futures)
+
+    def test_cancel_skips_pending_and_next_jobs(self):
+        state = State()
+        pool = Pool(thread_count=2, max_pending_jobs=1)
+        pool.run(CancellingJob, [JobParam(state)] * 5)
+        self.assert_true(pool.is_cancelled)
+        self.assert_equal([1], state.result)
+
+    def test_sequential_cancel(self):
+        state = State()
+        pool = Pool(thread_count=1)
+        pool.run(CancellingJob, [JobParam(state)] * 5)
+        self.assert_equal([1], state.result)
+
+    def test_stopping_as_completed_cancels_the_pool(self):
+        pool = Pool(thread_count=2, max_pending_jobs=2)
+        for _ in pool.as_completed(ResultJob, JobParam.from_list(list(range(100)))):
+            break
+        self.assert_true(pool.is_cancelled)
+        self.assert_less(pool.statistics.completed_count, 100)
+
+    def test_many_tiny_jobs_with_reducers(self):
+        pool = Pool(thread_count=8)
+        results = pool.map(TinyJob, [JobParam(i, 10) for i in range(2000)])
+        self.assert_equal(list(range(2000)), [r for r in results if r >= 0])
+        self.assert_equal(2000 * 10, results.count(-1))
+        self.assert_equal(2000, results.count(-2))
+        self.assert_equal(0, len(pool.map_reduce))
+        self.assert_false(pool.futures)
@@ -1,14 +1,22 @@
 # Copyright 2020-2021 Laszlo Attila Toth
 # Distributed under the terms of the Apache License, Version 2.0
 
+import collections
+import collections.abc
+import enum
+import heapq
+import itertools
 import multiprocessing
+import operator
+import queue
 import threading
 import time
 from abc import ABC
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
 from typing import Optional
 
-from dewi_core.logger import log_error
+from dewi_core.logger import log_debug, log_error, log_info, log_warning
+from dewi_dataclass.node import Node
 
 
 class JobParam:
@@ -25,19 +33,98 @@ class JobParam:
 
 
 class Job(ABC):
+    # Retry policy of the job class: a failed _run() is retried at most max_retries times
+    # if the exception is one of retry_exceptions, the delay is multiplied by retry_backoff after each retry
+    max_retries: int = 0
+    retry_delay: float = 1.0
+    retry_backoff: float = 2.0
+    retry_exceptions: tuple[type[Exception], ...] = (Exception,)
+
+    # Wall-clock time limit of the job in seconds (None: no limit), see Pool
+    timeout: float | None = None
+
     def __init__(self, pool):
         self.pool: Pool = pool
         self.internal_future: Future = None
+        self.sequence_number: int | None = None
+        self.depth = 0
+        self.result = None
+        self.failed = False
+        self.retry_count = 0
+        self.timed_out = False
+        self.completed = False
+        # the ident of the worker thread, only set by the depth-first and priority schedulers
+        self.worker: int | None = None
+
+        # monotonic timestamps for the pool statistics
+        self.submitted_at: float | None = None
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.reducible_at: float | None = None
 
     def run(self, _=None):
-        try:
-            self._run()
-        except Exception as e:
-            log_error("Unhandled exception in job", class_name=e.__class__.__name__, exception=str(e), repr=repr(e))
+        self.pool.job_started(self)
+        if not self.is_cancelled:
+            self.run_without_completion()
         self.pool.job_completed(self)
 
+    def run_without_completion(self):
+        self.started_at = time.monotonic()
+        delay = self.retry_delay
+
+        while True:
+            try:
+                self.result = self._run()
+                break
+            except Exception as e:
+                if not self._may_retry(e, delay):
+                    break
+                self._sleep(delay)
+                delay *= self.retry_backoff
+
+        self.finished_at = time.monotonic()
+
+    def _may_retry(self, e: Exception, delay: float) -> bool:
+        if (self.retry_count < self.max_retries and isinstance(e, self.retry_exceptions)
+                and not self.is_cancelled and not self.timed_out):
+            self.retry_count += 1
+            log_warning("Retrying failed job", job_class=self.__class__.__name__, retry=self.retry_count,
+                        delay=delay, class_name=e.__class__.__name__, exception=str(e))
+            return True
+
+        self.failed = True
+        log_error("Unhandled exception in job", class_name=e.__class__.__name__, exception=str(e), repr=repr(e))
+        return False
+
+    def _sleep(self, delay: float):
+        if self.pool is not None:
+            # interrupted by Pool.cancel()
+            self.pool.cancel_event.wait(delay)
+        else:
+            time.sleep(delay)
+
+    @property
+    def is_cancelled(self) -> bool:
+        """
+        Long running jobs may check it periodically and return early if the pool is cancelled.
+        """
+        return self.pool is not None and self.pool.is_cancelled
+
+    def __getstate__(self):
+        # The pool cannot be sent to a worker process, the job's own state is transferred in both directions
+        state = dict(self.__dict__)
+        state.pop('pool', None)
+        state.pop('internal_future', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pool = None
+        self.internal_future = None
+
     def _run(self):
         # optionally use self.pool.state (perhaps as observer, etc.)
+        # the returned value, if it's not None, is available via Pool.map() and Pool.as_completed()
         raise NotImplementedError()
 
     def next_job_class(self) -> type | None:
@@ -52,52 +139,73 @@ class Job(ABC):
     def post_processor_job_params(self) -> JobParam | None:
         return None
 
+    def priority(self) -> int:
+        """
+        Used by the priority scheduler of the Pool, jobs with higher priority are started first.
+        """
+        return 0
+
 
 class MapReduceConfig:
+    """
+    Keeps track of the unfinished subjobs of each job to start the reducer (post processor) jobs.
+
+    A job is finished if it's completed and all of its subjobs are finished. Only the count
+    of the unfinished direct subjobs is stored, so adding a job costs O(1) and finishing
+    a job costs O(depth) in the worst case, when the whole chain of its ancestors is finished.
+    """
+
     def __init__(self):
-        self._job_subjobs_map: dict[Job, list[Job]] = dict()
-        self._job_to_parent_job_map: dict[Job] = dict()
+        self._unfinished_subjob_count: dict[Job, int] = dict()
+        self._job_to_parent_job_map: dict[Job, Job | None] = dict()
 
     def add_job(self, job: Job, parent: Job | None):
         self._job_to_parent_job_map[job] = parent
-        self._job_subjobs_map[job] = list()
+        self._unfinished_subjob_count[job] = 0
 
-        p = parent
-        while p:
-            self._job_subjobs_map[p].append(job)
-            p = self._job_to_parent_job_map[p]
+        if parent:
+            self._unfinished_subjob_count[parent] += 1
 
     def may_reduce_job(self, pool, job: Job | None) -> Job | None:
-        if not job or self._job_subjobs_map[job]:
-            return None
+        while job and not self._unfinished_subjob_count[job]:
+            del self._unfinished_subjob_count[job]
+            parent = self._job_to_parent_job_map.pop(job)
 
-        del self._job_subjobs_map[job]
+            reducer_job = self._get_reducer_job(pool, job)
+            if reducer_job:
+                # The reducer job replaces the finished job as a subjob of the parent
+                self._job_to_parent_job_map[reducer_job] = parent
+                self._unfinished_subjob_count[reducer_job] = 0
+                return reducer_job
 
-        parent = self._job_to_parent_job_map[job]
-        del self._job_to_parent_job_map[job]
-        self._remove_job_starting_with_parent(job, parent)
+            if parent:
+                self._unfinished_subjob_count[parent] -= 1
+            job = parent
 
-        reducer_job = self._get_reducer_job(pool, job)
-        if reducer_job:
-            self.add_job(reducer_job, parent)
-            return reducer_job
-        else:
-            return self.may_reduce_job(pool, parent)
+        return None
+
+    def hold_job(self, job: Job):
+        """
+        Keeps the job unfinished until release_job() is called, even if it has no unfinished subjobs.
+        """
+        self._unfinished_subjob_count[job] += 1
+
+    def release_job(self, pool, job: Job) -> Job | None:
+        self._unfinished_subjob_count[job] -= 1
+        return self.may_reduce_job(pool, job)
 
     def _get_reducer_job(self, pool, job: Job) -> Job | None:
         reducer_job_class = job.post_processor_job_class()
         if reducer_job_class:
             params = job.post_processor_job_params()
-            return reducer_job_class(pool, *params.args, **params.kwargs)
+            reducer_job = reducer_job_class(pool, *params.args, **params.kwargs)
+            reducer_job.depth = job.depth
+            return reducer_job
         else:
             return None
 
-    def _remove_job_starting_with_parent(self, job: Job, parent: Job):
-        p = parent
-
-        while p:
-            self._job_subjobs_map[p].remove(job)
-            p = self._job_to_parent_job_map[p]
+    def __len__(self):
+        return len(self._unfinished_subjob_count)
 
 
 class LockableJob(Job, ABC):
@@ -115,81 +223,771 @@ class LockableJob(Job, ABC):
         if self.lock:
             self.lock.release()
 
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop('lock', None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.lock = None
+
+
+class JobClassStatistics(Node):
+    """
+    Timing of the completed jobs of a job class, in seconds.
+
+    The queue wait time is the time between the submission and the start of the job.
+    The reducer latency is the time between the finish of the subtree of a job
+    and the completion of its reducer job, so it's counted for reducer jobs only.
+    """
+    name: str
+    count: int
+    failure_count: int
+    timeout_count: int
+    retry_count: int
+    queue_wait_time: float
+    max_queue_wait_time: float
+    run_time: float
+    max_run_time: float
+    reducer_count: int
+    reducer_latency: float
+    max_reducer_latency: float
+
+    def __init__(self):
+        self.name = ''
+        self.count = 0
+        self.failure_count = 0
+        self.timeout_count = 0
+        self.retry_count = 0
+        self.queue_wait_time = 0.0
+        self.max_queue_wait_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+        self.reducer_count = 0
+        self.reducer_latency = 0.0
+        self.max_reducer_latency = 0.0
+
+    def add_job(self, job: Job):
+        self.count += 1
+        if job.failed:
+            self.failure_count += 1
+        if job.timed_out:
+            self.timeout_count += 1
+        self.retry_count += job.retry_count
+
+        if job.started_at is None:
+            return
+
+        if job.submitted_at is not None:
+            queue_wait_time = max(0.0, job.started_at - job.submitted_at)
+            self.queue_wait_time += queue_wait_time
+            self.max_queue_wait_time = max(self.max_queue_wait_time, queue_wait_time)
+
+        run_time = job.finished_at - job.started_at
+        self.run_time += run_time
+        self.max_run_time = max(self.max_run_time, run_time)
+
+        if job.reducible_at is not None:
+            reducer_latency = job.finished_at - job.reducible_at
+            self.reducer_count += 1
+            self.reducer_latency += reducer_latency
+            self.max_reducer_latency = max(self.max_reducer_latency, reducer_latency)
+
+    @property
+    def average_queue_wait_time(self) -> float:
+        return self.queue_wait_time / self.count if self.count else 0.0
+
+    @property
+    def average_run_time(self) -> float:
+        return self.run_time / self.count if self.count else 0.0
+
+    @property
+    def average_reducer_latency(self) -> float:
+        return self.reducer_latency / self.reducer_count if self.reducer_count else 0.0
+
+
+class PoolStatistics(Node):
+    """
+    Statistics of the completed jobs of a Pool, grouped by job class name.
+    """
+    job_classes: dict[str, JobClassStatistics]
+
+    def __init__(self):
+        self.job_classes = dict()
+        self.start_time: float | None = None
+        self.end_time: float | None = None
+
+    def add_job(self, job: Job):
+        name = job.__class__.__name__
+        if name not in self.job_classes:
+            self.job_classes[name] = JobClassStatistics()
+            self.job_classes[name].name = name
+        self.job_classes[name].add_job(job)
+
+    @property
+    def completed_count(self) -> int:
+        return sum(s.count for s in self.job_classes.values())
+
+    @property
+    def failure_count(self) -> int:
+        return sum(s.failure_count for s in self.job_classes.values())
+
+    @property
+    def timed_out_count(self) -> int:
+        return sum(s.timeout_count for s in self.job_classes.values())
+
+    @property
+    def elapsed_time(self) -> float:
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    @property
+    def throughput(self) -> float:
+        """Completed jobs per second"""
+        elapsed = self.elapsed_time
+        return self.completed_count / elapsed if elapsed else 0.0
+
+    def log_progress(self, running_count: int):
+        log_info('Pool progress', completed=self.completed_count, failed=self.failure_count,
+                 running=running_count, elapsed=f'{self.elapsed_time:.3f}s', jobs_per_sec=f'{self.throughput:.2f}')
+
+    def log_summary(self):
+        self.log_progress(0)
+        for name in sorted(self.job_classes):
+            s = self.job_classes[name]
+            log_info('Pool job class statistics', job_class=name, count=s.count, failed=s.failure_count,
+                     timed_out=s.timeout_count, retries=s.retry_count,
+                     avg_queue_wait=f'{s.average_queue_wait_time:.3f}s', max_queue_wait=f'{s.max_queue_wait_time:.3f}s',
+                     avg_run=f'{s.average_run_time:.3f}s', max_run=f'{s.max_run_time:.3f}s',
+                     avg_reducer_latency=f'{s.average_reducer_latency:.3f}s')
+
+
+class SchedulerType(enum.Enum):
+    # The jobs are started in the order of submission
+    FIFO = 1
+    # Work-stealing: each worker thread has its own deque, the jobs created after the completion
+    # of a job (its next jobs and the reducer jobs) are pushed to the deque of the worker
+    # which ran the completed job, and the worker pops its latest job, so the subtrees
+    # are finished depth-first. An idle worker steals the oldest job of another worker.
+    DEPTH_FIRST = 2
+    # The job with the highest priority(), then the deepest job is started first
+    PRIORITY = 3
+
+
+class WorkStealingScheduler:
+    def __init__(self):
+        # jobs without a worker, e.g. the ones created by Pool.run()
+        self._shared_deque = collections.deque()
+        self._worker_deques: dict[int, collections.deque] = dict()
+        self._deques: list[collections.deque] = [self._shared_deque]
+        self._deques_lock = threading.Lock()
+
+    def _deque_of(self, worker: int) -> collections.deque:
+        worker_deque = self._worker_deques.get(worker)
+        if worker_deque is None:
+            with self._deques_lock:
+                worker_deque = self._worker_deques.get(worker)
+                if worker_deque is None:
+                    worker_deque = self._worker_deques[worker] = collections.deque()
+                    self._deques = self._deques + [worker_deque]
+        return worker_deque
+
+    def push(self, job: Job, worker: int | None):
+        if worker is None:
+            self._shared_deque.append(job)
+        else:
+            self._deque_of(worker).append(job)
+
+    def pop(self) -> Job:
+        """
+        Returns a pushed job to the current worker thread. It may only be called if there
+        is a pushed but not yet popped job, so retrying is only needed while a job is pushed
+        to an already checked deque.
+        """
+        own = self._deque_of(threading.get_ident())
+        while True:
+            try:
+                return own.pop()
+            except IndexError:
+                pass
+
+            for other in self._deques:
+                try:
+                    return other.popleft()
+                except IndexError:
+                    pass
+
+
+class PriorityScheduler:
+    def __init__(self):
+        self._heap: list[tuple[int, int, int, Job]] = list()
+        self._lock = threading.Lock()
+
+    def push(self, job: Job, worker: int | None):
+        with self._lock:
+            heapq.heappush(self._heap, (-job.priority(), -job.depth, job.sequence_number, job))
+
+    def pop(self) -> Job:
+        with self._lock:
+            return heapq.heappop(self._heap)[-1]
+
+
+class _JobSource:
+    def __init__(self, job_class_getter: collections.abc.Callable[[], type],
+                 params_iterator: collections.abc.Iterator[JobParam], parent: Job | None):
+        self.job_class = job_class_getter
+        self.params_iterator = params_iterator
+        self.parent = parent
+
+
+class _GrowableThreadPoolExecutor(ThreadPoolExecutor):
+    def add_thread(self):
+        """
+        Adds a thread to the executor for the waiting work items, if there is no idle thread.
+        It relies on the internals of ThreadPoolExecutor, which provides no public API for it.
+        """
+        self._max_workers += 1
+        self._adjust_thread_count()
+
+
+def _run_job_in_process(job: Job) -> dict:
+    job.run_without_completion()
+    return job.__getstate__()
+
+
+def _read_cpu_times() -> tuple[int, int] | None:
+    """
+    Returns the I/O wait and the total CPU time of the system (in ticks), or None if it's unknown
+    """
+    try:
+        with open('/proc/stat') as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+
+    if len(values) < 5:
+        return None
+    return values[4], sum(values)
+
+
+class ConcurrencyController:
+    """
+    Adjusts the count of the concurrently running jobs of a parallel Pool (its max_pending_jobs)
+    while the jobs are running. The methods are called by the coordinator thread of the pool.
+    """
+
+    def start(self, pool: 'Pool'):
+        pass
+
+    def job_completed(self, pool: 'Pool', job: Job):
+        pass
+
+
+class HillClimbingConcurrencyController(ConcurrencyController):
+    """
+    Searches the count of the concurrent jobs having the highest throughput by hill climbing.
+
+    It starts from initial_count (the CPU count by default), and after each window of completed jobs
+    it compares the throughput (jobs per second) to the previous window's. The count is changed by one
+    in the same direction while the throughput increases, and the direction is reversed if it decreases.
+    If the throughput doesn't change significantly (tolerance), fewer jobs are preferred. It also shrinks
+    if the system mostly waits for I/O (iowait_threshold, only on Linux) and the run time of the jobs increased,
+    e.g. if the jobs read files from a slow storage.
+
+    The pool's thread_count is the upper limit, the window is twice the current count, but at least min_window.
+    """
+
+    def __init__(self, *, initial_count: int | None = None, min_count: int = 1, min_window: int = 8,
+                 tolerance: float = 0.05, iowait_threshold: float = 0.3):
+        self._initial_count = initial_count
+        self._min_count = max(1, min_count)
+        self._min_window = max(1, min_window)
+        self._tolerance = tolerance
+        self._iowait_threshold = iowait_threshold
+
+        self._max_count = 1
+        self.count = 1
+        self._direction = 1
+        self._window_start: float | None = None
+        self._window_jobs = 0
+        self._window_run_time = 0.0
+        self._window_cpu_times: tuple[int, int] | None = None
+        self._previous_throughput: float | None = None
+        self._previous_run_time: float | None = None
+        # (count, throughput, average run time, iowait) of each window
+        self.history: list[tuple[int, float, float, float | None]] = list()
+
+    def start(self, pool: 'Pool'):
+        self._max_count = max(self._min_count, pool.thread_count)
+        initial_count = self._initial_count or multiprocessing.cpu_count()
+        self._set_count(pool, initial_count)
+        self._start_window(time.monotonic())
+
+    def _set_count(self, pool: 'Pool', count: int):
+        self.count = min(self._max_count, max(self._min_count, count))
+        pool.max_pending_jobs = self.count
+
+    def _start_window(self, now: float):
+        self._window_start = now
+        self._window_jobs = 0
+        self._window_run_time = 0.0
+        self._window_cpu_times = _read_cpu_times()
+
+    def _iowait_since_window_start(self) -> float | None:
+        cpu_times = _read_cpu_times()
+        if cpu_times is None or self._window_cpu_times is None or cpu_times[1] == self._window_cpu_times[1]:
+            return None
+        return (cpu_times[0] - self._window_cpu_times[0]) / (cpu_times[1] - self._window_cpu_times[1])
+
+    def job_completed(self, pool: 'Pool', job: Job):
+        if job.started_at is None or job.finished_at is None:
+            return
+
+        self._window_jobs += 1
+        self._window_run_time += job.finished_at - job.started_at
+        if self._window_jobs < max(self._min_window, 2 * self.count):
+            return
+
+        elapsed = job.finished_at - self._window_start
+        if elapsed <= 0:
+            return
+
+        throughput = self._window_jobs / elapsed
+        run_time = self._window_run_time / self._window_jobs
+        iowait = self._iowait_since_window_start()
+        self.history.append((self.count, throughput, run_time, iowait))
+
+        self._direction = self._next_direction(throughput, run_time, iowait)
+        self._previous_throughput = throughput
+        self._previous_run_time = run_time
+
+        previous_count = self.count
+        self._set_count(pool, self.count + self._direction)
+        if self.count != previous_count:
+            log_debug('Changed concurrent job count', count=self.count, previous_count=previous_count,
+                      jobs_per_sec=f'{throughput:.2f}', avg_run=f'{run_time:.3f}s', iowait=iowait)
+        elif self.count in (self._min_count, self._max_count):
+            # Cannot go further in this direction, try the other one next time
+            self._direction = -self._direction
+
+        self._start_window(job.finished_at)
+
+    def _next_direction(self, throughput: float, run_time: float, iowait: float | None) -> int:
+        if (iowait is not None and iowait > self._iowait_threshold
+                and self._previous_run_time is not None and run_time > self._previous_run_time * (1 + self._tolerance)):
+            return -1
+
+        if self._previous_throughput is None:
+            return self._direction
+        if throughput > self._previous_throughput * (1 + self._tolerance):
+            return self._direction
+        if throughput < self._previous_throughput * (1 - self._tolerance):
+            return -self._direction
+        return -1
+
 
 class Pool:
+    """
+    Runs jobs and their chained (next) and post processor (reducer) jobs.
+
+    If thread_count is 1, the jobs are run sequentially in the caller's thread,
+    otherwise in a ThreadPoolExecutor. The run() method returns when the last job,
+    including the chained and reducer jobs, is finished - it is signalled by the
+    completion of the job instead of polling. The wait_interval parameter is kept
+    for backward compatibility only.
+
+    If use_processes is True, the _run() method of the jobs is called in a
+    ProcessPoolExecutor having thread_count worker processes, even if thread_count is 1.
+    The jobs are pickled without their pool, so the job's _run() cannot access
+    self.pool, but the job's state is copied back after _run(), and the rest of the
+    methods (next_job_param_list(), post_processor_job_params(), etc.) are called
+    in the parent process, so these can use self.pool.state.
+
+    If max_pending_jobs is set, at most that many jobs are submitted to the executor
+    at the same time, the rest of the jobs are created from the JobParam iterables
+    (the params_list of run() and the next_job_param_list() of the jobs) only if there
+    is a free slot. This keeps the memory usage flat regardless of the count of the jobs.
+
+    The completion of the jobs is processed by the thread of run(), see _process_completed_jobs().
+
+    The values returned by the _run() methods of the jobs are available
+    either as a list via map() or as an iterator via as_completed(), which yields
+    the results while the rest of the jobs are still running.
+
+    The queue wait, run time, failures and reducer latency of the completed jobs
+    are collected per job class in `statistics`. If log_interval (in seconds) is set,
+    the progress is logged periodically while the jobs are running, and
+    the summary of the statistics is logged at the end of the run.
+
+    By default the executor starts the jobs in the order of submission, so
+    a tree of jobs is processed breadth-first. The scheduler parameter can change
+    it to depth-first (work-stealing) or priority order, see SchedulerType,
+    so the subtrees and their reducer jobs are finished sooner.
+
+    The failed jobs are retried based on the retry policy of their class (Job.max_retries, etc.).
+    If Job.timeout is set, a job running longer than that is considered failed,
+    it's completed without its next jobs, so the pool doesn't wait for it, and it isn't retried.
+    The pool cannot stop a thread, so the job keeps running in the background, and a new thread
+    is started in its place, so the waiting jobs are not blocked by the timed out ones. In process mode
+    the worker process is kept busy until the job returns, so the waiting jobs may be blocked
+    by the timed out jobs. In sequential mode (thread_count == 1) the timeout is not checked.
+
+    The run can be cancelled by cancel() from any thread (or from a job): the not yet
+    started jobs are skipped, and no more next or reducer jobs are created. The running
+    jobs can check their is_cancelled property to return early.
+
+    In parallel mode the count of the concurrent jobs can be adjusted while the jobs are running
+    by a concurrency_controller (e.g. HillClimbingConcurrencyController), which sets
+    max_pending_jobs. Then thread_count is the upper limit of the concurrent jobs.
+    """
     pool: ThreadPoolExecutor | None
-    lock: Optional[threading.Lock]
+    process_pool: ProcessPoolExecutor | None
     futures: set[Future]
 
-    def __init__(self, *, state=None, thread_count: int = 1, wait_interval: float = 0.1):
+    def __init__(self, *, state=None, thread_count: int = 1, wait_interval: float = 0.1,
+                 use_processes: bool = False, max_pending_jobs: int | None = None,
+                 log_interval: float | None = None, scheduler: SchedulerType = SchedulerType.FIFO,
+                 concurrency_controller: ConcurrencyController | None = None):
         self.state = state
         if thread_count == 0:
             thread_count = max(1, multiprocessing.cpu_count() - 1)
         self.thread_count = thread_count
         self.wait_interval = wait_interval
-        self.pool = None if thread_count == 1 else ThreadPoolExecutor(thread_count)
-        self.lock = None if thread_count == 1 else threading.Lock()
+        self.use_processes = use_processes
+        parallel = thread_count > 1 or use_processes
+        self.pool = _GrowableThreadPoolExecutor(thread_count) if parallel else None
+        self.process_pool = ProcessPoolExecutor(thread_count) if use_processes else None
         self.futures = set()
         self.map_reduce = MapReduceConfig()
+        self.max_pending_jobs = max(1, max_pending_jobs) if max_pending_jobs else None
+        self._completed_jobs: queue.SimpleQueue[Job | None] = queue.SimpleQueue()
+        self._job_sources: list[_JobSource] = list()
+        self._ready_jobs: collections.deque[tuple[Job, int | None]] = collections.deque()
+        self._sequence_numbers = itertools.count()
+        self._results: collections.deque[tuple[int, object]] | None = None
+        self.statistics = PoolStatistics()
+        self.scheduler = None
+        if parallel and scheduler == SchedulerType.DEPTH_FIRST:
+            self.scheduler = WorkStealingScheduler()
+        elif parallel and scheduler == SchedulerType.PRIORITY:
+            self.scheduler = PriorityScheduler()
+        self.cancel_event = threading.Event()
+        # The timeouts of the submitted but not started jobs, and the (deadline, sequence number, job)
+        # heap of the started ones, which are reported by the workers via _started_timed_jobs
+        self._unstarted_timeouts: collections.Counter[float] = collections.Counter()
+        self._started_timed_jobs: queue.SimpleQueue[tuple[float, Job]] = queue.SimpleQueue()
+        self._timed_jobs: list[tuple[float, int, Job]] = list()
+        self.log_interval = log_interval
+        self._next_log_time: float | None = None
+        self.concurrency_controller = concurrency_controller if parallel else None
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+        if self.pool:
+            # wake up the coordinator
+            self._completed_jobs.put(None)
 
-    def _acquire(self):
-        if self.lock:
-            self.lock.acquire()
+    def job_started(self, job: Job):
+        if self._is_timed(job):
+            self._started_timed_jobs.put((time.monotonic() + job.timeout, job))
 
-    def _release(self):
-        if self.lock:
-            self.lock.release()
+    def _is_timed(self, job: Job) -> bool:
+        return job.timeout is not None and self.pool is not None and not self.process_pool
 
     def job_completed(self, job: Job):
-        self._acquire()
+        if self.pool:
+            self._completed_jobs.put(job)
+        elif not job.completed:
+            self._complete_job(job)
+
+    def _complete_job(self, job: Job):
+        job.completed = True
         try:
-            self._register_next_jobs(job)
-            self._may_reduce(job)
-            self._remove_job_future(job)
+            self.statistics.add_job(job)
+            if self.concurrency_controller:
+                self.concurrency_controller.job_completed(self, job)
+            self._store_result(job)
+            if not self.is_cancelled:
+                if not job.timed_out:
+                    self._register_next_jobs(job)
+                self._may_reduce(job)
         finally:
-            self._release()
+            if self.pool:
+                self.futures.remove(job.internal_future)
 
-    def _remove_job_future(self, job: Job):
-        if self.pool:
-            # job.internal_future.result()
-            self.futures.remove(job.internal_future)
+    def _store_result(self, job: Job):
+        if self._results is not None and job.result is not None:
+            self._results.append((job.sequence_number, job.result))
 
     def _register_next_jobs(self, job: Job):
-        jobs = [job.next_job_class()(self, *params.args, **params.kwargs) for params in job.next_job_param_list()]
-
-        for j in jobs:
-            self._register_job(j, job, lock=False)
-
-    def _register_job(self, job: Job, parent: Job | None = None, lock=True):
         if self.pool:
-            self.map_reduce.add_job(job, parent)
+            # The job is kept unfinished until all of its next jobs are registered
+            self.map_reduce.hold_job(job)
+            self._job_sources.append(_JobSource(job.next_job_class, iter(job.next_job_param_list()), job))
+        else:
+            for params in job.next_job_param_list():
+                self._run_job(job.next_job_class()(self, *params.args, **params.kwargs))
+
+    def _run_job(self, job: Job):
+        job.sequence_number = next(self._sequence_numbers)
+        job.submitted_at = time.monotonic()
+        job.run()
+        self._may_log_progress()
+
+    def _submit_pending_jobs(self):
+        """
+        Submits the waiting reducer jobs and then the jobs created from the job sources,
+        until max_pending_jobs futures are in flight or there is nothing to submit.
+        The latest job source is used first, so the subtrees are finished sooner.
+        """
+        if self.is_cancelled:
+            self._job_sources.clear()
+            self._ready_jobs.clear()
+
+        while self.max_pending_jobs is None or len(self.futures) < self.max_pending_jobs:
+            if self._ready_jobs:
+                self._submit_job(*self._ready_jobs.popleft())
+            elif self._job_sources:
+                source = self._job_sources[-1]
+                params = next(source.params_iterator, None)
+                worker = source.parent.worker if source.parent else None
+                if params is None:
+                    self._job_sources.pop()
+                    if source.parent:
+                        self._add_reducer_job(self.map_reduce.release_job(self, source.parent), worker)
+                else:
+                    job = source.job_class()(self, *params.args, **params.kwargs)
+                    if source.parent:
+                        job.depth = source.parent.depth + 1
+                    self.map_reduce.add_job(job, source.parent)
+                    self._submit_job(job, worker)
+            else:
+                break
+
+    def _submit_job(self, job: Job, worker: int | None = None):
+        job.sequence_number = next(self._sequence_numbers)
+        job.submitted_at = time.monotonic()
+        if self._is_timed(job):
+            self._unstarted_timeouts[job.timeout] += 1
+        if self.scheduler:
+            # The future is not bound to the job, it runs the next job chosen by the scheduler,
+            # but there is one future per job, so the futures are still counted correctly.
+            self.scheduler.push(job, worker)
+            job.internal_future = self.pool.submit(self._run_scheduled_job)
+        elif self.process_pool:
+            job.internal_future = self.pool.submit(self._run_job_in_process, job)
+        else:
             job.internal_future = self.pool.submit(job.run)
-            self.futures.add(job.internal_future)
+        self.futures.add(job.internal_future)
+
+    def _run_scheduled_job(self):
+        job = self.scheduler.pop()
+        job.worker = threading.get_ident()
+        if self.process_pool:
+            self._run_job_in_process(job)
         else:
             job.run()
 
+    def _run_job_in_process(self, job: Job):
+        if not self.is_cancelled:
+            try:
+                job.__dict__.update(self.process_pool.submit(_run_job_in_process, job).result(job.timeout))
+            except TimeoutError:
+                self._set_timed_out(job)
+            except Exception as e:
+                job.failed = True
+                log_error("Unable to run job in worker process", job_class=job.__class__.__name__,
+                          class_name=e.__class__.__name__, exception=str(e), repr=repr(e))
+        self.job_completed(job)
+
+    def _set_timed_out(self, job: Job):
+        job.timed_out = job.failed = True
+        job.finished_at = time.monotonic()
+        log_error("Job timed out", job_class=job.__class__.__name__, timeout=job.timeout)
+
+    def _update_timed_jobs(self):
+        try:
+            while True:
+                deadline, job = self._started_timed_jobs.get_nowait()
+                self._unstarted_timeouts[job.timeout] -= 1
+                if not self._unstarted_timeouts[job.timeout]:
+                    del self._unstarted_timeouts[job.timeout]
+                heapq.heappush(self._timed_jobs, (deadline, job.sequence_number, job))
+        except queue.Empty:
+            pass
+
+        # The finished jobs cannot time out, even if their completion is not processed yet
+        while self._timed_jobs and self._is_finished(self._timed_jobs[0][-1]):
+            heapq.heappop(self._timed_jobs)
+
+    @staticmethod
+    def _is_finished(job: Job) -> bool:
+        return job.completed or job.finished_at is not None
+
+    def _complete_timed_out_jobs(self):
+        self._update_timed_jobs()
+        now = time.monotonic()
+        while self._timed_jobs and self._timed_jobs[0][0] <= now:
+            job = heapq.heappop(self._timed_jobs)[-1]
+            if not self._is_finished(job):
+                self._set_timed_out(job)
+                # The thread of the job is still busy
+                self.pool.add_thread()
+                self._complete_job(job)
+
+    def _time_until_next_check(self) -> float | None:
+        self._update_timed_jobs()
+        now = time.monotonic()
+        times = [self._next_log_time - now] if self._next_log_time is not None else []
+        if self._timed_jobs:
+            times.append(self._timed_jobs[0][0] - now)
+        if self._unstarted_timeouts:
+            # a job which is not started yet cannot time out sooner than its timeout
+            times.append(min(self._unstarted_timeouts))
+        return max(0.0, min(times)) if times else None
+
     def _may_reduce(self, job: Job):
         if self.pool:
-            reducer_job = self.map_reduce.may_reduce_job(self, job)
-            if reducer_job:
-                reducer_job.internal_future = self.pool.submit(reducer_job.run)
-                self.futures.add(reducer_job.internal_future)
+            self._add_reducer_job(self.map_reduce.may_reduce_job(self, job), job.worker)
         else:
             reducer_job_class = job.post_processor_job_class()
             if reducer_job_class:
                 params = job.post_processor_job_params()
-                reducer_job_class(self, *params.args, **params.kwargs).run()
+                reducer_job = reducer_job_class(self, *params.args, **params.kwargs)
+                reducer_job.reducible_at = time.monotonic()
+                self._run_job(reducer_job)
 
-    def run(self, job_class: type, params_list: list[JobParam]):
-        for params in params_list:
-            self._register_job(job_class(self, *params.args, **params.kwargs))
+    def _add_reducer_job(self, reducer_job: Job | None, worker: int | None):
+        if reducer_job:
+            reducer_job.reducible_at = time.monotonic()
+            self._ready_jobs.append((reducer_job, worker))
+
+    def run(self, job_class: type, params_list: collections.abc.Iterable[JobParam]):
+        """
+        Runs the jobs created from params_list, which may be any iterable, e.g. a generator.
+        In parallel mode and if max_pending_jobs is set, it is consumed lazily.
+
+        If the bookkeeping of the jobs raises an exception (e.g. a next_job_param_list() method),
+        the run is cancelled, and the exception is raised after the running jobs are finished.
+        """
         if self.pool:
+            try:
+                self._start(job_class, params_list)
+                self._wait_for_pool()
+            except BaseException:
+                self.cancel()
+                self._wait_for_pool()
+                raise
+        else:
+            self._start_statistics()
+            for params in params_list:
+                if self.is_cancelled:
+                    break
+                self._run_job(job_class(self, *params.args, **params.kwargs))
+            self._stop_statistics()
+
+    def map(self, job_class: type, params_list: collections.abc.Iterable[JobParam]) -> list:
+        """
+        Runs the jobs like run() and returns the non-None results of all jobs, including
+        the next and reducer jobs, in the order of the submission (creation) of the jobs.
+        """
+        return [result for _, result in sorted(self._iter_results(job_class, params_list),
+                                               key=operator.itemgetter(0))]
+
+    def as_completed(self, job_class: type,
+                     params_list: collections.abc.Iterable[JobParam]) -> collections.abc.Iterator:
+        """
+        Runs the jobs like run() and yields the non-None results of the jobs, including
+        the next and reducer jobs, as soon as they are completed.
+        """
+        for _, result in self._iter_results(job_class, params_list):
+            yield result
+
+    def _iter_results(self, job_class: type,
+                      params_list: collections.abc.Iterable[JobParam]) -> collections.abc.Iterator[tuple[int, object]]:
+        self._results = collections.deque()
+
+        if not self.pool:
+            self._start_statistics()
+            for params in params_list:
+                if self.is_cancelled:
+                    break
+                self._run_job(job_class(self, *params.args, **params.kwargs))
+                while self._results:
+                    yield self._results.popleft()
+            self._stop_statistics()
+            return
+
+        finished = False
+        try:
+            self._start(job_class, params_list)
+            while self.futures:
+                self._process_completed_jobs()
+                while self._results:
+                    yield self._results.popleft()
+            finished = True
+        finally:
+            if not finished:
+                # the consumer stopped the iteration, or the bookkeeping of a job raised an exception
+                self.cancel()
             self._wait_for_pool()
 
+    def _start(self, job_class: type, params_list: collections.abc.Iterable[JobParam]):
+        self._start_statistics()
+        if self.concurrency_controller:
+            self.concurrency_controller.start(self)
+        self._job_sources.append(_JobSource(lambda: job_class, iter(params_list), None))
+        self._submit_pending_jobs()
+
     def _wait_for_pool(self):
-        while True:
-            if len(self.futures):
-                time.sleep(self.wait_interval)
-                continue
-            self.pool.shutdown()
-            break
+        while self.futures:
+            self._process_completed_jobs()
+        # the threads / processes of the timed out jobs may still run
+        wait = not self.statistics.timed_out_count
+        self.pool.shutdown(wait=wait)
+        if self.process_pool:
+            self.process_pool.shutdown(wait=wait, cancel_futures=True)
+        self._stop_statistics()
+
+    def _process_completed_jobs(self):
+        """
+        The thread of run() (or the consumer of the results) is the coordinator of the pool:
+        the workers only put their completed jobs into a queue, and the bookkeeping (next jobs,
+        reducers, submission, statistics, timeouts) is done here, so no lock is needed
+        and the workers never wait for each other. All of the already completed jobs are processed
+        at once, and it returns after at least one job is completed, or a timeout or log event is due.
+        """
+        try:
+            job = self._completed_jobs.get(timeout=self._time_until_next_check())
+            while True:
+                # None is put by cancel(), and a timed out job is already completed
+                if job is not None and not job.completed:
+                    self._complete_job(job)
+                job = self._completed_jobs.get_nowait()
+        except queue.Empty:
+            pass
+
+        self._may_log_progress()
+        self._complete_timed_out_jobs()
+        self._submit_pending_jobs()
+
+    def _start_statistics(self):
+        self.statistics.start_time = time.monotonic()
+        if self.log_interval:
+            self._next_log_time = self.statistics.start_time + self.log_interval
+
+    def _stop_statistics(self):
+        self.statistics.end_time = time.monotonic()
+        if self.log_interval:
+            self.statistics.log_summary()
+
+    def _may_log_progress(self):
+        if self._next_log_time is not None and time.monotonic() >= self._next_log_time:
+            self.statistics.log_progress(len(self.futures))
+            self._next_log_time = time.monotonic() + self.log_interval